@@ -1,8 +1,6 @@
-import csv
 import os
-import shutil
 import sys
-import tempfile
+import threading
 import unittest
 
 import ctk
@@ -62,8 +60,7 @@ class TractographyMetricsWidget:
         except AttributeError:
             self.developerMode = settings.value('Developer/DeveloperMode') is True
 
-        self.tmp = tempfile.mkdtemp()
-        self.logic = TractographyMetricsLogic(self.tmp)
+        self.logic = TractographyMetricsLogic()
 
         if not parent:
             self.parent = slicer.qMRMLWidget()
@@ -226,6 +223,24 @@ class TractographyMetricsWidget:
         self.compute_button.connect('clicked(bool)', self.on_compute_button)
         tm_form_layout.addRow(self.compute_button)
 
+        # the computation runs in a worker thread, followed by the timer from the GUI thread
+        self.task = None
+        self.progress_bar = qt.QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.visible = False
+        self.cancel_button = qt.QPushButton('Cancel')
+        self.cancel_button.enabled = False
+        self.cancel_button.connect('clicked(bool)', self.on_cancel_button)
+
+        progress_layout = qt.QHBoxLayout()
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.cancel_button)
+        tm_form_layout.addRow(progress_layout)
+
+        self.timer = qt.QTimer()
+        self.timer.setInterval(100)
+        self.timer.connect('timeout()', self.on_timer)
+
         self.layout.addStretch(1)
 
         if self.developerMode:
@@ -280,209 +295,24 @@ class TractographyMetricsWidget:
     def on_compute_button(self):
         self.output_file_selector.addCurrentPathToHistory()
 
-        properties = {'useCompression': 0}
-        tracto_path = os.path.join(self.tmp, 'tracto.vtk')
-        slicer.util.saveNode(self.tracto_node, tracto_path, properties)
-
         if self.bzero_node or self.fa_node or self.md_node:
-            if self.bzero_node:
-                bzero_path = os.path.join(self.tmp, 'bzero.nii')
-                slicer.util.saveNode(self.bzero_node, bzero_path, properties)
-            else:
-                bzero_path = None
-            if self.fa_node:
-                fa_path = os.path.join(self.tmp, 'fa.nii')
-                slicer.util.saveNode(self.fa_node, fa_path, properties)
-            else:
-                fa_path = None
-            if self.md_node:
-                md_path = os.path.join(self.tmp, 'md.nii')
-                slicer.util.saveNode(self.md_node, md_path, properties)
-            else:
-                md_path = None
-
-            header = self.additional_info.document().toPlainText().encode('utf8')
-
-            txt_path = self.output_file_selector.currentPath.encode('utf-8')
+            # the fibers and the volumes are handed over in memory, without writing them to disk; they are copied here
+            # so that the nodes can be edited or removed while the computation runs
+            tractogram = fiber_streamlines(self.tracto_node.GetPolyData())
+            volumes = {}
+            for scalar_name, node in (('FA', self.fa_node), ('b-zero', self.bzero_node), ('MD', self.md_node)):
+                if node:
+                    volumes[scalar_name] = volume_arrays(node)
 
-            to_csv = self.to_csv.isChecked()
-            to_xlsx = self.to_xlsx.isChecked()
+            header = self.additional_info.document().toPlainText()
 
-            csv_fname, behaviors = self.logic.compute_stats(tracto_path, txt_path, fa_path, bzero_path, md_path, header,
-                                                            to_csv,
-                                                            to_xlsx, None)
-
-            pop_up_window = qt.QDialog(slicer.util.mainWindow())
-            pop_up_window.setLayout(qt.QVBoxLayout())
-            pop_up_title = qt.QLabel('Fiber Statistics')
-            pop_up_window.layout().addWidget(pop_up_title)
-            pop_up_window.layout().setAlignment(pop_up_title, 4)
-
-            with open(csv_fname, "r") as f:
-                reader = csv.reader(f, delimiter=";")
-                lines = [line for line in reader]
-
-            table = qt.QTableWidget(len(lines[0]), 2)
-            for i in range(len(lines[0])):
-                v = qt.QTableWidgetItem(lines[0][i])
-                table.setItem(i, 0, v)
-                v = qt.QTableWidgetItem(lines[1][i])
-                table.setItem(i, 1, v)
-
-            # table.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
-            # table.horizontalHeader().setStretchLastSection(True)
-            pop_up_window.layout().addWidget(table)
-
-            pop_up_window.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
-
-            if self.to_plot.isChecked():
-                if 'FA' in behaviors or 'b-zero' in behaviors or 'MD' in behaviors:
-                    if int(slicer.app.applicationVersion.split('.')[1]):
-                        lns = slicer.mrmlScene.GetNodesByClass('vtkMRMLLayoutNode')
-                        lns.InitTraversal()
-                        ln = lns.GetNextItemAsObject()
-                        ln.SetViewArrangement(24)
-
-                        cvns = slicer.mrmlScene.GetNodesByClass('vtkMRMLChartViewNode')
-                        cvns.InitTraversal()
-                        cvn = cvns.GetNextItemAsObject()
-
-                        cn = slicer.mrmlScene.AddNode(slicer.vtkMRMLChartNode())
-
-                        if 'FA' in behaviors:
-                            dn_fa = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
-                            a = dn_fa.GetArray()
-                            a.SetNumberOfTuples(20)
-                            x_label = range(5, 105, 5)
-                            for i in range(20):
-                                a.SetComponent(i, 0, x_label[i])
-                                a.SetComponent(i, 1, behaviors['FA'][i])
-
-                            cn.AddArray('FA', dn_fa.GetID())
-
-                        if 'MD' in behaviors:
-                            dn_md = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
-                            a = dn_md.GetArray()
-                            a.SetNumberOfTuples(20)
-                            x_label = range(5, 105, 5)
-                            for i in range(20):
-                                a.SetComponent(i, 0, x_label[i])
-                                a.SetComponent(i, 1, behaviors['MD'][i])
-
-                            cn.AddArray('MD', dn_md.GetID())
-
-                        if 'b-zero' in behaviors:
-                            dn_bz = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
-                            a = dn_bz.GetArray()
-                            a.SetNumberOfTuples(20)
-                            x_label = range(5, 105, 5)
-                            for i in range(20):
-                                a.SetComponent(i, 0, x_label[i])
-                                a.SetComponent(i, 1, behaviors['b-zero'][i])
-
-                            cn.AddArray('b-zero', dn_bz.GetID())
-
-                        cn.SetProperty('default', 'title', 'Diffusion Behaviors')
-                        cn.SetProperty('default', 'showLegend', 'on')
-                        cn.SetProperty('default', 'showMarkers', 'on')
-                        cn.SetProperty('default', 'xAxisPad', '0.2')
-                        cn.SetProperty('default', 'xAxisLabel', 'Fibers Portion (%)')
-                        cn.SetProperty('default', 'yAxisLabel', 'Normalized Metric Values')
-
-                        cvn.SetChartNodeID(cn.GetID())
-                    else:
-                        tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
-                        table = tableNode.GetTable()
-                        numPoints = 20
+            txt_path = self.output_file_selector.currentPath
 
-                        arrX = vtk.vtkFloatArray()
-                        arrX.SetName("%")
-                        table.AddColumn(arrX)
+            to_csv = self.to_csv.isChecked()
+            to_xlsx = self.to_xlsx.isChecked()
 
-                        table.SetNumberOfRows(numPoints)
-                        for i in range(numPoints):
-                            table.SetValue(i, 0, (i / 20) * 100)
-                        col = 1
-                        if 'FA' in behaviors:
-                            arrY1 = vtk.vtkFloatArray()
-                            arrY1.SetName("FA")
-                            table.AddColumn(arrY1)
-
-                            for i in range(numPoints):
-                                table.SetValue(i, col, behaviors['FA'][i])
-                            col += 1
-
-                            plotSeriesNode1 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "FA")
-                            plotSeriesNode1.SetAndObserveTableNodeID(tableNode.GetID())
-                            plotSeriesNode1.SetXColumnName("%")
-                            plotSeriesNode1.SetYColumnName("FA")
-                            plotSeriesNode1.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
-                            plotSeriesNode1.SetLineStyle(slicer.vtkMRMLPlotSeriesNode.LineStyleNone)
-                            plotSeriesNode1.SetMarkerStyle(slicer.vtkMRMLPlotSeriesNode.MarkerStyleSquare)
-                            plotSeriesNode1.SetUniqueColor()
-                        else:
-                            plotSeriesNode1 = None
-
-                        if 'MD' in behaviors:
-                            arrY2 = vtk.vtkFloatArray()
-                            arrY2.SetName("MD")
-                            table.AddColumn(arrY2)
-
-                            for i in range(numPoints):
-                                table.SetValue(i, col, behaviors['MD'][i])
-                            col += 1
-
-                            plotSeriesNode2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "MD")
-                            plotSeriesNode2.SetAndObserveTableNodeID(tableNode.GetID())
-                            plotSeriesNode2.SetXColumnName("%")
-                            plotSeriesNode2.SetYColumnName("MD")
-                            plotSeriesNode2.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
-                            plotSeriesNode2.SetUniqueColor()
-                        else:
-                            plotSeriesNode2 = None
-
-                        if 'b-zero' in behaviors:
-
-                            arrY3 = vtk.vtkFloatArray()
-                            arrY3.SetName("b-zero")
-                            table.AddColumn(arrY3)
-
-                            for i in range(numPoints):
-                                table.SetValue(i, col, behaviors['b-zero'][i])
-                            col += 1
-
-                            plotSeriesNode3 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "b-zero")
-                            plotSeriesNode3.SetAndObserveTableNodeID(tableNode.GetID())
-                            plotSeriesNode3.SetXColumnName("%")
-                            plotSeriesNode3.SetYColumnName("b-zero")
-                            plotSeriesNode3.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
-                            plotSeriesNode3.SetUniqueColor()
-                        else:
-                            plotSeriesNode3 = None
-
-                        plotChartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode")
-                        if plotSeriesNode1 is not None:
-                            plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode1.GetID())
-                        if plotSeriesNode2 is not None:
-                            plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode2.GetID())
-                        if plotSeriesNode3 is not None:
-                            plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode3.GetID())
-
-                        plotChartNode.SetTitle('Fiber Scalars')
-                        plotChartNode.SetXAxisTitle('Fiber Portion (%)')
-                        plotChartNode.SetYAxisTitle('Normalized Metric Values')
-
-                        layoutManager = slicer.app.layoutManager()
-                        layoutWithPlot = slicer.modules.plots.logic().GetLayoutWithPlot(layoutManager.layout)
-                        layoutManager.setLayout(layoutWithPlot)
-
-                        plotWidget = layoutManager.plotWidget(0)
-                        plotViewNode = plotWidget.mrmlPlotViewNode()
-                        plotViewNode.SetPlotChartNodeID(plotChartNode.GetID())
-
-            pop_up_window.show()
-
-            self.cleanup()
+            self.start_task(self.logic.compute_stats_in_memory, tractogram, volumes, txt_path, header, to_csv, to_xlsx,
+                            None)
         else:
             message = qt.QMessageBox()
             message.setText('At least one scalar metric map must be selected')
@@ -490,6 +320,214 @@ class TractographyMetricsWidget:
             message.setIcon(qt.QMessageBox.Critical)
             message.exec_()
 
+    def start_task(self, function, *args):
+        """
+        Run a computation in the background; the timer follows its progress from the GUI thread
+        """
+        self.task = TractographyMetricsTask(function, *args)
+        self.compute_button.enabled = False
+        self.cancel_button.enabled = True
+        self.progress_bar.value = 0
+        self.progress_bar.format = '%p%'
+        self.progress_bar.visible = True
+        self.task.start()
+        self.timer.start()
+
+    def on_cancel_button(self):
+        if self.task is not None:
+            self.cancel_button.enabled = False
+            self.progress_bar.format = 'Cancelling...'
+            self.task.cancel()
+
+    def on_timer(self):
+        task = self.task
+        if task.is_alive():
+            if not task.progress.token.cancelled:
+                self.progress_bar.value = int(round(100 * task.fraction))
+                self.progress_bar.format = '{} %p%'.format(task.stage or '')
+            return
+
+        self.timer.stop()
+        self.task = None
+        self.compute_button.enabled = True
+        self.cancel_button.enabled = False
+        self.progress_bar.visible = False
+        if isinstance(task.error, tm.Cancelled):
+            slicer.util.showStatusMessage('Tractography metrics cancelled', 3000)
+        elif task.error is not None:
+            slicer.util.errorDisplay('Tractography metrics failed: {}'.format(task.error))
+        else:
+            self.show_results(*task.result)
+
+    def show_results(self, report, behaviors):
+        pop_up_window = qt.QDialog(slicer.util.mainWindow())
+        pop_up_window.setLayout(qt.QVBoxLayout())
+        pop_up_title = qt.QLabel('Fiber Statistics')
+        pop_up_window.layout().addWidget(pop_up_title)
+        pop_up_window.layout().setAlignment(pop_up_title, 4)
+
+        rows = list(report.to_dict().items())
+
+        table = qt.QTableWidget(len(rows), 2)
+        for i, (key, value) in enumerate(rows):
+            v = qt.QTableWidgetItem(key)
+            table.setItem(i, 0, v)
+            v = qt.QTableWidgetItem(str(value))
+            table.setItem(i, 1, v)
+
+        # table.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
+        # table.horizontalHeader().setStretchLastSection(True)
+        pop_up_window.layout().addWidget(table)
+
+        pop_up_window.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
+
+        if self.to_plot.isChecked():
+            if 'FA' in behaviors or 'b-zero' in behaviors or 'MD' in behaviors:
+                if int(slicer.app.applicationVersion.split('.')[1]):
+                    lns = slicer.mrmlScene.GetNodesByClass('vtkMRMLLayoutNode')
+                    lns.InitTraversal()
+                    ln = lns.GetNextItemAsObject()
+                    ln.SetViewArrangement(24)
+
+                    cvns = slicer.mrmlScene.GetNodesByClass('vtkMRMLChartViewNode')
+                    cvns.InitTraversal()
+                    cvn = cvns.GetNextItemAsObject()
+
+                    cn = slicer.mrmlScene.AddNode(slicer.vtkMRMLChartNode())
+
+                    if 'FA' in behaviors:
+                        dn_fa = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
+                        a = dn_fa.GetArray()
+                        a.SetNumberOfTuples(20)
+                        x_label = range(5, 105, 5)
+                        for i in range(20):
+                            a.SetComponent(i, 0, x_label[i])
+                            a.SetComponent(i, 1, behaviors['FA'][i])
+
+                        cn.AddArray('FA', dn_fa.GetID())
+
+                    if 'MD' in behaviors:
+                        dn_md = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
+                        a = dn_md.GetArray()
+                        a.SetNumberOfTuples(20)
+                        x_label = range(5, 105, 5)
+                        for i in range(20):
+                            a.SetComponent(i, 0, x_label[i])
+                            a.SetComponent(i, 1, behaviors['MD'][i])
+
+                        cn.AddArray('MD', dn_md.GetID())
+
+                    if 'b-zero' in behaviors:
+                        dn_bz = slicer.mrmlScene.AddNode(slicer.vtkMRMLDoubleArrayNode())
+                        a = dn_bz.GetArray()
+                        a.SetNumberOfTuples(20)
+                        x_label = range(5, 105, 5)
+                        for i in range(20):
+                            a.SetComponent(i, 0, x_label[i])
+                            a.SetComponent(i, 1, behaviors['b-zero'][i])
+
+                        cn.AddArray('b-zero', dn_bz.GetID())
+
+                    cn.SetProperty('default', 'title', 'Diffusion Behaviors')
+                    cn.SetProperty('default', 'showLegend', 'on')
+                    cn.SetProperty('default', 'showMarkers', 'on')
+                    cn.SetProperty('default', 'xAxisPad', '0.2')
+                    cn.SetProperty('default', 'xAxisLabel', 'Fibers Portion (%)')
+                    cn.SetProperty('default', 'yAxisLabel', 'Normalized Metric Values')
+
+                    cvn.SetChartNodeID(cn.GetID())
+                else:
+                    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+                    table = tableNode.GetTable()
+                    numPoints = 20
+
+                    arrX = vtk.vtkFloatArray()
+                    arrX.SetName("%")
+                    table.AddColumn(arrX)
+
+                    table.SetNumberOfRows(numPoints)
+                    for i in range(numPoints):
+                        table.SetValue(i, 0, (i / 20) * 100)
+                    col = 1
+                    if 'FA' in behaviors:
+                        arrY1 = vtk.vtkFloatArray()
+                        arrY1.SetName("FA")
+                        table.AddColumn(arrY1)
+
+                        for i in range(numPoints):
+                            table.SetValue(i, col, behaviors['FA'][i])
+                        col += 1
+
+                        plotSeriesNode1 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "FA")
+                        plotSeriesNode1.SetAndObserveTableNodeID(tableNode.GetID())
+                        plotSeriesNode1.SetXColumnName("%")
+                        plotSeriesNode1.SetYColumnName("FA")
+                        plotSeriesNode1.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
+                        plotSeriesNode1.SetLineStyle(slicer.vtkMRMLPlotSeriesNode.LineStyleNone)
+                        plotSeriesNode1.SetMarkerStyle(slicer.vtkMRMLPlotSeriesNode.MarkerStyleSquare)
+                        plotSeriesNode1.SetUniqueColor()
+                    else:
+                        plotSeriesNode1 = None
+
+                    if 'MD' in behaviors:
+                        arrY2 = vtk.vtkFloatArray()
+                        arrY2.SetName("MD")
+                        table.AddColumn(arrY2)
+
+                        for i in range(numPoints):
+                            table.SetValue(i, col, behaviors['MD'][i])
+                        col += 1
+
+                        plotSeriesNode2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "MD")
+                        plotSeriesNode2.SetAndObserveTableNodeID(tableNode.GetID())
+                        plotSeriesNode2.SetXColumnName("%")
+                        plotSeriesNode2.SetYColumnName("MD")
+                        plotSeriesNode2.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
+                        plotSeriesNode2.SetUniqueColor()
+                    else:
+                        plotSeriesNode2 = None
+
+                    if 'b-zero' in behaviors:
+
+                        arrY3 = vtk.vtkFloatArray()
+                        arrY3.SetName("b-zero")
+                        table.AddColumn(arrY3)
+
+                        for i in range(numPoints):
+                            table.SetValue(i, col, behaviors['b-zero'][i])
+                        col += 1
+
+                        plotSeriesNode3 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", "b-zero")
+                        plotSeriesNode3.SetAndObserveTableNodeID(tableNode.GetID())
+                        plotSeriesNode3.SetXColumnName("%")
+                        plotSeriesNode3.SetYColumnName("b-zero")
+                        plotSeriesNode3.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
+                        plotSeriesNode3.SetUniqueColor()
+                    else:
+                        plotSeriesNode3 = None
+
+                    plotChartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode")
+                    if plotSeriesNode1 is not None:
+                        plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode1.GetID())
+                    if plotSeriesNode2 is not None:
+                        plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode2.GetID())
+                    if plotSeriesNode3 is not None:
+                        plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode3.GetID())
+
+                    plotChartNode.SetTitle('Fiber Scalars')
+                    plotChartNode.SetXAxisTitle('Fiber Portion (%)')
+                    plotChartNode.SetYAxisTitle('Normalized Metric Values')
+
+                    layoutManager = slicer.app.layoutManager()
+                    layoutWithPlot = slicer.modules.plots.logic().GetLayoutWithPlot(layoutManager.layout)
+                    layoutManager.setLayout(layoutWithPlot)
+
+                    plotWidget = layoutManager.plotWidget(0)
+                    plotViewNode = plotWidget.mrmlPlotViewNode()
+                    plotViewNode.SetPlotChartNodeID(plotChartNode.GetID())
+
+        pop_up_window.show()
+
     def onReload(self):
 
         print('\n' * 2)
@@ -515,27 +553,80 @@ class TractographyMetricsWidget:
         filePath = slicer.util.modulePath(self.moduleName)
         qt.QDesktopServices.openUrl(qt.QUrl("file:///" + filePath, qt.QUrl.TolerantMode))
 
-    def cleanup(self):
-        for filename in os.listdir(self.tmp):
-            path = os.path.join(self.tmp, filename)
-            if os.path.isfile(path):
-                os.unlink(path)
-            elif os.path.isdir(path):
-                shutil.rmtree(path)
-
 
 class TractographyMetricsLogic:
-    def __init__(self, temp_folder):
-        self.temp_folder = temp_folder
+    @staticmethod
+    def compute_stats_in_memory(tractogram, volumes, txt_filepath, header, to_csv, to_xlsx, perc_resampling,
+                                progress=None):
+        """
+        Metrics of a fiber bundle and of volumes held in memory (see processing_tm.pipeline.compute_in_memory)
+        :param tractogram: fibers of the bundle node (RAS coordinates), see fiber_streamlines
+        :param volumes: dictionary map name -> (IJK voxel array, IJK to RAS matrix), see volume_arrays
+        :param progress: processing_tm.Progress of the computation (None to disable)
+        :return: report (processing_tm.logic_tm.report.Report), along-tract profiles
+        """
+        # thread workers: no process is spawned from Slicer, and the chunks are the cancellation points
+        report, behaviors = tm.pipeline.compute_in_memory(tractogram, volumes, perc_resampling,
+                                                          jobs=os.cpu_count() or 1, backend='thread', progress=progress)
+        tm.pipeline.save_report(report, txt_filepath, header, to_csv, to_xlsx)
+        return report, behaviors
+
+
+def fiber_streamlines(polydata):
+    """
+    Copy of the fibers of a vtkPolyData (packed streamlines)
+    """
+    tractogram = tm.logic_tm.input_output.vtkpolydata_to_tracts(polydata)[0]
+    return tm.logic_tm.streamlines.as_streamlines(tractogram).copy()
+
+
+def volume_arrays(node):
+    """
+    Copy of the voxels of a scalar volume node in IJK order (arrayFromVolume gives KJI, the transpose keeps the memory
+    layout) and its IJK to RAS matrix
+    """
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(ijk_to_ras)
+    return slicer.util.arrayFromVolume(node).transpose(2, 1, 0).copy(order='K'), \
+        slicer.util.arrayFromVTKMatrix(ijk_to_ras)
+
+
+class TractographyMetricsTask(threading.Thread):
+    """
+    Computation run in a worker thread. The GUI thread reads fraction, stage, result and error (Qt is never called
+    from the worker) and may cancel it.
+    """
+
+    def __init__(self, function, *args):
+        """
+        Object creation operations
+        :param function: computation, called as function(*args, progress=...)
+        :param args: arguments of the computation
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.progress = tm.Progress(self.on_progress)
+        self.fraction = 0.
+        self.stage = None
+        self.result = None
+        self.error = None
 
-    def compute_stats(self, tractogram, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv, to_xlsx,
-                      perc_resampling):
-        from_plugin = {'csv_fname': os.path.join(self.temp_folder, 'table.csv')}
-        csv_fname, behaviors = tm.proc(tractogram, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header,
-                                       to_csv, to_xlsx,
-                                       perc_resampling, from_plugin)
+    def __repr__(self):
+        return 'TractographyMetricsTask({})'.format(self.progress)
+
+    def on_progress(self, fraction, stage):
+        self.fraction, self.stage = fraction, stage
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, progress=self.progress)
+        except Exception as e:
+            self.error = e
 
-        return csv_fname, behaviors
+    def cancel(self):
+        self.progress.cancel()
 
 
 class TractographyMetricsTest(unittest.TestCase):
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup guard: importing the package and the --version/--help paths of the entry points must not load the heavy
+dependencies, and must start within a time budget (startup dominates the small-bundle jobs of a batch farm). Exits with
+status 1 on a violation.
+
+    python benchmarks/check_startup.py
+    python benchmarks/check_startup.py --max-seconds 0.5 -o startup.json
+"""
+
+import sys
+import os.path
+import json
+import argparse
+import subprocess
+from time import perf_counter
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('vtk', 'dipy', 'nibabel', 'xlsxwriter', 'scipy', 'pyarrow')
+MAX_SECONDS = 1.
+# name, entry point (None for a plain import of the package), arguments
+COMMANDS = [('import', None, []),
+            ('version', 'tractography_metrics.py', ['--version']),
+            ('help', 'tractography_metrics.py', ['--help']),
+            ('batch_help', 'tractography_metrics_batch.py', ['--help']),
+            ('service_help', 'tractography_metrics_service.py', ['--help'])]
+# runs an entry point (or imports the package) and prints the loaded heavy modules on stderr
+PROBE = '''
+import sys, json, runpy
+sys.path.insert(0, {root!r})
+if {script!r} is None:
+    import processing_tm
+else:
+    sys.argv = [{script!r}] + {args!r}
+    try:
+        runpy.run_path({script!r}, run_name='__main__')
+    except SystemExit:
+        pass
+sys.stderr.write(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules) & set({heavy!r}))))
+'''
+
+
+def main():
+    repeats, max_seconds, output = setup()
+
+    results, failures = [], 0
+    baseline = best_time([sys.executable, '-c', 'pass'], repeats)
+    print('{:<14} {:8.3f} s'.format('interpreter', baseline))
+    for name, script, args in COMMANDS:
+        path = os.path.join(ROOT, script) if script else None
+        probe = PROBE.format(root=ROOT, script=path, args=args, heavy=HEAVY_MODULES)
+        seconds = best_time([sys.executable, '-c', probe], repeats)
+        heavy = heavy_imports(probe)
+        ok = not heavy and seconds <= max_seconds
+        failures += not ok
+        results.append({'command': name, 'seconds': seconds, 'heavy_imports': heavy, 'ok': ok})
+        print('{:<14} {:8.3f} s {}{}'.format(name, seconds, 'ok' if ok else 'FAILED',
+                                             ' (imports {})'.format(', '.join(heavy)) if heavy else ''))
+
+    if output:
+        with open(output, 'w') as handle:
+            json.dump({'interpreter': baseline, 'max_seconds': max_seconds, 'results': results}, handle, indent=1)
+    if failures:
+        sys.exit(1)
+
+
+def setup():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeats', help='Runs per command, the best one is kept (default: %(default)s)',
+                        type=int, default=5)
+    parser.add_argument('--max-seconds', help='Startup time budget of every command (default: %(default)s)',
+                        type=float, default=MAX_SECONDS)
+    parser.add_argument('-o', '--output', help='JSON file receiving the timings')
+
+    args = parser.parse_args()
+
+    return args.repeats, args.max_seconds, args.output
+
+
+def best_time(command, repeats):
+    """
+    Best wall time of a command over several runs
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        best = min(best, perf_counter() - t0)
+    return best
+
+
+def heavy_imports(probe):
+    """
+    Heavy modules loaded by a probe
+    """
+    result = subprocess.run([sys.executable, '-c', probe], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            check=True)
+    return json.loads(result.stderr.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
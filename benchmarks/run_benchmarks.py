@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-stage timings of the pipeline on synthetic tractograms of increasing size, saved as JSON and optionally compared
+with a baseline run.
+
+    python benchmarks/run_benchmarks.py -n 1000 10000 100000 -l short long -o results.json
+    python benchmarks/run_benchmarks.py -o new.json --compare results.json
+"""
+
+import sys
+import os.path
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+import shutil
+from time import perf_counter, strftime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import processing_tm as tm  # noqa: E402
+import processing_tm.logic_tm as lg  # noqa: E402
+from processing_tm.logic_tm.profiles import mean_profile  # noqa: E402
+import synthetic  # noqa: E402
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_LENGTHS = ['short', 'medium', 'long']
+DEFAULT_FORMATS = ['vtk', 'tck', 'trk']
+TOLERANCE = .2
+MIN_SECONDS = .01
+
+
+def main():
+    (sizes, lengths, formats, repeats, output, baseline, tolerance, min_seconds, data_dir, keep,
+     n_bins) = setup()
+
+    folder = data_dir or tempfile.mkdtemp(prefix='tm_bench_')
+    try:
+        results = []
+        for n_lines in sizes:
+            for length in lengths:
+                results.extend(bench_case(folder, n_lines, length, formats, repeats, n_bins))
+    finally:
+        if not data_dir and not keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {'meta': environment(), 'results': results}
+    if output:
+        with open(output, 'w') as handle:
+            json.dump(report, handle, indent=1)
+
+    if baseline:
+        with open(baseline) as handle:
+            regressions = compare(json.load(handle), report, tolerance, min_seconds)
+        if regressions:
+            sys.exit(1)
+
+
+def setup():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--sizes', help='Numbers of streamlines (default: %(default)s)', type=int, nargs='+',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('-l', '--lengths', help='Fiber length presets (default: %(default)s)', nargs='+',
+                        choices=sorted(synthetic.FIBER_LENGTHS), default=DEFAULT_LENGTHS)
+    parser.add_argument('-f', '--formats', help='Tractogram formats (default: %(default)s)', nargs='+',
+                        choices=DEFAULT_FORMATS, default=DEFAULT_FORMATS)
+    parser.add_argument('-r', '--repeats', help='Runs per stage, the best one is kept (default: %(default)s)',
+                        type=int, default=3)
+    parser.add_argument('-b', '--bins', help='Number of fiber portions of the profiles (default: %(default)s)',
+                        type=int, default=20)
+    parser.add_argument('-o', '--output', help='JSON file receiving the timings')
+    parser.add_argument('--compare', help='Baseline JSON file: report the stages slower than the baseline and exit '
+                                          'with status 1 if any')
+    parser.add_argument('--tolerance', help='Relative slowdown considered a regression (default: %(default)s)',
+                        type=float, default=TOLERANCE)
+    parser.add_argument('--min-seconds', help='Ignore the stages faster than this in both runs (default: '
+                                              '%(default)s)', type=float, default=MIN_SECONDS)
+    parser.add_argument('--data-dir', help='Folder of the synthetic data (kept, and reused when present)')
+    parser.add_argument('--keep', help='Keep the temporary synthetic data', action='store_true')
+
+    args = parser.parse_args()
+
+    return (args.sizes, args.lengths, args.formats, args.repeats, args.output, args.compare, args.tolerance,
+            args.min_seconds, args.data_dir, args.keep, args.bins)
+
+
+def best_time(func, repeats, prepare=None):
+    """
+    Best wall time of a function over several runs
+    :param func: function, called with the result of prepare (if given)
+    :param repeats: number of runs
+    :param prepare: untimed setup called before every run
+    :return: seconds, result of the last run
+    """
+    best, result = np.inf, None
+    for _ in range(repeats):
+        arg = prepare() if prepare is not None else None
+        t0 = perf_counter()
+        result = func(arg) if prepare is not None else func()
+        best = min(best, perf_counter() - t0)
+    return best, result
+
+
+def bench_case(folder, n_lines, length, formats, repeats, n_bins):
+    """
+    Time every stage on one synthetic tractogram
+    :return: list of result records
+    """
+    case = '{}x{}'.format(n_lines, length)
+    fnames = dataset(folder, n_lines, length, formats)
+    records = []
+
+    def record(stage, seconds, n_points):
+        records.append({'case': case, 'stage': stage, 'n_lines': n_lines, 'n_points': int(n_points),
+                        'seconds': seconds, 'lines_per_second': n_lines / seconds if seconds else None})
+        print('{:>16} {:<14} {:10.4f} s'.format(case, stage, seconds))
+
+    tracts = None
+    for fmt in formats:
+        seconds, tracts = best_time(lambda: tm.pipeline.load_tracts(fnames[fmt]), repeats)
+        record('load_' + fmt, seconds, tracts.tractogram.total_points)
+    sidecar = os.path.join(folder, 'sidecars')
+    if not os.path.isdir(sidecar):
+        os.makedirs(sidecar)
+    tm.pipeline.load_tracts(fnames[formats[0]], sidecar)
+    seconds, _ = best_time(lambda: tm.pipeline.load_tracts(fnames[formats[0]], sidecar), repeats)
+    record('load_sidecar', seconds, tracts.tractogram.total_points)
+
+    streamlines = tracts.tractogram
+    n_points = streamlines.total_points
+    maps = fnames['maps']
+    affine, shape = lg.nii_grid(maps['FA'])
+
+    def fresh():
+        return lg.Tracts(streamlines.copy())
+
+    seconds, _ = best_time(lambda t: t.sort(affine), repeats, fresh)
+    record('sort', seconds, n_points)
+
+    tracts = fresh()
+    tracts.sort(affine)
+    seconds, _ = best_time(lambda: lg.input_output.load_nii(maps['FA']), repeats)
+    record('load_nii', seconds, n_points)
+    volumes = [(name, lg.load_nii(maps[name])[0]) for name in ('FA', 'b-zero', 'MD')]
+
+    seconds, metrics = best_time(lambda m: m.geometric() or m, repeats, lambda: lg.Metrics(tracts, n_bins))
+    record('geometric', seconds, n_points)
+    seconds, _ = best_time(tracts.get_winding, repeats)
+    record('winding', seconds, n_points)
+
+    seconds, (values, _) = best_time(lambda: tracts.mapping_multi([v for _, v in volumes], affine), repeats)
+    record('mapping', seconds, n_points)
+    seconds, _ = best_time(lambda: mean_profile(tracts.tractogram, values[:, 0], n_bins), repeats)
+    record('profiles', seconds, n_points)
+
+    def diffusion(m):
+        m.set_affine(affine)
+        m.diffusion_maps(volumes)
+        return m
+    seconds, _ = best_time(diffusion, repeats, lambda: lg.Metrics(tracts, n_bins))
+    record('diffusion', seconds, n_points)
+
+    diffusion(metrics)
+    body, body_dict = metrics.get_str(), metrics.get_dict()
+    out = os.path.join(folder, 'report')
+    seconds, _ = best_time(lambda: tm.pipeline.save_txt(out + '.txt', body, 'benchmark'), repeats)
+    record('write_txt', seconds, n_points)
+    seconds, _ = best_time(lambda: tm.pipeline.save_csv(out + '.csv', body_dict), repeats)
+    record('write_csv', seconds, n_points)
+    seconds, _ = best_time(lambda: tm.pipeline.save_xlsx(out + '.xlsx', body_dict, 'benchmark'), repeats)
+    record('write_xlsx', seconds, n_points)
+    return records
+
+
+def dataset(folder, n_lines, length, formats):
+    """
+    Synthetic data of a case, generated once per data folder
+    """
+    case_folder = os.path.join(folder, '{}_{}'.format(n_lines, length))
+    fnames = {'maps': {name: os.path.join(case_folder, name.replace('-', '') + '.nii.gz')
+                       for name in ('FA', 'MD', 'b-zero')}}
+    for fmt in formats:
+        fnames[fmt] = os.path.join(case_folder, 'tracts_{}_{}.{}'.format(n_lines, length, fmt))
+    missing = [f for f in list(fnames['maps'].values()) + [fnames[fmt] for fmt in formats] if not os.path.isfile(f)]
+    if missing:
+        fnames = synthetic.make_dataset(case_folder, n_lines, length, formats)
+    return fnames
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+def compare(baseline, current, tolerance=TOLERANCE, min_seconds=MIN_SECONDS):
+    """
+    Print the stage timings next to the baseline ones and flag the regressions
+    :param baseline: baseline report
+    :param current: current report
+    :param tolerance: relative slowdown considered a regression
+    :param min_seconds: stages faster than this in both runs are never flagged
+    :return: list of (case, stage, baseline seconds, current seconds) regressions
+    """
+    reference = {(r['case'], r['stage']): r['seconds'] for r in baseline['results']}
+    regressions = []
+    print('\n{:>16} {:<14} {:>10} {:>10} {:>8}'.format('case', 'stage', 'baseline', 'current', 'ratio'))
+    for r in current['results']:
+        key = (r['case'], r['stage'])
+        if key not in reference:
+            continue
+        before, after = reference[key], r['seconds']
+        ratio = after / before if before else np.inf
+        flag = ratio > 1 + tolerance and max(before, after) >= min_seconds
+        if flag:
+            regressions.append((key[0], key[1], before, after))
+        print('{:>16} {:<14} {:10.4f} {:10.4f} {:8.2f}{}'.format(key[0], key[1], before, after, ratio,
+                                                                 '  REGRESSION' if flag else ''))
+    print('\n{} regression(s) (tolerance {:.0%})'.format(len(regressions), tolerance))
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic tractograms and scalar maps for the benchmarks: smooth random fibers inside a brain-sized volume, written in
+every supported format.
+"""
+
+import os.path
+import sys
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from processing_tm.logic_tm import Streamlines  # noqa: E402
+
+# number of points per fiber (min, max) of every fiber length preset
+FIBER_LENGTHS = {'short': (10, 30), 'medium': (50, 150), 'long': (300, 1000)}
+GRID_SHAPE = (96, 96, 60)
+VOXEL_SIZE = 2.
+
+
+def grid_affine(shape=GRID_SHAPE, voxel_size=VOXEL_SIZE):
+    """
+    RAS affine of the synthetic grid, centred on the origin
+    """
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.])
+    affine[:3, 3] = -voxel_size * (np.asarray(shape) - 1) / 2.
+    return affine
+
+
+def make_streamlines(n_lines, length='medium', step=1., seed=0, shape=GRID_SHAPE, voxel_size=VOXEL_SIZE):
+    """
+    Random smooth fibers: every fiber starts near the centre of the grid and follows a slowly turning direction
+    :param n_lines: number of fibers
+    :param length: fiber length preset (see FIBER_LENGTHS) or (min, max) number of points
+    :param step: distance between consecutive points (mm)
+    :param seed: random seed
+    :return: packed streamlines (float32, mm)
+    """
+    rng = np.random.default_rng(seed)
+    low, high = FIBER_LENGTHS[length] if isinstance(length, str) else length
+    lengths = rng.integers(low, high + 1, size=n_lines)
+    fibers = Streamlines(np.zeros((int(lengths.sum()), 3), dtype=np.float64), lengths)
+
+    directions = rng.normal(size=(n_lines, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    turns = rng.normal(scale=.08, size=(fibers.total_points, 3))
+    heading = np.repeat(directions, lengths, axis=0) + segment_cumsum(turns, fibers)
+    heading /= np.linalg.norm(heading, axis=1)[:, None]
+
+    extent = voxel_size * (np.asarray(shape) - 1) / 4.
+    starts = rng.uniform(-extent, extent, size=(n_lines, 3))
+    points = np.repeat(starts, lengths, axis=0) + step * (segment_cumsum(heading, fibers) - heading)
+    return Streamlines(points.astype(np.float32), lengths)
+
+
+def segment_cumsum(values, streamlines):
+    """
+    Cumulative sum restarting at the first point of every fiber
+    """
+    total = np.cumsum(values, axis=0)
+    before = np.zeros_like(values[:len(streamlines)])
+    starts = streamlines.offsets[1:]
+    before[1:] = total[starts - 1]
+    return total - np.repeat(before, streamlines.lengths, axis=0)
+
+
+def make_volumes(shape=GRID_SHAPE, seed=0):
+    """
+    Smooth FA-, MD- and b0-like maps
+    :return: dictionary name -> float32 volume
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, d) for d in shape], indexing='ij'), axis=-1)
+    radius = np.sqrt((grid ** 2).sum(axis=-1))
+    noise = rng.normal(scale=.02, size=shape)
+    fa = np.clip(.7 - .5 * radius + noise, 0, 1)
+    md = 7e-4 + 3e-4 * radius + 1e-5 * noise
+    b0 = 400. * (1.2 - radius) + 20. * noise
+    return {'FA': fa.astype(np.float32), 'MD': md.astype(np.float32), 'b-zero': b0.astype(np.float32)}
+
+
+def save_volumes(folder, volumes, affine):
+    """
+    Write the maps as .nii.gz files
+    :return: dictionary name -> filename
+    """
+    fnames = {}
+    for name, volume in volumes.items():
+        fnames[name] = os.path.join(folder, name.replace('-', '') + '.nii.gz')
+        nib.save(nib.Nifti1Image(volume, affine), fnames[name])
+    return fnames
+
+
+def save_vtk(fname, streamlines):
+    """
+    Write a legacy binary .vtk polyline file
+    """
+    import vtk
+    from vtk.util import numpy_support as ns
+
+    points = vtk.vtkPoints()
+    points.SetData(ns.numpy_to_vtk(np.ascontiguousarray(streamlines.data), deep=True))
+    offsets = np.append(streamlines.offsets, streamlines.total_points).astype(np.int64)
+    connectivity = np.arange(streamlines.total_points, dtype=np.int64)
+    cells = vtk.vtkCellArray()
+    if vtk.vtkVersion.GetVTKMajorVersion() < 9:
+        # legacy layout: [n, id_1, ..., id_n, n, ...]
+        sizes = offsets[:-1] + np.arange(len(streamlines.lengths))
+        ids = np.ones(streamlines.total_points + len(streamlines.lengths), dtype=bool)
+        ids[sizes] = False
+        legacy = np.empty(len(ids), dtype=np.int64)
+        legacy[sizes] = streamlines.lengths
+        legacy[ids] = connectivity
+        cells.SetCells(len(streamlines.lengths), ns.numpy_to_vtkIdTypeArray(legacy, deep=True))
+    else:
+        cells.SetData(ns.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                      ns.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(cells)
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(fname)
+    writer.SetFileTypeToBinary()
+    writer.SetInputData(polydata)
+    writer.Write()
+
+
+def save_nibabel(fname, streamlines, affine, shape):
+    """
+    Write a .tck or .trk file
+    """
+    from nibabel.streamlines import Tractogram
+
+    tractogram = Tractogram(list(streamlines), affine_to_rasmm=np.eye(4))
+    if fname.endswith('.trk'):
+        header = {'voxel_to_rasmm': affine, 'voxel_sizes': np.abs(np.diag(affine)[:3]), 'dimensions': shape}
+        nib.streamlines.save(tractogram, fname, header=header)
+    else:
+        nib.streamlines.save(tractogram, fname)
+
+
+def make_dataset(folder, n_lines, length='medium', formats=('vtk', 'tck', 'trk'), seed=0):
+    """
+    Write a synthetic tractogram in every requested format plus the scalar maps
+    :param folder: output folder
+    :param n_lines: number of fibers
+    :param length: fiber length preset
+    :param formats: tractogram formats
+    :param seed: random seed
+    :return: dictionary of filenames: format -> tractogram, 'maps' -> {name: filename}
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    affine = grid_affine()
+    streamlines = make_streamlines(n_lines, length, seed=seed)
+    fnames = {'maps': save_volumes(folder, make_volumes(seed=seed), affine)}
+    for fmt in formats:
+        fnames[fmt] = os.path.join(folder, 'tracts_{}_{}.{}'.format(n_lines, length, fmt))
+        if fmt == 'vtk':
+            save_vtk(fnames[fmt], streamlines)
+        else:
+            save_nibabel(fnames[fmt], streamlines, affine, GRID_SHAPE)
+    return fnames
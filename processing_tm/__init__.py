@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+__version__ = '1.0.0'
 
 from .pipeline import proc
+from .batch import batch
+from .cache import ResultCache, DataCache
+from .profiling import Profiler
+from .service import Service, ServiceClient
+from .progress import Progress, CancelToken, Cancelled
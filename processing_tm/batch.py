@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multi-subject batch mode: one manifest, a pool of worker processes and a single merged table.
+"""
+
+import os
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .cache import ResultCache, CACHE_BYTES
+from .logic_tm.metrics import select_metrics, SCALAR_METRICS
+from .pipeline import compute, CHUNK_POINTS
+from .service import ServiceClient
+
+MANIFEST_KEYS = {'subject': 'subject', 'bundle': 'bundle', 'tractogram': 'tractogram', 'tract': 'tractogram',
+                 'fa': 'fa', 'bzero': 'bzero', 'b-zero': 'bzero', 'b0': 'bzero', 'md': 'md'}
+ID_COLUMNS = ['Subject', 'Bundle', 'Status', 'Error']
+
+
+def read_manifest(fname):
+    """
+    Read a batch manifest: a CSV file (',', ';' or tab separated, with a header line) or a JSON list of objects.
+    Columns: subject, bundle, tractogram, fa, bzero, md; the map columns are optional and relative paths are
+    relative to the manifest
+    :param fname: manifest filename
+    :return: list of items (dictionaries)
+    """
+    if fname.endswith('.json'):
+        with open(fname) as handle:
+            entries = json.load(handle)
+        if isinstance(entries, dict):
+            entries = entries.get('items', [])
+    else:
+        with open(fname) as handle:
+            sample = handle.read(4096)
+            handle.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            entries = list(csv.DictReader(handle, dialect=dialect))
+
+    root = os.path.dirname(os.path.abspath(fname))
+    items = []
+    for position, entry in enumerate(entries):
+        item = {'subject': '', 'bundle': '', 'tractogram': None, 'fa': None, 'bzero': None, 'md': None}
+        for key, value in entry.items():
+            key = MANIFEST_KEYS.get(str(key).strip().lower())
+            if key is not None and value not in (None, ''):
+                item[key] = str(value).strip()
+        for key in ('tractogram', 'fa', 'bzero', 'md'):
+            if item[key] and not os.path.isabs(item[key]):
+                item[key] = os.path.join(root, item[key])
+        if not item['subject'] and not item['bundle']:
+            item['subject'] = str(position)
+        if not item['bundle'] and item['tractogram']:
+            item['bundle'] = os.path.basename(item['tractogram']).split('.')[0]
+        items.append(item)
+    return items
+
+
+def run_item(item, perc_resampling=None, n_bins=20, streaming=False, chunk_size=CHUNK_POINTS, cache_dir=None,
+             cache_bytes=CACHE_BYTES, sidecar=None, subsample=None, stratify=False, seed=None, n_bootstrap=0,
+             confidence=.95, metrics=None, service=None):
+    """
+    Compute the metrics of one manifest item, catching every error
+    :param item: manifest item
+    :param cache_dir: result cache folder (None to disable the cache)
+    :param cache_bytes: size of the result cache
+    :param sidecar: binary sidecar of the parsed tractograms (see pipeline.load_tracts)
+    :param subsample: number (int) or fraction (float) of streamlines to keep (see pipeline.compute_metrics)
+    :param metrics: metrics to compute (see pipeline.compute_metrics)
+    :param service: port of a running service.Service computing the item (None to compute in this process)
+    :return: (dictionary report, None) or (None, error message)
+    """
+    try:
+        if not item['tractogram']:
+            raise ValueError('No tractogram given')
+        if not item['fa'] and not item['bzero'] and not item['md'] and select_metrics(metrics) & set(SCALAR_METRICS):
+            raise ValueError('No scalar map given')
+        for key in ('tractogram', 'fa', 'bzero', 'md'):
+            if item[key] and not os.path.isfile(item[key]):
+                raise IOError('No such file: {}'.format(item[key]))
+        if service:
+            body_dict, _ = ServiceClient(service).compute(
+                item['tractogram'], item['fa'], item['bzero'], item['md'], perc_resampling, n_bins=n_bins,
+                streaming=streaming, chunk_size=chunk_size, sidecar=sidecar, subsample=subsample, stratify=stratify,
+                seed=seed, n_bootstrap=n_bootstrap, confidence=confidence, metrics=metrics)
+            return body_dict, None
+        cache = ResultCache(cache_dir, cache_bytes) if cache_dir else None
+        report, _ = compute(item['tractogram'], item['fa'], item['bzero'], item['md'], perc_resampling, n_bins=n_bins,
+                            streaming=streaming, chunk_size=chunk_size, cache=cache, sidecar=sidecar,
+                            subsample=subsample, stratify=stratify, seed=seed, n_bootstrap=n_bootstrap,
+                            confidence=confidence, metrics=metrics)
+        return report.to_dict(), None
+    except SystemExit:
+        return None, 'Empty or unreadable tractogram'
+    except Exception as e:
+        return None, '{}: {}'.format(e.__class__.__name__, e)
+
+
+def batch(manifest_filepath, table_filepath, workers=None, perc_resampling=None, n_bins=20, streaming=False,
+          chunk_size=CHUNK_POINTS, verbose=True, cache_dir=None, cache_bytes=CACHE_BYTES, sidecar=None, subsample=None,
+          stratify=False, seed=None, n_bootstrap=0, confidence=.95, metrics=None, service=None):
+    """
+    Process every item of a manifest in a pool of worker processes and write one merged table (one row per subject
+    and bundle, ';' separated). A failing item gets an error row and does not stop the others.
+    :param manifest_filepath: manifest filename (see read_manifest)
+    :param table_filepath: output CSV filename
+    :param workers: number of worker processes (default: number of CPUs)
+    :param verbose: print one line per processed item
+    :param cache_dir: result cache folder, shared by the workers (None to disable the cache): a restarted batch only
+    computes the items that did not complete
+    :param cache_bytes: size of the result cache
+    :param sidecar: binary sidecar of the parsed tractograms (see pipeline.load_tracts)
+    :param subsample: number (int) or fraction (float) of streamlines to keep; with a seed, every item gets the same
+    reproducible draw
+    :param service: port of a running service.Service computing the items, one at a time (None to use the pool)
+    :return: list of rows, in manifest order
+    """
+    items = read_manifest(manifest_filepath)
+    options = dict(perc_resampling=perc_resampling, n_bins=n_bins, streaming=streaming, chunk_size=chunk_size,
+                   cache_dir=cache_dir, cache_bytes=cache_bytes, sidecar=sidecar, subsample=subsample,
+                   stratify=stratify, seed=seed, n_bootstrap=n_bootstrap, confidence=confidence, metrics=metrics,
+                   service=service)
+
+    results = [None] * len(items)
+    if workers == 1 or service:
+        for position, item in enumerate(items):
+            results[position] = run_item(item, **options)
+            report_item(item, results[position], verbose)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_item, item, **options): position for position, item in enumerate(items)}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except Exception as e:
+                    results[position] = (None, 'Worker failure: {}: {}'.format(e.__class__.__name__, e))
+                report_item(items[position], results[position], verbose)
+
+    rows = []
+    for item, (body_dict, error) in zip(items, results):
+        row = {'Subject': item['subject'], 'Bundle': item['bundle'], 'Status': 'failed' if error else 'ok',
+               'Error': error or ''}
+        if body_dict:
+            row.update(body_dict)
+        rows.append(row)
+
+    save_table(table_filepath, rows)
+    return rows
+
+
+def report_item(item, result, verbose):
+    if verbose:
+        error = result[1]
+        print('{} {}: {}'.format(item['subject'], item['bundle'], 'failed ({})'.format(error) if error else 'ok'))
+
+
+def save_table(csv_filepath, rows):
+    """
+    Merged CSV table, the metric columns in order of first appearance
+    :param csv_filepath: output filename
+    :param rows: list of dictionaries
+    """
+    columns = list(ID_COLUMNS)
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    with open(csv_filepath, 'w') as handle:
+        w = csv.DictWriter(handle, columns, delimiter=';', restval='')
+        w.writeheader()
+        w.writerows(rows)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of the computed metrics, addressed by the content of the input files and the parameters.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+from .logic_tm.utils import file_digest
+
+CACHE_VERSION = 2
+CACHE_BYTES = 1 << 30
+DATA_CACHE_BYTES = 4 << 30
+ENTRY_SUFFIX = '.pkl'
+INDEX_NAME = 'file_hashes.json'
+
+
+def default_cache_dir():
+    """
+    Per-user cache folder ($XDG_CACHE_HOME/tractography_metrics, ~/.cache/tractography_metrics by default)
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'tractography_metrics')
+
+
+def atomic_write(fname, data, mode='wb'):
+    """
+    Write a file through a temporary file and a rename, so that concurrent readers never see a partial file
+    """
+    folder = os.path.dirname(fname)
+    handle, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(handle, mode) as f:
+            f.write(data)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ResultCache:
+    """
+    Content-addressed store of (report, profiles) results with least recently used eviction.
+
+    The key of a result is the SHA-256 of the input file contents and of the parameters. File digests are memoized
+    by path, size and modification time, so a warm lookup only stats the inputs and reads one entry.
+    """
+
+    def __init__(self, directory=None, max_bytes=CACHE_BYTES):
+        """
+        Object creation operations
+        :param directory: cache folder (default: default_cache_dir())
+        :param max_bytes: total size of the stored entries above which the least recently used ones are removed
+        """
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._index = None
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.directory, self.max_bytes)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as handle:
+                    self._index = json.load(handle)
+            except (IOError, OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def file_hash(self, fname):
+        """
+        Content digest of an input file, memoized by path, size and modification time
+        :param fname: filename
+        :return: hexadecimal digest
+        """
+        path = os.path.realpath(fname)
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = self.index.get(path)
+        if entry is not None and entry[:2] == signature:
+            return entry[2]
+        digest = file_digest(path)
+        self.index[path] = signature + [digest]
+        atomic_write(self.index_path, json.dumps(self.index), 'w')
+        return digest
+
+    def key(self, filepaths, params):
+        """
+        Cache key of a computation
+        :param filepaths: input filenames (None for missing optional inputs)
+        :param params: dictionary of the parameters changing the result
+        :return: hexadecimal key
+        """
+        description = {'version': CACHE_VERSION,
+                       'files': [self.file_hash(f) if f else None for f in filepaths],
+                       'params': params}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        Stored result, marked as recently used
+        :param key: cache key
+        :return: result, or None on a miss
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as handle:
+                result = pickle.load(handle)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result, then evict the least recently used entries beyond max_bytes
+        :param key: cache key
+        :param result: picklable result
+        """
+        atomic_write(self.entry_path(key), pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX) or name == INDEX_NAME:
+                os.remove(os.path.join(self.directory, name))
+        self._index = None
+
+
+class DataCache:
+    """
+    In-memory store of parsed inputs (tractograms, volumes) with least recently used eviction, for a resident process
+    (see service.Service). Entries are addressed by the content of the files, so that inputs written again with the
+    same content (e.g. exported by Slicer at every run) are not parsed again.
+    """
+
+    def __init__(self, max_bytes=DATA_CACHE_BYTES):
+        """
+        Object creation operations
+        :param max_bytes: total size of the stored entries above which the least recently used ones are dropped
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.signatures = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "{}({} entries, {} bytes)".format(self.__class__.__name__, len(self.entries), self.n_bytes())
+
+    def n_bytes(self):
+        return sum(n_bytes for _, n_bytes in self.entries.values())
+
+    def file_hash(self, fname):
+        """
+        Content digest of a file, memoized by path, size and modification time
+        """
+        path = os.path.realpath(fname)
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self.signatures.get(path, (None,))[:2] != signature:
+            self.signatures[path] = signature + (file_digest(path),)
+        return self.signatures[path][2]
+
+    def get(self, kind, fname, load):
+        """
+        Stored entry, loaded on a miss
+        :param kind: kind of entry (e.g. 'tracts', 'nii'), so that one file can be stored in several forms
+        :param fname: input filename
+        :param load: function returning (value, size in bytes)
+        :return: value
+        """
+        key = (kind, self.file_hash(fname))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        self.entries[key] = load()
+        self.evict()
+        return self.entries[key][0]
+
+    def evict(self):
+        total = self.n_bytes()
+        while len(self.entries) > 1 and total > self.max_bytes:
+            _, (_, n_bytes) = self.entries.popitem(last=False)
+            total -= n_bytes
+
+    def clear(self):
+        self.entries.clear()
+        self.signatures.clear()
+
+    def status(self):
+        return {'entries': len(self.entries), 'bytes': self.n_bytes(), 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .input_output import read_tck, read_trk, read_vtk, load_nii
-from .tractogram import Tracts
-from .metrics import Metrics
+from .input_output import read_tck, iter_tck, read_trk, read_vtk, load_nii, nii_grid, crop_bounds, read_sidecar, \
+    write_sidecar
+from .streamlines import Streamlines
+from .tractogram import Tracts, TractStream
+from .metrics import Metrics, StreamingMetrics, select_metrics
+from .parallel import ChunkPool
+from .fiber_table import FiberTable, read_fiber_table
+from .scheduler import Intermediate, Scheduler
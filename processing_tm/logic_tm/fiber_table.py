@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-fiber table: one row per streamline (geometry, winding, mean/min/max of every mapped scalar), written chunk by
+chunk to a columnar binary file, .npz or Parquet/Feather when pyarrow is available.
+"""
+
+import os
+import shutil
+import importlib.util
+import tempfile
+import weakref
+import zipfile
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+from .utils import LazyModule
+
+pyarrow = LazyModule('pyarrow', 'to write Parquet and Feather files')
+ipc = LazyModule('pyarrow.ipc', 'to write Feather files')
+parquet = LazyModule('pyarrow.parquet', 'to write Parquet files')
+
+TABLE_FORMATS = {'.npz': 'npz', '.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather'}
+ROWS_PER_BATCH = 1 << 18
+AXES = ('x', 'y', 'z')
+
+
+def table_format(filename):
+    """
+    Format of a per-fiber table, from its extension
+    :param filename: table filename (.npz, .parquet/.pq, .feather/.arrow)
+    :return: 'npz', 'parquet' or 'feather'
+    """
+    fmt = TABLE_FORMATS.get(os.path.splitext(filename)[1].lower())
+    if fmt is None:
+        raise ValueError('Unsupported fiber table extension (supported: {}): {}'.format(
+            ', '.join(sorted(TABLE_FORMATS)), filename))
+    if fmt != 'npz' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError('pyarrow is required to write {} files: {}'.format(fmt, filename))
+    return fmt
+
+
+def read_fiber_table(filename):
+    """
+    Read back a per-fiber table
+    :param filename: table filename
+    :return: dictionary column name -> (n_fibers,) array
+    """
+    fmt = table_format(filename)
+    if fmt == 'npz':
+        with np.load(filename) as table:
+            return {name: table[name] for name in table.files}
+    if fmt == 'parquet':
+        table = parquet.read_table(filename)
+    else:
+        with pyarrow.memory_map(filename) as source:
+            table = ipc.open_file(source).read_all()
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+class FiberTable:
+    """
+    Columns of the per-fiber table. The geometric and diffusion passes fill the columns separately, chunk by chunk and
+    in fiber order: every chunk is appended to a raw temporary file, so memory stays bounded, and save() writes the
+    final file in batches of rows. The temporary files are removed by save(), close(), or when the table is garbage
+    collected.
+    """
+
+    def __init__(self, filename, rows_per_batch=ROWS_PER_BATCH):
+        """
+        Object creation operations
+        :param filename: output filename, its extension gives the format (see table_format)
+        :param rows_per_batch: number of rows written at once (row group size of the Parquet/Feather files)
+        """
+        self.filename = filename
+        self.fmt = table_format(filename)
+        self.rows_per_batch = rows_per_batch
+        self.columns = dict()
+        self.scalar_columns = set()
+        self._folder = None
+        self._cleanup = None
+
+    def __repr__(self):
+        return "{}({}, {} columns)".format(self.__class__.__name__, self.filename, len(self.columns))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def column_path(self, name):
+        return os.path.join(self._folder, '{}.bin'.format(list(self.columns).index(name)))
+
+    def append(self, name, values):
+        """
+        Append the values of a chunk of fibers to a column; (n, 3) values give the name_x, name_y, name_z columns
+        :param name: column name
+        :param values: (n,) or (n, k) array
+        """
+        values = np.asarray(values)
+        if values.ndim > 1:
+            labels = AXES if values.shape[1] == len(AXES) else range(values.shape[1])
+            for label, column in zip(labels, values.T):
+                self.append('{}_{}'.format(name, label), column)
+            return
+
+        if self._folder is None:
+            self._folder = tempfile.mkdtemp(prefix='.fibers_', dir=os.path.dirname(os.path.abspath(self.filename)))
+            self._cleanup = weakref.finalize(self, shutil.rmtree, self._folder, True)
+        if name not in self.columns:
+            self.columns[name] = [values.dtype, 0]
+        dtype = self.columns[name][0]
+        with open(self.column_path(name), 'ab') as handle:
+            handle.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        self.columns[name][1] += len(values)
+
+    def add_geometric(self, features, windings=None, ids=None):
+        """
+        Append the geometric columns of a chunk of fibers (only the computed ones)
+        :param features: per-fiber geometric features (see geometry.geometric_features), at least the number of points
+        :param windings: per-fiber winding angles (None when not computed)
+        :param ids: index of every fiber in the input tractogram, written as the fiber column (None: row numbers)
+        """
+        if ids is not None:
+            self.append('fiber', np.asarray(ids, dtype=np.int64))
+        self.append('n_points', np.asarray(features['n_points'], dtype=np.int64))
+        if 'lengths' in features:
+            extremities = np.asarray(features['extremities'])
+            self.append('length', np.asarray(features['lengths'], dtype=np.float64))
+            self.append('shortest_length', np.asarray(features['shortest'], dtype=np.float64))
+        if windings is not None:
+            self.append('winding', np.asarray(windings, dtype=np.float64))
+        if 'lengths' in features:
+            self.append('midpoint', np.asarray(features['midpoints'], dtype=np.float64))
+            self.append('start', extremities[:, 0, :])
+            self.append('end', extremities[:, -1, :])
+
+    def add_scalar(self, scalar_name, means, amin, amax):
+        """
+        Append the columns of a mapped scalar for a chunk of fibers
+        :param scalar_name: name of the scalar map
+        :param means: per-fiber mean values
+        :param amin: per-fiber minimum values
+        :param amax: per-fiber maximum values
+        """
+        for suffix, values in (('_mean', means), ('_min', amin), ('_max', amax)):
+            self.append(scalar_name + suffix, np.asarray(values, dtype=np.float64))
+            self.scalar_columns.add(scalar_name + suffix)
+
+    def column_names(self):
+        """
+        Column names in output order: geometric columns first, then the scalar ones, each in order of first appearance
+        """
+        return sorted(self.columns, key=lambda name: name in self.scalar_columns)
+
+    def n_rows(self):
+        counts = set(n for _, n in self.columns.values())
+        if len(counts) > 1:
+            raise ValueError('Fiber table columns of different lengths: {}'.format(
+                {name: n for name, (_, n) in self.columns.items()}))
+        return counts.pop() if counts else 0
+
+    def column(self, name):
+        """
+        Values of a column, memory-mapped from its temporary file
+        """
+        dtype, n = self.columns[name]
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.column_path(name), dtype=dtype, mode='r', shape=(n,))
+
+    def batches(self):
+        """
+        Iterate over the rows by batches, the fiber index column first (row numbers when the ids were not given)
+        :return: generator of dictionaries column name -> array
+        """
+        n_rows = self.n_rows()
+        columns = dict((name, self.column(name)) for name in self.column_names())
+        for start in range(0, max(n_rows, 1), self.rows_per_batch):
+            stop = min(start + self.rows_per_batch, n_rows)
+            batch = {} if 'fiber' in columns else {'fiber': np.arange(start, stop, dtype=np.int64)}
+            batch.update((name, np.asarray(values[start:stop])) for name, values in columns.items())
+            yield batch
+
+    def save(self):
+        """
+        Write the table, through a temporary file renamed into place
+        """
+        n_rows = self.n_rows()
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        handle, tmp = tempfile.mkstemp(dir=folder, prefix='.fibers_', suffix='.tmp')
+        os.close(handle)
+        try:
+            if self.fmt == 'npz':
+                self.save_npz(tmp, n_rows)
+            else:
+                self.save_arrow(tmp)
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            self.close()
+
+    def save_npz(self, fname, n_rows):
+        """
+        Uncompressed .npz archive (np.load), every column copied from its temporary file without loading it
+        """
+        with zipfile.ZipFile(fname, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            if 'fiber' not in self.columns:
+                with archive.open('fiber.npy', 'w', force_zip64=True) as member:
+                    npy_format.write_array(member, np.arange(n_rows, dtype=np.int64))
+            for name in self.column_names():
+                dtype = self.columns[name][0]
+                with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+                    npy_format.write_array_header_1_0(member, {'descr': npy_format.dtype_to_descr(dtype),
+                                                               'fortran_order': False, 'shape': (n_rows,)})
+                    with open(self.column_path(name), 'rb') as source:
+                        shutil.copyfileobj(source, member)
+
+    def save_arrow(self, fname):
+        """
+        Parquet file (one row group per batch) or Feather v2 / Arrow IPC file (one record batch per batch)
+        """
+        writer = None
+        try:
+            for batch in self.batches():
+                record_batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(v) for v in batch.values()],
+                                                               names=list(batch))
+                if writer is None:
+                    if self.fmt == 'parquet':
+                        writer = parquet.ParquetWriter(fname, record_batch.schema)
+                    else:
+                        writer = ipc.new_file(fname, record_batch.schema)
+                if self.fmt == 'parquet':
+                    writer.write_table(pyarrow.Table.from_batches([record_batch]))
+                else:
+                    writer.write_batch(record_batch)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def close(self):
+        """
+        Remove the temporary column files
+        """
+        if self._cleanup is not None:
+            self._cleanup()
+            self._folder = None
+            self._cleanup = None
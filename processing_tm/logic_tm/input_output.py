@@ -5,47 +5,122 @@
 Utilities for the I/O relative to fiber bundles and medical images.
 """
 
-import nibabel as nib
 import numpy as np
 import os.path
+import json
+import pickle
+import shutil
+import tempfile
 
-try:
-    import vtk
-except ImportError:
-    pass
 from six import iteritems
 
-from vtk.util import numpy_support as ns
-from nibabel.streamlines.trk import TrkFile as Trk
+from .streamlines import Streamlines, as_streamlines
+from .utils import file_digest, LazyModule
 
+nib = LazyModule('nibabel', 'to read NIfTI images')
+trk = LazyModule('nibabel.streamlines.trk', 'to read .trk tractograms')
+vtk = LazyModule('vtk', 'to read .vtk/.vtp tractograms')
+ns = LazyModule('vtk.util.numpy_support', 'to read .vtk/.vtp tractograms')
 
-def load_nii(fname):
+TCK_CHUNK_POINTS = 1 << 20
+SIDECAR_SUFFIX = '.sidecar'
+SIDECAR_VERSION = 1
+LEGACY_CELL_PASSES = 8
+LEGACY_CELL_BLOCK = 1 << 16
+
+
+def load_nii(fname, bbox=None, dtype=np.float32, with_range=False, slab=16):
+    """
+    NIfTI images loading. Only the voxels inside the bounding box are read from the image proxy, a few slices at a
+    time, so that no full-volume array is ever allocated.
+    :param fname: filename
+    :param bbox: (lower, upper) voxel bounds of the region to keep (upper excluded), None for the whole image
+    :param dtype: output data type
+    :param with_range: also return the intensity range of the whole image, computed during the same pass
+    :param slab: number of slices along the third axis read at once
+    :return: data array, affine matrix (of the cropped grid when bbox is given)[, (min, max)]
+    """
+    img = nib.load(fname, keep_file_open=True)
+    if bbox is None and not with_range:
+        return img.get_fdata(dtype=dtype), img.affine
+
+    shape = img.shape
+    lower, upper = bbox if bbox is not None else ((0, 0, 0), shape[:3])
+    lower = [int(v) for v in lower]
+    upper = [int(v) for v in upper]
+    data = np.empty(tuple(hi - lo for lo, hi in zip(lower, upper)) + tuple(shape[3:]), dtype=dtype, order='F')
+
+    lo, hi = np.inf, -np.inf
+    if with_range:
+        # the range is the one of the whole image: every slab is read in full
+        for k in range(0, shape[2], slab):
+            block = np.asarray(img.dataobj[:, :, k:min(k + slab, shape[2])])
+            lo, hi = min(lo, block.min()), max(hi, block.max())
+            k0, k1 = max(k, lower[2]), min(k + slab, upper[2])
+            if k0 < k1:
+                data[:, :, k0 - lower[2]:k1 - lower[2]] = \
+                    block[lower[0]:upper[0], lower[1]:upper[1], k0 - k:k1 - k]
+    else:
+        # only the bounding box is read from the proxy
+        for k in range(lower[2], upper[2], slab):
+            k1 = min(k + slab, upper[2])
+            data[:, :, k - lower[2]:k1 - lower[2]] = img.dataobj[lower[0]:upper[0], lower[1]:upper[1], k:k1]
+
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3].dot(np.asarray(lower, dtype=np.float64)) + img.affine[:3, 3]
+    if with_range:
+        return data, affine, (float(lo), float(hi))
+    return data, affine
+
+
+def nii_grid(fname):
     """
-    NIfTI images loading
+    Voxel grid of a NIfTI image, read from the header only
     :param fname: filename
-    :return: data array, affine matrix
+    :return: affine matrix, spatial shape
     """
     img = nib.load(fname)
-    return img.get_fdata(), img.affine
+    return img.affine, img.shape[:3]
 
 
-def read_tck(filename):
+def crop_bounds(points_bounds, shape, margin=1):
+    """
+    Region of an image needed to interpolate at a set of points
+    :param points_bounds: (min, max) voxel coordinates of the points
+    :param shape: spatial shape of the image
+    :param margin: voxels added around the points (at least 1 for trilinear interpolation)
+    :return: lower, upper voxel bounds (upper excluded)
+    """
+    lower = np.clip(np.floor(points_bounds[0]).astype(np.int64) - margin + 1, 0, shape)
+    upper = np.clip(np.floor(points_bounds[1]).astype(np.int64) + margin + 1, 0, shape)
+    return lower, np.maximum(upper, lower)
+
+
+def read_tck(filename, chunk_points=TCK_CHUNK_POINTS):
     """
     MRTrix3 tractogram loading
     :param filename: filename
+    :param chunk_points: number of vertices scanned at once
     :return: tractogram, header
     """
 
     header = read_mrtrix_header(filename)
-
-    vertices, line_starts, line_ends = read_mrtrix_streamlines(filename, header)
-    streamlines = []
-    for s, e in zip(line_starts, line_ends):
-        streamlines.append(vertices[s:e, :])
+    streamlines = Streamlines.concatenate(iter_mrtrix_streamlines(filename, header, chunk_points))
 
     return streamlines, header
 
 
+def iter_tck(filename, chunk_points=TCK_CHUNK_POINTS):
+    """
+    MRTrix3 tractogram streaming: the file is memory-mapped and read a fixed number of vertices at a time, so the
+    memory used does not depend on the file size
+    :param filename: filename
+    :param chunk_points: number of vertices scanned at once
+    :return: generator of packed streamlines (the complete fibers of every chunk)
+    """
+    return iter_mrtrix_streamlines(filename, read_mrtrix_header(filename), chunk_points)
+
+
 def read_mrtrix_header(in_file):
     fileobj = open(in_file, "rb")
     header = {}
@@ -68,9 +143,14 @@ def read_mrtrix_header(in_file):
     return header
 
 
-def read_mrtrix_streamlines(in_file, header):
+def mrtrix_memmap(in_file, header):
+    """
+    Memory-mapped view of the vertices of a .tck file
+    :param in_file: filename
+    :param header: MRTrix3 header
+    :return: (n_vertices, 3) memmap (delimiters included), None if the data type is not supported
+    """
     byte_offset = header["offset"]
-    stream_count = header["count"]
     datatype = header["datatype"]
     dt = 4
     if datatype.startswith( 'Float64' ):
@@ -85,24 +165,55 @@ def read_mrtrix_streamlines(in_file, header):
         dt = '<'+dt
     if datatype.endswith( 'BE' ):
         dt = '>'+dt
-    vtx = np.fromfile(in_file, dtype=dt, count=(num_triplets*3), offset=byte_offset)
-    vtx = np.reshape(vtx, (-1,3))
+    if num_triplets == 0:
+        return np.zeros((0, 3), dtype=dt)
+    return np.memmap(in_file, dtype=dt, mode='r', offset=byte_offset, shape=(num_triplets, 3))
+
+
+def iter_mrtrix_streamlines(in_file, header, chunk_points=TCK_CHUNK_POINTS):
+    """
+    Chunked scan of the vertices of a .tck file. Streamlines are separated by NaN triplets and the data ends with
+    an Inf triplet (or with the end of the file); fibers crossing a chunk boundary are carried over to the next chunk.
+    :param in_file: filename
+    :param header: MRTrix3 header
+    :param chunk_points: number of vertices scanned at once
+    :return: generator of packed streamlines
+    """
+    vtx = mrtrix_memmap(in_file, header)
+    if vtx is None:
+        return
+    found = 0
+    carry = []
+    for start in range(0, len(vtx), chunk_points):
+        block = np.array(vtx[start:start + chunk_points], dtype=vtx.dtype.newbyteorder('='))
+        end_of_data = np.flatnonzero(np.isinf(block).all(axis=1))
+        if len(end_of_data):
+            block = block[:end_of_data[0]]
+
+        delimiters = np.flatnonzero(np.isnan(block).all(axis=1))
+        if len(delimiters):
+            lengths = np.diff(np.concatenate(([-1], delimiters))) - 1
+            lengths[0] += sum(len(c) for c in carry)
+            points = np.delete(block[:delimiters[-1]], delimiters[:-1], axis=0)
+            data = np.concatenate(carry + [points]) if carry else points
+            carry = [block[delimiters[-1] + 1:]]
+            keep = lengths > 0
+            found += int(keep.sum())
+            yield Streamlines(data, lengths) if keep.all() else Streamlines(data, lengths[keep])
+        else:
+            carry.append(block)
+
+        if len(end_of_data):
+            break
+
     #make sure last streamline delimited...
-    if not np.isnan(vtx[-2,1]):
-        vtx[-1,:] = np.nan
-    line_ends, = np.where(np.all(np.isnan(vtx), axis=1))
-    if stream_count != line_ends.size:
-        print('expected {} streamlines, found {}'.format(stream_count, line_ends.size))
-    line_starts = line_ends + 0
-    line_starts[1:line_ends.size] = line_ends[0:line_ends.size-1]
-    #the first line starts with the first vertex (index 0), so preceding NaN at -1
-    line_starts[0] = -1
-    #first vertex of line is the one after a NaN
-    line_starts = line_starts + 1
-    #last vertex of line is the one before NaN
-    line_ends = line_ends - 1
-
-    return vtx, line_starts, line_ends
+    if sum(len(c) for c in carry):
+        data = np.concatenate(carry)
+        found += 1
+        yield Streamlines(data, [len(data)])
+
+    if header["count"] != found:
+        print('expected {} streamlines, found {}'.format(header["count"], found))
 
 
 def read_trk(filename):
@@ -111,8 +222,8 @@ def read_trk(filename):
     :param filename: filename
     :return: tractogram, header
     """
-    trk_object = Trk.load(filename)
-    streamlines = trk_object.streamlines
+    trk_object = trk.TrkFile.load(filename)
+    streamlines = as_streamlines(trk_object.streamlines)
     header = trk_object.header
 
     return streamlines, header
@@ -143,8 +254,14 @@ def vtkpolydata_to_tracts(polydata):
     :param polydata: vtk file polydata
     :return: tractogram, associated data
     """
-    result = {'lines': ns.vtk_to_numpy(polydata.GetLines().GetData()),
-              'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    cells = polydata.GetLines()
+    result = {'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    if hasattr(cells, 'GetOffsetsArray'):
+        # VTK >= 9: offsets/connectivity layout, no legacy array export
+        result['offsets'] = ns.vtk_to_numpy(cells.GetOffsetsArray())
+        result['connectivity'] = ns.vtk_to_numpy(cells.GetConnectivityArray())
+    else:
+        result['lines'] = ns.vtk_to_numpy(cells.GetData())
 
     data = {}
     if polydata.GetPointData().GetScalars():
@@ -167,40 +284,209 @@ def vtkpolydata_to_tracts(polydata):
     return tracts, data
 
 
+def legacy_cells_to_connectivity(lines, number_of_lines):
+    """
+    Split a legacy VTK cell array ([n, id_1, ..., id_n, n, ...]) in offsets and connectivity
+    :param lines: legacy cell array
+    :param number_of_lines: number of cells
+    :return: (number_of_lines + 1,) offsets, connectivity
+    """
+    lines = np.asarray(lines).ravel()
+    positions = legacy_cell_positions(lines, number_of_lines)
+    if positions is None:
+        positions = walk_legacy_cells(lines, number_of_lines)
+
+    counts = lines[positions].astype(np.int64)
+    offsets = np.zeros(number_of_lines + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    is_id = np.ones(len(lines), dtype=bool)
+    is_id[positions] = False
+    if number_of_lines:
+        is_id[positions[-1] + counts[-1] + 1:] = False
+    return offsets, lines[is_id]
+
+
+def legacy_cell_positions(lines, number_of_lines, max_passes=LEGACY_CELL_PASSES):
+    """
+    Positions of the cell sizes of a legacy cell array, in a few vectorized passes. Every position where the ids on
+    both sides are consecutive is a candidate: the sizes are all candidates when the point ids follow the storage
+    order (the layout written by VTK and by the tractography tools). Candidates whose next cell (position + size + 1)
+    is not a candidate, or which are not the next cell of a candidate, are dropped until none is; what remains is the
+    chain of cells starting at 0.
+    :param lines: legacy cell array
+    :param number_of_lines: number of cells
+    :param max_passes: maximum number of passes
+    :return: (number_of_lines,) positions, None when the chain is not found (see walk_legacy_cells)
+    """
+    n = len(lines)
+    if number_of_lines == 0 or n < 2:
+        return None
+    # block by block, the temporaries staying in cache
+    candidates = [[0]]
+    shifted = np.empty(min(LEGACY_CELL_BLOCK, n), dtype=lines.dtype)
+    for start in range(0, n - 2, LEGACY_CELL_BLOCK):
+        stop = min(start + LEGACY_CELL_BLOCK, n - 2)
+        np.add(lines[start:stop], 1, out=shifted[:stop - start])
+        candidates.append(np.flatnonzero(lines[start + 2:stop + 2] == shifted[:stop - start]) + start + 1)
+    if lines[n - 1] == 0:
+        candidates.append([n - 1])
+    positions = np.concatenate(candidates).astype(np.int64)
+
+    for _ in range(max_passes):
+        if len(positions) == 0 or positions[0] != 0:
+            return None
+        successors = positions + lines[positions] + 1
+        # the positions are sorted: membership by binary search
+        index = np.minimum(np.searchsorted(positions, successors), len(positions) - 1)
+        found = positions[index] == successors
+        reached = np.zeros(len(positions), dtype=bool)
+        reached[0] = True
+        reached[index[found]] = True
+        keep = (successors > positions) & (found | (successors == n)) & reached
+        if keep.all():
+            if len(positions) == number_of_lines and successors[-1] == n:
+                return positions
+            return None
+        positions = positions[keep]
+    return None
+
+
+def walk_legacy_cells(lines, number_of_lines):
+    """
+    Positions of the cell sizes of a legacy cell array, cell after cell
+    """
+    positions = np.zeros(number_of_lines, dtype=np.int64)
+    position = 0
+    for i in range(number_of_lines):
+        positions[i] = position
+        position += int(lines[position]) + 1
+    return positions
+
+
 def vtkpolydata_dictionary_to_tracts_and_data(dictionary):
     """
-    VTK polydata management
+    VTK polydata management. Accepts both the legacy cell array ('lines') and the VTK 9 'offsets'/'connectivity'
+    layout. When the points are stored fiber after fiber, the tractogram and its point data are views of the input
+    buffers; otherwise they are gathered with a single indexing pass.
     :param dictionary: polydata dictionary
-    :return: tractogram, associated data
+    :return: packed tractogram, associated data (packed per-point arrays)
     """
-    dictionary_keys = {'lines', 'points', 'numberOfLines'}
-    if not dictionary_keys.issubset(dictionary):
-        raise ValueError("Dictionary must have the keys lines and points" + repr(dictionary))
+    if not {'points', 'numberOfLines'}.issubset(dictionary) or \
+            not ('lines' in dictionary or {'offsets', 'connectivity'}.issubset(dictionary)):
+        raise ValueError("Dictionary must have the keys lines (or offsets and connectivity) and points" +
+                         repr(dictionary))
+
+    points = np.asarray(dictionary['points'])
+    if 'offsets' in dictionary and 'connectivity' in dictionary:
+        offsets = np.asarray(dictionary['offsets'], dtype=np.int64).ravel()
+        connectivity = np.asarray(dictionary['connectivity']).ravel()
+    else:
+        offsets, connectivity = legacy_cells_to_connectivity(dictionary['lines'], dictionary['numberOfLines'])
+    connectivity = connectivity[offsets[0]:offsets[-1]]
+    lengths = np.diff(offsets)
 
-    tract_data = {}
-    tracts = []
+    in_order = len(connectivity) == len(points) and (
+        len(connectivity) == 0 or (connectivity[0] == 0 and np.all(np.diff(connectivity) == 1)))
 
-    lines = np.asarray(dictionary['lines']).squeeze()
-    points = dictionary['points']
+    def gather(array):
+        return array if in_order else array[connectivity]
 
-    actual_line_index = 0
-    number_of_tracts = dictionary['numberOfLines']
-    original_lines = []
-    for _ in range(number_of_tracts):
-        tracts.append(points[lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1]])
-        original_lines.append(
-            np.array(lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1], copy=True))
-        actual_line_index += lines[actual_line_index] + 1
+    tracts = Streamlines(gather(points), lengths)
 
+    tract_data = {}
     if 'pointData' in dictionary:
-        point_data_keys = [it[0] for it in iteritems(dictionary['pointData']) if isinstance(it[1], np.ndarray)]
-
-        for k in point_data_keys:
-            array_data = dictionary['pointData'][k]
-            if k not in tract_data:
-                tract_data[k] = [array_data[f] for f in original_lines]
-            else:
-                np.vstack(tract_data[k])
-                tract_data[k].extend([array_data[f] for f in original_lines[-number_of_tracts:]])
+        for k, array_data in iteritems(dictionary['pointData']):
+            if isinstance(array_data, np.ndarray):
+                tract_data[k] = Streamlines(gather(array_data), lengths)
 
     return tracts, tract_data
+
+
+def sidecar_path(filename, folder=None):
+    """
+    Location of the binary sidecar of a tractogram
+    :param filename: tractogram filename
+    :param folder: folder holding the sidecars (default: next to the tractogram)
+    :return: sidecar folder name
+    """
+    filename = os.path.abspath(filename)
+    if folder is None:
+        return filename + SIDECAR_SUFFIX
+    return os.path.join(folder, os.path.basename(filename) + SIDECAR_SUFFIX)
+
+
+def write_sidecar(filename, streamlines, header=None, point_data=None, folder=None):
+    """
+    Store a parsed tractogram as raw .npy arrays (points, offsets, point data) plus the size, modification time and
+    SHA-256 of the source file. The folder is written aside and renamed, so a partial sidecar is never read.
+    :param filename: tractogram filename
+    :param streamlines: packed streamlines
+    :param header: tractogram header (pickled)
+    :param point_data: dictionary of packed per-point arrays
+    :param folder: folder holding the sidecars (default: next to the tractogram)
+    :return: sidecar folder name
+    """
+    path = sidecar_path(filename, folder)
+    stat = os.stat(filename)
+    meta = {'version': SIDECAR_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_digest(filename), 'point_data': []}
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    umask = os.umask(0)
+    os.umask(umask)
+    try:
+        os.chmod(tmp, 0o777 & ~umask)
+        np.save(os.path.join(tmp, 'points.npy'), np.ascontiguousarray(streamlines.data))
+        np.save(os.path.join(tmp, 'offsets.npy'), np.append(streamlines.offsets, streamlines.total_points))
+        for i, (name, values) in enumerate(sorted(iteritems(point_data or {}))):
+            np.save(os.path.join(tmp, 'point_data_{}.npy'.format(i)), np.ascontiguousarray(as_streamlines(values).data))
+            meta['point_data'].append(name)
+        with open(os.path.join(tmp, 'header.pkl'), 'wb') as handle:
+            pickle.dump(header, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as handle:
+            json.dump(meta, handle)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+
+def read_sidecar(filename, folder=None):
+    """
+    Memory-mapped tractogram from its binary sidecar. The sidecar is used when the source file has the recorded size
+    and, if its modification time changed, the recorded SHA-256.
+    :param filename: tractogram filename
+    :param folder: folder holding the sidecars (default: next to the tractogram)
+    :return: packed streamlines (read-only memmap), header, point data; None when there is no valid sidecar
+    """
+    path = sidecar_path(filename, folder)
+    try:
+        with open(os.path.join(path, 'meta.json')) as handle:
+            meta = json.load(handle)
+        stat = os.stat(filename)
+        if meta['version'] != SIDECAR_VERSION or meta['size'] != stat.st_size:
+            return None
+        if meta['mtime_ns'] != stat.st_mtime_ns:
+            if file_digest(filename) != meta['sha256']:
+                return None
+            meta['mtime_ns'] = stat.st_mtime_ns
+            try:
+                with open(os.path.join(path, 'meta.json'), 'w') as handle:
+                    json.dump(meta, handle)
+            except (IOError, OSError):
+                pass
+
+        offsets = np.load(os.path.join(path, 'offsets.npy'))
+        lengths = np.diff(offsets)
+        streamlines = Streamlines(np.load(os.path.join(path, 'points.npy'), mmap_mode='r'), lengths)
+        point_data = {name: Streamlines(np.load(os.path.join(path, 'point_data_{}.npy'.format(i)), mmap_mode='r'),
+                                        lengths)
+                      for i, name in enumerate(meta['point_data'])}
+        with open(os.path.join(path, 'header.pkl'), 'rb') as handle:
+            header = pickle.load(handle)
+    except (IOError, OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        return None
+    return streamlines, header, point_data
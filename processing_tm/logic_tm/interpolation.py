@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Trilinear sampling of one or several volumes sharing the same grid.
+"""
+
+import numpy as np
+
+CHUNK_POINTS = 1 << 18
+
+
+class TrilinearWeights:
+    """
+    Corner indices and weights of the trilinear interpolation at a set of voxel coordinates. They are computed once
+    and reused for every volume sampled on the same grid.
+
+    Same conventions as dipy.core.interpolation.interpolate_scalar_3d: points outside ]-1, dim[ get 0 and the corners
+    falling outside the volume contribute 0.
+    """
+
+    def __init__(self, points_vox, shape):
+        """
+        Object creation operations
+        :param points_vox: (N, 3) voxel coordinates
+        :param shape: spatial shape of the volumes
+        """
+        points_vox = np.asarray(points_vox, dtype=np.float64)
+        self.shape = tuple(int(d) for d in shape[:3])
+        dims = np.asarray(self.shape)
+
+        base = np.floor(points_vox)
+        frac = points_vox - base
+        base = base.astype(np.int64)
+        inside = np.all((points_vox > -1) & (points_vox < dims), axis=1)
+
+        corners = []
+        weights = []
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    corner = base + (dx, dy, dz)
+                    weight = (frac[:, 0] if dx else 1 - frac[:, 0]) * \
+                             (frac[:, 1] if dy else 1 - frac[:, 1]) * \
+                             (frac[:, 2] if dz else 1 - frac[:, 2])
+                    valid = inside & np.all((corner >= 0) & (corner < dims), axis=1)
+                    corners.append(np.where(valid[:, None], corner, 0))
+                    weights.append(np.where(valid, weight, 0.))
+        self.corners = corners
+        self.weights = weights
+        self._flat = {}
+
+    def __repr__(self):
+        return "{}({} points, {})".format(self.__class__.__name__, len(self.weights[0]), self.shape)
+
+    @property
+    def weight_sum(self):
+        """
+        Sum of the weights of the corners inside the volume (1 inside, less than 1 near and outside the borders)
+        """
+        return np.sum(self.weights, axis=0)
+
+    def flat_corners(self, order):
+        """
+        Flat index of every corner
+        :param order: memory layout of the volume ('C' or 'F')
+        :return: list of eight (N,) index arrays
+        """
+        if order not in self._flat:
+            self._flat[order] = [np.ravel_multi_index(c.T, self.shape, order=order) for c in self.corners]
+        return self._flat[order]
+
+    def sample(self, volume):
+        """
+        Interpolated values of a volume
+        :param volume: 3D array, or 4D array of volumes stacked along the last axis
+        :return: (N,) or (N, C) array
+        """
+        volume = np.asarray(volume)
+        if volume.shape[:3] != self.shape:
+            raise ValueError('Volume shape {} does not match the sampling grid {}'.format(volume.shape, self.shape))
+        order = 'F' if volume.flags.f_contiguous and not volume.flags.c_contiguous else 'C'
+        channels = volume.shape[3:]
+        flat = volume.reshape((-1,) + channels, order=order)
+        out = np.zeros((len(self.weights[0]),) + channels, dtype=np.float64)
+        for index, weight in zip(self.flat_corners(order), self.weights):
+            out += (weight.reshape((-1,) + (1,) * len(channels))) * flat[index]
+        return out
+
+
+def squeeze_volume(volume):
+    """
+    Drop the trailing singleton dimensions of a scalar volume (e.g. (X, Y, Z, 1) NIfTI images)
+    :param volume: array
+    :return: 3D array
+    """
+    volume = np.asarray(volume)
+    if volume.ndim > 3 and np.prod(volume.shape[3:]) == 1:
+        volume = volume.reshape(volume.shape[:3], order='F' if volume.flags.f_contiguous else 'C')
+    return volume
+
+
+def sample_volumes(points_vox, volumes, shape=None, chunk_size=CHUNK_POINTS, origin=None):
+    """
+    Trilinear interpolation of several volumes in a single pass over the points
+    :param points_vox: (N, 3) voxel coordinates
+    :param volumes: list of 3D arrays sharing the same grid, or one 4D array of stacked volumes
+    :param shape: spatial shape of the grid (default: shape of the first volume)
+    :param chunk_size: number of points interpolated at once
+    :param origin: voxel of the full image stored at index (0, 0, 0) of the volumes, when they are cropped
+    :return: (N, n_volumes) values, (N,) sum of the corner weights inside the grid
+    """
+    stacked = not isinstance(volumes, (list, tuple))
+    if shape is None:
+        shape = volumes.shape[:3] if stacked else volumes[0].shape[:3]
+    n_channels = volumes.shape[3] if stacked and volumes.ndim == 4 else 1 if stacked else len(volumes)
+
+    values = np.zeros((len(points_vox), n_channels), dtype=np.float64)
+    weight_sum = np.zeros(len(points_vox), dtype=np.float64)
+    for start in range(0, len(points_vox), chunk_size):
+        stop = start + chunk_size
+        points = points_vox[start:stop]
+        if origin is not None:
+            points = points - np.asarray(origin, dtype=np.float64)
+        weights = TrilinearWeights(points, shape)
+        weight_sum[start:stop] = weights.weight_sum
+        if stacked:
+            values[start:stop] = weights.sample(volumes).reshape(-1, n_channels)
+        else:
+            for c, volume in enumerate(volumes):
+                values[start:stop, c] = weights.sample(squeeze_volume(volume))
+    return values, weight_sum
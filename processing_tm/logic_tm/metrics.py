@@ -1,37 +1,172 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from itertools import islice
+import zlib
+from collections import deque
 
 import numpy as np
 
+from . import geometry
+from .parallel import ChunkPool
+from .profiles import along_tract_profile, fiber_extrema, fiber_means, mean_profile
+from .statistics import ArraySummary, RunningStats, StreamingSummary, BOOTSTRAP_STATISTICS, bootstrap_intervals
+from .streamlines import Streamlines
+from .report import Report, Position, Summary, Value
+from .tractogram import get_windings, streamlines_mapvolumes
 from .utils import ras_to_ijk
 
+GEOMETRIC_METRICS = ('points', 'lengths', 'shortest', 'midpoint', 'winding', 'endpoints')
+SCALAR_METRICS = ('FA', 'b-zero', 'MD')
+METRICS = GEOMETRIC_METRICS + SCALAR_METRICS + ('profiles',)
+ALIASES = {'length': 'lengths', 'shortest_length': 'shortest', 'midpoints': 'midpoint', 'windings': 'winding',
+           'turning_angle': 'winding', 'endpoint': 'endpoints', 'n_points': 'points', 'bzero': 'b-zero', 'b0': 'b-zero',
+           'profile': 'profiles'}
 
-def get_length(tract):
+
+def map_range(entry):
+    """
+    Intensity range of a scalar map
+    :param entry: (name, volume) or (name, volume, (min, max))
+    :return: min, max (None for FA, which is not normalized)
+    """
+    if entry[0] == 'FA':
+        return None
+    if len(entry) > 2 and entry[2] is not None:
+        return entry[2]
+    return np.amin(entry[1]), np.amax(entry[1])
+
+
+def normalize_mapping(scalar_name, values, weight_sum, value_range):
     """
-    Compute streamline length
-    :param tract: streamline
-    :return: length
+    Rescale sampled values as if they had been sampled on the min-max normalized map (FA is left untouched).
+    Interpolation is linear, so only the weight of the corners inside the grid is needed.
+    :param scalar_name: name of the scalar map
+    :param values: values sampled on the raw map
+    :param weight_sum: sum of the interpolation weights inside the grid
+    :param value_range: min and max of the raw map
+    :return: normalized values
     """
-    return ((((tract[1:] - tract[:-1]) ** 2).sum(1)) ** .5).sum()
+    if scalar_name == 'FA':
+        return values
+    lo, hi = value_range
+    return (values - lo * weight_sum) / (hi - lo)
+
 
+def select_metrics(metrics=None):
+    """
+    Parse a metric selection
+    :param metrics: comma-separated string or list of metric names (see METRICS, ALIASES); None for every metric
+    :return: frozenset of metric names
+    :raise ValueError: unknown metric, or profiles selected without any scalar metric
+    """
+    if metrics is None:
+        return frozenset(METRICS)
+    if isinstance(metrics, str):
+        metrics = metrics.split(',')
+    names = dict((name.lower(), name) for name in METRICS)
+    names.update(ALIASES)
+    selected = set()
+    for name in metrics:
+        name = name.strip()
+        if not name:
+            continue
+        if name == 'all':
+            selected.update(METRICS)
+            continue
+        if name.lower() not in names:
+            raise ValueError('Unknown metric: {} (available: {})'.format(name, ', '.join(METRICS)))
+        selected.add(names[name.lower()])
+    if 'profiles' in selected and not selected & set(SCALAR_METRICS):
+        raise ValueError('The profiles are computed on the scalar maps: select at least one of {} with profiles'.format(
+            ', '.join(SCALAR_METRICS)))
+    return frozenset(selected)
+
+
+def geometric_chunk(chunk, features=True, winding=True):
+    """
+    Geometric kernel: per-fiber geometric quantities of a group of streamlines
+    :param chunk: packed streamlines
+    :param features: compute the lengths, shortest lengths, midpoints and endpoints
+    :param winding: compute the winding angles
+    :return: dictionary of per-fiber arrays (number of points, geometric features and winding angles)
+    """
+    result = geometry.geometric_features(chunk) if features else {'n_points': chunk.lengths}
+    if winding:
+        result['windings'] = np.asarray(get_windings(chunk), dtype=np.float64)
+    return result
 
-def batch_iterable(iterable, size):
-    iterable = iter(iterable)
-    batch = list(islice(iterable, size))
-    while batch:
-        yield batch
-        batch = list(islice(iterable, size))
+
+def diffusion_chunk(chunk, voxel_chunk, volumes, scalar_names, ranges, n_bins, affine, origin=None, extrema=False,
+                    profiles=True):
+    """
+    Diffusion kernel: sample several scalar maps on a group of streamlines and reduce them per fiber
+    :param chunk: packed streamlines
+    :param voxel_chunk: the same streamlines in voxel coordinates (None to compute them from the affine)
+    :param volumes: list of volumes sharing the same grid
+    :param scalar_names: name of every volume
+    :param ranges: intensity range of every volume (see map_range)
+    :param n_bins: number of fiber portions of the profiles
+    :param affine: affine matrix of the volumes
+    :param origin: voxel of the full images stored first in the volumes, when they are cropped
+    :param extrema: also return the per-fiber min and max
+    :param profiles: also return the profile sums and counts
+    :return: dictionary of (n_volumes, ...) arrays: per-fiber means, point max and min, profile sums and counts
+    """
+    points_vox = None if voxel_chunk is None else voxel_chunk.data
+    values, weight_sum = streamlines_mapvolumes(chunk, volumes, affine, points_vox, origin)
+
+    result = {'fiber_means': [], 'amax': [], 'amin': []}
+    if profiles:
+        cum = geometry.cumulative_lengths(chunk)
+        result.update(profile_sums=[], profile_counts=[])
+    if extrema:
+        result.update(fiber_min=[], fiber_max=[])
+    for c, scalar_name in enumerate(scalar_names):
+        scalar_values = normalize_mapping(scalar_name, values[:, c], weight_sum, ranges[c])
+        result['fiber_means'].append(fiber_means(chunk, scalar_values))
+        result['amax'].append(np.amax(scalar_values))
+        result['amin'].append(np.amin(scalar_values))
+        if profiles:
+            profile = along_tract_profile(chunk, scalar_values, n_bins, cum)
+            result['profile_sums'].append(np.nansum(profile, axis=0))
+            result['profile_counts'].append(np.sum(~np.isnan(profile), axis=0))
+        if extrema:
+            fiber_min, fiber_max = fiber_extrema(chunk, scalar_values)
+            result['fiber_min'].append(fiber_min)
+            result['fiber_max'].append(fiber_max)
+    return {key: np.asarray(value) for key, value in result.items()}
 
 
 class Metrics:
-    def __init__(self, tractogram):
+    def __init__(self, tractogram, n_bins=20, jobs=1, backend='process', n_bootstrap=0, confidence=.95, seed=None,
+                 fiber_table=None, metrics=None, progress=None):
+        """
+        Object creation operations
+        :param tractogram: Tracts
+        :param n_bins: number of fiber portions of the along-tract profiles
+        :param jobs: number of workers of the per-fiber kernels
+        :param backend: 'process' or 'thread' workers
+        :param n_bootstrap: number of bootstrap resamples of the confidence intervals (0 to disable)
+        :param confidence: confidence level of the intervals
+        :param seed: random seed of the bootstrap
+        :param fiber_table: FiberTable receiving the per-fiber values (None to skip it)
+        :param metrics: metrics to compute (see select_metrics; None for every metric)
+        :param progress: processing_tm.progress.Progress checked between the chunks of the parallel kernels (None to
+        disable)
+        """
         self.measures = dict()
         self.tractogram = tractogram
+        self.n_bins = n_bins
+        self.jobs = jobs
+        self.backend = backend
+        self.n_bootstrap = n_bootstrap
+        self.confidence = confidence
+        self.seed = seed
+        self.fiber_table = fiber_table
+        self.metrics = select_metrics(metrics)
+        self.progress = progress
         self.affine = None
-        self.txt_str = ''
-        self.txt_dict = dict()
+        self.report = Report()
 
     def __str__(self):
         return "{}()".format(self.__class__.__name__)
@@ -42,193 +177,298 @@ class Metrics:
     def set_affine(self, affine):
         self.affine = affine
 
+    def plan(self, scalar_names):
+        """
+        Declare the metrics of the run to the intermediate scheduler of the tractogram, so that the shared
+        intermediates (segment lengths, arc lengths) are computed once and freed after their last consumer. Only the
+        serial in-memory path uses it: the chunk kernels compute their own intermediates.
+        :param scalar_names: names of the maps to be sampled
+        """
+        intermediates = getattr(self.tractogram, 'intermediates', None)
+        if intermediates is None or self.jobs > 1:
+            return
+        consumers = dict()
+        if 'profiles' in self.metrics:
+            for scalar_name in scalar_names:
+                consumers['profile ' + scalar_name] = ['cumulative_lengths']
+        if self.needs_features():
+            consumers['geometric'] = ['segment_lengths', 'arc_lengths']
+        intermediates.plan(consumers)
+
+    def needs_features(self):
+        """
+        Whether the selection needs the geometric features (everything but the count and the winding)
+        """
+        return bool(self.metrics & (set(GEOMETRIC_METRICS) - {'winding'}))
+
+    def needs_winding(self):
+        return 'winding' in self.metrics
+
     def geometric(self):
-        n_lines = self.tractogram.n_lines()
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {}'.format('Number of fibers', n_lines)
-        self.txt_dict['Number of fibers'] = n_lines
-
-        n_points = np.asarray(self.tractogram.n_points(), dtype=np.int64)
-
-        mean_n_points = n_points.mean()
-        std_n_points = n_points.std()
-        median_n_points = np.median(n_points)
-        max_n_points = np.amax(n_points)
-        min_n_points = np.amin(n_points)
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {}'.format('Mean number of points per fiber', mean_n_points)
-        self.txt_dict['Mean number of points per fiber'] = mean_n_points
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}'.format('Std number of points per fiber', std_n_points)
-        self.txt_dict['Std number of points per fiber'] = std_n_points
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}'.format('Median number of points per fiber', int(median_n_points))
-        self.txt_dict['Median number of points per fiber'] = int(median_n_points)
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}, {}: {}'.format('Max number of points per fiber', max_n_points,
-                                                'Min number of points per fiber', min_n_points)
-        self.txt_dict['Max number of points per fiber'] = max_n_points
-        self.txt_dict['Min number of points per fiber'] = min_n_points
-
-        lengths = np.asarray(self.tractogram.lengths(), dtype=np.float64)
-
-        mean_length = lengths.mean()
-        std_length = lengths.std()
-        median_length = np.median(lengths)
-        max_length = np.amax(lengths)
-        min_length = np.amin(lengths)
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {} mm'.format('Mean Length', mean_length)
-        self.txt_dict['Mean Length'] = mean_length
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm'.format('Std Length', std_length)
-        self.txt_dict['Std Length'] = std_length
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm'.format('Median Length', median_length)
-        self.txt_dict['Median Length'] = median_length
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm, {}: {} mm'.format('Max Length', max_length, 'Min Length', min_length)
-        self.txt_dict['Max Length'] = max_length
-        self.txt_dict['Min Length'] = min_length
-
-        shortest = np.asarray(self.tractogram.shortest(), dtype=np.float64)
-
-        mean_shortest = shortest.mean()
-        std_shortest = shortest.std()
-        median_shortest = np.median(shortest)
-        max_shortest = np.amax(shortest)
-        min_shortest = np.amin(shortest)
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {} mm'.format('Mean Shortest Length', mean_shortest)
-        self.txt_dict['Mean Shortest Length'] = mean_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm'.format('Std Shortest Length', std_shortest)
-        self.txt_dict['Std Shortest Length'] = std_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm'.format('Median Shortest Length', median_shortest)
-        self.txt_dict['Median Shortest Length'] = median_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} mm, {}: {} mm'.format('Max Shortest Length', max_shortest,
-                                                      'Min Shortest Length', min_shortest)
-        self.txt_dict['Max Shortest Length'] = max_shortest
-        self.txt_dict['Min Shortest Length'] = min_shortest
-
-        midpoints = np.asarray(self.tractogram.get_midpoints())
-
-        mean_midpoints = midpoints.mean(axis=0)
-
-        if type(self.affine) is np.ndarray:
-            mean_midpoints_ijk = ras_to_ijk(mean_midpoints, self.affine)
-
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm / {} vox'.format('Mean Midpoint Position', mean_midpoints, mean_midpoints_ijk)
-            self.txt_dict['Mean Midpoint Position (mm)'] = mean_midpoints
-            self.txt_dict['Mean Midpoint Position (vox)'] = mean_midpoints_ijk
-        else:
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm'.format('Mean Midpoint Position', mean_midpoints)
-            self.txt_dict['Mean Midpoint Position (mm)'] = mean_midpoints
-
-        turning_angles = np.asarray(self.tractogram.get_winding())
-
-        mean_turning_angles = turning_angles.mean()
-        std_turning_angles = turning_angles.std()
-        median_turning_angles = np.median(turning_angles)
-        max_turning_angles = np.amax(turning_angles)
-        min_turning_angles = np.amin(turning_angles)
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {} deg'.format('Mean Turning Angle', mean_turning_angles)
-        self.txt_dict['Mean Turning Angle'] = mean_turning_angles
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} deg'.format('Std Turning Angle', std_turning_angles)
-        self.txt_dict['Std Turning Angle'] = std_turning_angles
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} deg'.format('Median Turning Angle', median_turning_angles)
-        self.txt_dict['Median Turning Angle'] = median_turning_angles
-        self.txt_str += '\n'
-        self.txt_str += '{}: {} deg, {}: {} deg'.format('Max Turning Angle', max_turning_angles,
-                                                    'Min Turning Angle', min_turning_angles)
-        self.txt_dict['Max Turning Angle'] = max_turning_angles
-        self.txt_dict['Min Turning Angle'] = min_turning_angles
-
-        extremities = np.asarray(self.tractogram.extremities())
-
-        seed_points = extremities[:, 0, :]
-
-        termination_points = extremities[:, -1, :]
-
-        seed_points_mean_pos = seed_points.mean(axis=0)
-        termination_points_mean_pos = termination_points.mean(axis=0)
-
-        if type(self.affine) is np.ndarray:
-            seed_points_mean_pos_ijk = ras_to_ijk(seed_points_mean_pos, self.affine)
-            termination_points_mean_pos_ijk = ras_to_ijk(termination_points_mean_pos, self.affine)
-
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm / {} vox'.format('Seed Points Mean Position', seed_points_mean_pos,
-                                                        seed_points_mean_pos_ijk)
-            self.txt_dict['Seed Points Mean Position (mm)'] = seed_points_mean_pos
-            self.txt_dict['Seed Points Mean Position (vox)'] = seed_points_mean_pos_ijk
-
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm / {} vox'.format('Termination  Points Mean Position',
-                                                        termination_points_mean_pos,
-                                                        termination_points_mean_pos_ijk)
-            self.txt_dict['Termination Points Mean Position (mm)'] = seed_points_mean_pos
-            self.txt_dict['Termination Points Mean Position (vox)'] = termination_points_mean_pos_ijk
+        features, winding = self.needs_features(), self.needs_winding()
+        if self.jobs > 1 and (features or winding):
+            with ChunkPool(self.jobs, self.backend, progress=self.progress) as pool:
+                chunks = pool.map(geometric_chunk, self.tractogram.tractogram, features, winding)
+            result = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
         else:
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm'.format('Seed Points Mean Position', seed_points_mean_pos)
-            self.txt_dict['Seed Points Mean Position (mm)'] = seed_points_mean_pos
-
-            self.txt_str += '\n\n'
-            self.txt_str += '{}: {} mm'.format('Termination  Points Mean Position', termination_points_mean_pos)
-            self.txt_dict['Termination Points Mean Position (mm)'] = seed_points_mean_pos
+            with self.tractogram.intermediates.consumer('geometric'):
+                result = self.tractogram.geometric_features() if features else {'n_points': self.tractogram.n_points()}
+            if winding:
+                result['windings'] = self.tractogram.get_winding()
+        if self.fiber_table is not None:
+            self.fiber_table.add_geometric(result, result.get('windings'), self.tractogram.original_ids())
+
+        summaries = {'n_points': ArraySummary(np.asarray(result['n_points'], dtype=np.int64))}
+        if features:
+            extremities = np.asarray(result['extremities'])
+            summaries.update(lengths=ArraySummary(np.asarray(result['lengths'], dtype=np.float64)),
+                             shortest=ArraySummary(np.asarray(result['shortest'], dtype=np.float64)),
+                             mean_midpoints=np.asarray(result['midpoints']).mean(axis=0),
+                             seed_points_mean_pos=extremities[:, 0, :].mean(axis=0),
+                             termination_points_mean_pos=extremities[:, -1, :].mean(axis=0))
+        if winding:
+            summaries['turning_angles'] = ArraySummary(np.asarray(result['windings']))
+        self.report_geometric(self.tractogram.n_lines(), **summaries)
 
     def diffusion(self, scalar_map, scalar_name):
-        if scalar_name != 'FA':
-            scalar_map = (scalar_map - np.amin(scalar_map)) / (np.amax(scalar_map) - np.amin(scalar_map))
-        scalar_measurement = self.tractogram.mapping(scalar_map, self.affine)
-        scalar_measurement_mean = np.asarray([np.asarray(m).mean() for m in scalar_measurement])
-
-        mean_shortest = scalar_measurement_mean.mean()
-        std_shortest = scalar_measurement_mean.std()
-        median_shortest = np.median(scalar_measurement_mean)
-        max_shortest = np.amax(np.concatenate(scalar_measurement).ravel())
-        min_shortest = np.amin(np.concatenate(scalar_measurement).ravel())
-
-        self.txt_str += '\n\n'
-        self.txt_str += '{}: {}'.format('Mean ' + scalar_name + ' Value', mean_shortest)
-        self.txt_dict['Mean ' + scalar_name + ' Value'] = mean_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}'.format('Std ' + scalar_name + ' Value', std_shortest)
-        self.txt_dict['Std ' + scalar_name + ' Value'] = std_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}'.format('Median ' + scalar_name + ' Value', median_shortest)
-        self.txt_dict['Median ' + scalar_name + ' Value'] = median_shortest
-        self.txt_str += '\n'
-        self.txt_str += '{}: {}, {}: {}'.format('Max ' + scalar_name + ' Value', max_shortest,
-                                                'Min ' + scalar_name + ' Value', min_shortest)
-        self.txt_dict['Max ' + scalar_name + ' Value'] = max_shortest
-        self.txt_dict['Min ' + scalar_name + ' Value'] = min_shortest
-
-        behavior = np.zeros((self.tractogram.n_lines(), 20))
-        for i, tract in enumerate(self.tractogram.tractogram):
-            cum_len = [get_length(tract[:n]) for n in range(1, len(tract) + 1)]
-            ten_perc = get_length(tract) / 20.
-            for j in range(1, 21):
-                behavior[i, j - 1] = np.asarray(scalar_measurement[i])[
-                    (ten_perc * (j - 1) <= cum_len) & (cum_len <= ten_perc * j)].mean()
-
-        return np.mean(behavior, axis=0)
+        return self.diffusion_maps([(scalar_name, scalar_map)])[scalar_name]
+
+    def diffusion_maps(self, scalar_maps, origin=None):
+        """
+        Diffusion statistics of several scalar maps sharing the grid of the current affine, sampled in a single pass
+        :param scalar_maps: list of (name, volume) or (name, volume, (min, max)) entries; the range of the whole
+        image must be given when the volume is cropped
+        :param origin: voxel of the full images stored first in the volumes, when they are cropped
+        :return: dictionary of along-tract profiles (empty when the profiles are not selected)
+        """
+        if self.jobs > 1:
+            return self.diffusion_maps_parallel(scalar_maps, origin)
+
+        volumes = [entry[1] for entry in scalar_maps]
+        ranges = [map_range(entry) for entry in scalar_maps]
+        values, weight_sum = self.tractogram.mapping_multi(volumes, self.affine, origin)
+
+        behaviors = dict()
+        for c, scalar_name in enumerate(entry[0] for entry in scalar_maps):
+            scalar_values = normalize_mapping(scalar_name, values[:, c], weight_sum, ranges[c])
+            scalar_measurement_mean = fiber_means(self.tractogram.tractogram, scalar_values)
+            if self.fiber_table is not None:
+                self.fiber_table.add_scalar(scalar_name, scalar_measurement_mean,
+                                            *fiber_extrema(self.tractogram.tractogram, scalar_values))
+            self.report_diffusion(scalar_name, ArraySummary(scalar_measurement_mean), np.amax(scalar_values),
+                                  np.amin(scalar_values))
+            if 'profiles' in self.metrics:
+                with self.tractogram.intermediates.consumer('profile ' + scalar_name):
+                    behaviors[scalar_name] = self.profile(scalar_values)
+
+        return behaviors
+
+    def diffusion_maps_parallel(self, scalar_maps, origin=None):
+        """
+        Same as diffusion_maps, the fibers being split in chunks processed by a pool of jobs workers. Per-fiber
+        values are concatenated and the profile sums and counts are added, so the statistics are the exact ones.
+        """
+        scalar_names = [entry[0] for entry in scalar_maps]
+        ranges = [map_range(entry) for entry in scalar_maps]
+        streamlines = self.tractogram.tractogram
+        voxel_streamlines = Streamlines(self.tractogram.voxel_points(self.affine), streamlines.lengths)
+        profiles = 'profiles' in self.metrics
+
+        with ChunkPool(self.jobs, self.backend, progress=self.progress) as pool:
+            volumes = [pool.share(entry[1]) for entry in scalar_maps]
+            chunks = pool.map(diffusion_chunk, [streamlines, voxel_streamlines], volumes, scalar_names, ranges,
+                              self.n_bins, self.affine, origin, self.fiber_table is not None, profiles)
+
+        scalar_measurement_mean = np.concatenate([chunk['fiber_means'] for chunk in chunks], axis=1)
+        amax = np.amax([chunk['amax'] for chunk in chunks], axis=0)
+        amin = np.amin([chunk['amin'] for chunk in chunks], axis=0)
+        if self.fiber_table is not None:
+            fiber_min = np.concatenate([chunk['fiber_min'] for chunk in chunks], axis=1)
+            fiber_max = np.concatenate([chunk['fiber_max'] for chunk in chunks], axis=1)
+            for c, scalar_name in enumerate(scalar_names):
+                self.fiber_table.add_scalar(scalar_name, scalar_measurement_mean[c], fiber_min[c], fiber_max[c])
+
+        behaviors = dict()
+        for c, scalar_name in enumerate(scalar_names):
+            self.report_diffusion(scalar_name, ArraySummary(scalar_measurement_mean[c]), amax[c], amin[c])
+        if profiles:
+            behaviors = self.merge_profiles(scalar_names, np.sum([chunk['profile_sums'] for chunk in chunks], axis=0),
+                                            np.sum([chunk['profile_counts'] for chunk in chunks], axis=0))
+
+        return behaviors
+
+    @staticmethod
+    def merge_profiles(scalar_names, profile_sums, profile_counts):
+        """
+        Bundle profiles from the profile sums and counts of all the fibers
+        :return: dictionary name -> (n_bins,) profile
+        """
+        behaviors = dict()
+        for c, scalar_name in enumerate(scalar_names):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                behaviors[scalar_name] = profile_sums[c] / profile_counts[c]
+        return behaviors
+
+    def profile(self, values):
+        """
+        Along-tract profile of a mapped scalar
+        :param values: scalar values mapped on every point of the tractogram
+        :return: mean value over each of the n_bins fiber portions
+        """
+        return mean_profile(self.tractogram.tractogram, values, self.n_bins,
+                            self.tractogram.intermediates.get('cumulative_lengths'))
+
+    def report_geometric(self, n_lines, n_points=None, lengths=None, shortest=None, mean_midpoints=None,
+                         turning_angles=None, seed_points_mean_pos=None, termination_points_mean_pos=None):
+        """
+        Add the selected geometric statistics to the report
+        :param n_lines: number of fibers
+        :param n_points: summary of the number of points per fiber
+        :param lengths: summary of the fiber lengths
+        :param shortest: summary of the distances between fiber endpoints
+        :param mean_midpoints: mean midpoint position
+        :param turning_angles: summary of the fiber turning angles
+        :param seed_points_mean_pos: mean position of the first points
+        :param termination_points_mean_pos: mean position of the last points
+        """
+        self.report.add(Value('Number of fibers', n_lines))
+        n_lines_total = getattr(self.tractogram, 'n_lines_total', None)
+        if n_lines_total is not None:
+            self.report.add(Value('Number of fibers before subsampling', n_lines_total), new_section=False)
+
+        if 'points' in self.metrics:
+            self.report_summary('number of points per fiber', n_points, median=int(n_points.median))
+        if 'lengths' in self.metrics:
+            self.report_summary('Length', lengths, 'mm')
+        if 'shortest' in self.metrics:
+            self.report_summary('Shortest Length', shortest, 'mm')
+        if 'midpoint' in self.metrics:
+            self.report_position('Mean Midpoint Position', 'Mean Midpoint Position', mean_midpoints)
+        if 'winding' in self.metrics:
+            self.report_summary('Turning Angle', turning_angles, 'deg')
+        if 'endpoints' in self.metrics:
+            self.report_position('Seed Points Mean Position', 'Seed Points Mean Position', seed_points_mean_pos)
+            self.report_position('Termination  Points Mean Position', 'Termination Points Mean Position',
+                                 termination_points_mean_pos)
+
+    def report_diffusion(self, scalar_name, fiber_means_summary, max_value, min_value):
+        """
+        Add the statistics of a mapped scalar to the report
+        :param scalar_name: name of the scalar map
+        :param fiber_means_summary: summary of the per-fiber mean values
+        :param max_value: maximum value over all the points
+        :param min_value: minimum value over all the points
+        """
+        self.report_summary(scalar_name + ' Value', fiber_means_summary, amax=max_value, amin=min_value)
+
+    def report_summary(self, name, summary, unit='', median=None, amax=None, amin=None):
+        overridden = [key for key, value in (('amax', amax), ('amin', amin)) if value is not None]
+        intervals = self.intervals(name, summary, exclude=overridden)
+        statistics = {'mean': summary.mean, 'std': summary.std,
+                      'median': summary.median if median is None else median,
+                      'amax': summary.amax if amax is None else amax,
+                      'amin': summary.amin if amin is None else amin}
+        self.report.add(Summary(name, statistics, unit, intervals, self.confidence))
+
+    def intervals(self, name, summary, exclude=()):
+        """
+        Bootstrap confidence intervals of the statistics of a summary (only for exact, in-memory summaries)
+        :param name: name of the measure
+        :param summary: ArraySummary of per-fiber values
+        :param exclude: statistics reported from other values (e.g. point-wise max and min)
+        :return: dictionary statistic -> (low, high), empty when bootstrapping is disabled
+        """
+        if not self.n_bootstrap or not isinstance(summary, ArraySummary) or summary.values.ndim != 1:
+            return {}
+        statistics = {k: v for k, v in BOOTSTRAP_STATISTICS.items() if k not in exclude}
+        # one generator per reported measure, so that an interval does not depend on the other measures computed
+        rng = np.random.default_rng(None if self.seed is None else [self.seed, zlib.crc32(name.encode())])
+        return bootstrap_intervals(summary.values, self.n_bootstrap, self.confidence, rng, statistics)
+
+    def report_position(self, label, key, position):
+        position_ijk = ras_to_ijk(position, self.affine) if type(self.affine) is np.ndarray else None
+        self.report.add(Position(label, key, position, position_ijk))
+
+    def get_report(self):
+        return self.report
 
     def get_str(self):
-        return self.txt_str
+        return self.report.to_text()
 
     def get_dict(self):
-        return self.txt_dict
+        return self.report.to_dict()
+
+
+class StreamingMetrics(Metrics):
+    """
+    Same report as Metrics for tractograms read chunk by chunk (TractStream): per-fiber values are folded into
+    running accumulators (Welford mean/variance, min/max, quantile sketch for the medians) and never kept in memory, so
+    no bootstrap interval is reported
+    """
+
+    def __init__(self, tractogram, n_bins=20, sketch_capacity=4096, jobs=1, backend='process', n_bootstrap=0,
+                 confidence=.95, seed=None, fiber_table=None, metrics=None, progress=None):
+        Metrics.__init__(self, tractogram, n_bins, jobs, backend, n_bootstrap, confidence, seed, fiber_table, metrics,
+                         progress)
+        self.sketch_capacity = sketch_capacity
+
+    def geometric(self):
+        features, winding = self.needs_features(), self.needs_winding()
+        n_points, lengths, shortest, turning_angles = (StreamingSummary(self.sketch_capacity) for _ in range(4))
+        midpoints, seed_points, termination_points = RunningStats(), RunningStats(), RunningStats()
+
+        # input indices of the chunks handed to the pool, consumed in the same order by the results
+        ids = deque()
+
+        def chunks():
+            for chunk_ids, chunk in self.tractogram.chunks(with_ids=True):
+                ids.append(chunk_ids)
+                yield chunk
+
+        with ChunkPool(self.jobs, self.backend, progress=self.progress) as pool:
+            for result in pool.imap(geometric_chunk, chunks(), features, winding):
+                chunk_ids = ids.popleft()
+                n_points.update(np.asarray(result['n_points'], dtype=np.int64))
+                if features:
+                    lengths.update(result['lengths'])
+                    shortest.update(result['shortest'])
+                    midpoints.update(result['midpoints'])
+                    seed_points.update(result['extremities'][:, 0, :])
+                    termination_points.update(result['extremities'][:, -1, :])
+                if winding:
+                    turning_angles.update(result['windings'])
+                if self.fiber_table is not None:
+                    self.fiber_table.add_geometric(result, result.get('windings'), chunk_ids)
+
+        self.report_geometric(n_points.count, n_points, lengths, shortest, midpoints.mean, turning_angles,
+                              seed_points.mean, termination_points.mean)
+
+    def diffusion_maps(self, scalar_maps, origin=None):
+        scalar_names = [entry[0] for entry in scalar_maps]
+        ranges = [map_range(entry) for entry in scalar_maps]
+        profiles = 'profiles' in self.metrics
+
+        scalar_measurement_mean = [StreamingSummary(self.sketch_capacity) for _ in scalar_maps]
+        amax = np.full(len(scalar_maps), -np.inf)
+        amin = np.full(len(scalar_maps), np.inf)
+        profile_sums = np.zeros((len(scalar_maps), self.n_bins))
+        profile_counts = np.zeros((len(scalar_maps), self.n_bins))
+        with ChunkPool(self.jobs, self.backend, progress=self.progress) as pool:
+            volumes = [pool.share(entry[1]) for entry in scalar_maps]
+            for chunk in pool.imap(diffusion_chunk, self.tractogram.chunks(), None, volumes, scalar_names, ranges,
+                                   self.n_bins, self.affine, origin, self.fiber_table is not None, profiles):
+                for c in range(len(scalar_maps)):
+                    scalar_measurement_mean[c].update(chunk['fiber_means'][c])
+                    if self.fiber_table is not None:
+                        self.fiber_table.add_scalar(scalar_names[c], chunk['fiber_means'][c], chunk['fiber_min'][c],
+                                                    chunk['fiber_max'][c])
+                amax = np.maximum(amax, chunk['amax'])
+                amin = np.minimum(amin, chunk['amin'])
+                if profiles:
+                    profile_sums += chunk['profile_sums']
+                    profile_counts += chunk['profile_counts']
+
+        for c, scalar_name in enumerate(scalar_names):
+            self.report_diffusion(scalar_name, scalar_measurement_mean[c], amax[c], amin[c])
+
+        return self.merge_profiles(scalar_names, profile_sums, profile_counts) if profiles else dict()
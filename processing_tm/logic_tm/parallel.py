@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel execution of the per-streamline kernels on chunks of whole streamlines, in a thread or a process pool.
+
+With processes, the packed buffers and the volumes are copied once in shared memory: only the block names and the
+chunk bounds are sent to the workers, which map the blocks without copying them.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .streamlines import Streamlines
+
+CHUNKS_PER_JOB = 4
+
+_ATTACHED = {}
+
+
+def _attach_array(name, shape, dtype, order):
+    """
+    Worker side of SharedArray: map a shared memory block (once per process)
+    """
+    if name not in _ATTACHED:
+        block = shared_memory.SharedMemory(name=name)
+        _ATTACHED[name] = (block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, order=order))
+    return _ATTACHED[name][1]
+
+
+def _attach_streamlines(data, lengths):
+    """
+    Worker side of SharedStreamlines
+    """
+    key = ('streamlines', id(data))
+    if key not in _ATTACHED:
+        _ATTACHED[key] = (None, Streamlines(data, lengths))
+    return _ATTACHED[key][1]
+
+
+class SharedArray:
+    """
+    Copy of an array in a shared memory block. It is pickled as the block name, shape and data type, and unpickled
+    as a numpy array mapping the block.
+    """
+
+    def __init__(self, array):
+        array = np.asarray(array)
+        self.order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.block.buf, order=self.order)
+        self.array[...] = array
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.shape, self.dtype)
+
+    def __reduce__(self):
+        return _attach_array, (self.block.name, self.shape, self.dtype.str, self.order)
+
+    def release(self):
+        """
+        Free the shared memory block
+        """
+        self.array = None
+        self.block.close()
+        self.block.unlink()
+
+
+class SharedStreamlines:
+    """
+    Packed streamlines whose buffers live in shared memory, unpickled as a Streamlines container
+    """
+
+    def __init__(self, data, lengths):
+        self.data = data
+        self.lengths = lengths
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.data)
+
+    def __reduce__(self):
+        return _attach_streamlines, (self.data, self.lengths)
+
+
+def chunk_ranges(lengths, n_chunks):
+    """
+    Split a tractogram in consecutive groups of whole streamlines holding about the same number of points
+    :param lengths: number of points of every streamline
+    :param n_chunks: number of groups
+    :return: list of (first, last + 1) streamline indices
+    """
+    n_lines = len(lengths)
+    if n_lines == 0:
+        return []
+    cum = np.cumsum(lengths)
+    targets = np.linspace(0, cum[-1], max(min(n_chunks, n_lines), 1) + 1)[1:-1]
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(cum, targets, side='right'), [n_lines])))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def run_chunk(func, sequences, start, stop, args):
+    """
+    Apply a kernel to a range of streamlines of several aligned packed sequences
+    :param func: kernel, called as func(*chunks, *args)
+    :param sequences: packed sequences sharing the same lengths (e.g. points in mm and in voxels)
+    :param start: first streamline
+    :param stop: last streamline + 1
+    :param args: additional kernel arguments
+    :return: kernel result
+    """
+    chunks = [sequence[start:stop] for sequence in sequences]
+    return func(*(chunks + list(args)))
+
+
+class ChunkPool:
+    """
+    Pool of workers running per-streamline kernels chunk by chunk. Use it as a context manager: the workers and the
+    shared memory blocks are released on exit.
+    """
+
+    def __init__(self, jobs=1, backend='process', chunks_per_job=CHUNKS_PER_JOB, progress=None):
+        """
+        Object creation operations
+        :param jobs: number of workers
+        :param backend: 'process' (kernels holding the GIL scale too) or 'thread' (no copy at all)
+        :param chunks_per_job: number of chunks per worker, for load balancing
+        :param progress: processing_tm.progress.Progress told about every completed chunk, which may cancel the run
+        (None to disable)
+        """
+        if backend not in ('process', 'thread'):
+            raise ValueError('Unknown parallel backend: {}'.format(backend))
+        self.jobs = max(int(jobs), 1)
+        self.backend = backend
+        self.chunks_per_job = chunks_per_job
+        self.progress = progress
+        self._executor = None
+        self._shared = {}
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.jobs, self.backend)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.backend == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for array, shared in self._shared.values():
+            shared.release()
+        self._shared = {}
+
+    def share(self, value):
+        """
+        Make an array (or a packed sequence) available to the workers without pickling it
+        :param value: array or Streamlines
+        :return: object to pass to the kernels in place of the value
+        """
+        if self.backend == 'thread' or self.jobs == 1:
+            return value
+        if isinstance(value, Streamlines):
+            return SharedStreamlines(self.share(value.data), self.share(value.lengths))
+        key = id(value)
+        if key not in self._shared:
+            self._shared[key] = (value, SharedArray(value))
+        return self._shared[key][1]
+
+    def map(self, func, sequences, *args):
+        """
+        Run a kernel on every chunk of a tractogram
+        :param func: module-level kernel, called as func(*chunks, *args)
+        :param sequences: packed streamlines, or list of packed sequences with the same lengths
+        :param args: additional kernel arguments (arrays should go through share)
+        :return: list of the chunk results, in streamline order
+        """
+        if isinstance(sequences, Streamlines):
+            sequences = [sequences]
+        ranges = chunk_ranges(sequences[0].lengths, self.jobs * self.chunks_per_job)
+        results = []
+        if self.jobs == 1:
+            for start, stop in ranges:
+                results.append(run_chunk(func, sequences, start, stop, args))
+                self.chunk_done(len(results), len(ranges))
+            return results
+        shared = [self.share(sequence) for sequence in sequences]
+        futures = [self.executor.submit(run_chunk, func, shared, start, stop, args) for start, stop in ranges]
+        try:
+            for future in futures:
+                results.append(future.result())
+                self.chunk_done(len(results), len(futures))
+        except BaseException:
+            # cancelled or failed: the chunks not started yet are dropped
+            for future in futures:
+                future.cancel()
+            raise
+        return results
+
+    def imap(self, func, chunks, *args):
+        """
+        Run a kernel on a stream of chunks, keeping at most two chunks per worker in flight
+        :param func: module-level kernel, called as func(chunk, *args)
+        :param chunks: iterable of packed streamlines
+        :param args: additional kernel arguments (arrays should go through share)
+        :return: generator of the chunk results, in order
+        """
+        n_done = 0
+        if self.jobs == 1:
+            for chunk in chunks:
+                result = func(chunk, *args)
+                n_done += 1
+                self.chunk_done(n_done)
+                yield result
+            return
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(self.executor.submit(func, chunk, *args))
+                if len(pending) >= 2 * self.jobs:
+                    result = pending.popleft().result()
+                    n_done += 1
+                    self.chunk_done(n_done)
+                    yield result
+            while pending:
+                result = pending.popleft().result()
+                n_done += 1
+                self.chunk_done(n_done)
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def chunk_done(self, done, total=None):
+        if self.progress is not None:
+            self.progress.chunk(done, total)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Along-tract profiles: scalar values averaged over equal arc-length portions of every fiber.
+"""
+
+import numpy as np
+
+from .geometry import cumulative_lengths, segment_sums
+
+
+def point_bins(streamlines, n_bins, cum=None):
+    """
+    Portion index of every point of the packed buffer.
+
+    Portion j of a fiber of length L covers the arc lengths [j * L / n_bins, (j + 1) * L / n_bins]. A point lying
+    exactly on a boundary belongs to both neighbouring portions, so it is returned twice.
+    :param streamlines: packed streamlines
+    :param n_bins: number of portions per fiber
+    :param cum: precomputed cumulative arc lengths
+    :return: point indices, flat (fiber, portion) indices
+    """
+    if cum is None:
+        cum = cumulative_lengths(streamlines)
+    lengths = streamlines.lengths
+    fibers = streamlines.fiber_ids()
+    step = np.repeat(cum[streamlines.ends[lengths > 0]] / n_bins, lengths[lengths > 0])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        j = np.where(step > 0, np.floor(cum / step), 0)
+    j = np.clip(j, 0, n_bins - 1).astype(np.int64)
+    j -= (cum < step * j) & (j > 0)
+    j += (cum > step * (j + 1)) & (j < n_bins - 1)
+
+    points = np.arange(len(cum), dtype=np.int64)
+    lower = (cum == step * j) & (j > 0) & (step > 0)
+    upper = (cum == step * (j + 1)) & (j < n_bins - 1) & (step > 0)
+    idx = np.concatenate((points, points[lower], points[upper]))
+    bins = np.concatenate((j, j[lower] - 1, j[upper] + 1))
+
+    flat = fibers[idx] * n_bins + bins
+    degenerate = np.flatnonzero(step == 0)
+    if len(degenerate):
+        # zero-length fibers: every portion contains every point
+        extra = np.arange(1, n_bins, dtype=np.int64)
+        idx = np.concatenate((idx, np.repeat(degenerate, n_bins - 1)))
+        flat = np.concatenate((flat, (fibers[degenerate] * n_bins)[:, None].repeat(n_bins - 1, 1).ravel() +
+                               np.tile(extra, len(degenerate))))
+    return idx, flat
+
+
+def along_tract_profile(streamlines, values, n_bins=20, cum=None):
+    """
+    Per-fiber mean of a scalar over equal arc-length portions
+    :param streamlines: packed streamlines
+    :param values: (N_points,) scalar values mapped on the packed buffer
+    :param n_bins: number of portions per fiber
+    :param cum: precomputed cumulative arc lengths
+    :return: (n_lines, n_bins) array, NaN where a portion contains no point
+    """
+    idx, flat = point_bins(streamlines, n_bins, cum)
+    size = len(streamlines) * n_bins
+    sums = np.bincount(flat, weights=np.asarray(values, dtype=np.float64)[idx], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profile = sums / counts
+    return profile.reshape(len(streamlines), n_bins)
+
+
+def mean_profile(streamlines, values, n_bins=20, cum=None):
+    """
+    Bundle profile: average of the fiber profiles
+    :param streamlines: packed streamlines
+    :param values: (N_points,) scalar values mapped on the packed buffer
+    :param n_bins: number of portions per fiber
+    :param cum: precomputed cumulative arc lengths
+    :return: (n_bins,) array
+    """
+    profile = along_tract_profile(streamlines, values, n_bins, cum)
+    counts = np.sum(~np.isnan(profile), axis=0)
+    sums = np.nansum(profile, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def fiber_means(streamlines, values):
+    """
+    Mean scalar value of every fiber
+    :param streamlines: packed streamlines
+    :param values: (N_points,) scalar values mapped on the packed buffer
+    :return: (n_lines,) array
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return segment_sums(np.asarray(values, dtype=np.float64), streamlines) / streamlines.lengths
+
+
+def fiber_extrema(streamlines, values):
+    """
+    Minimum and maximum scalar value of every fiber
+    :param streamlines: packed streamlines
+    :param values: (N_points,) scalar values mapped on the packed buffer
+    :return: (n_lines,) minima, (n_lines,) maxima (NaN for empty fibers)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.full(len(streamlines), np.nan), np.full(len(streamlines), np.nan)
+    starts = np.minimum(streamlines.offsets, len(values) - 1)
+    amin = np.minimum.reduceat(values, starts)
+    amax = np.maximum.reduceat(values, starts)
+    amin[streamlines.lengths == 0] = np.nan
+    amax[streamlines.lengths == 0] = np.nan
+    return amin, amax
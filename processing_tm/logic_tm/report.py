@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Structured metric report: the computations fill a Report with values, summaries and positions, which is formatted as
+text or as a flat dictionary (CSV, Excel) only once everything is computed.
+"""
+
+import numpy as np
+
+# summary statistics: key, label prefix
+STATISTICS = (('mean', 'Mean '), ('std', 'Std '), ('median', 'Median '), ('amax', 'Max '), ('amin', 'Min '))
+
+
+class Value:
+    """
+    Single value, e.g. a count
+    """
+
+    def __init__(self, label, value):
+        self.label = label
+        self.value = value
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.label, self.value)
+
+    def text(self):
+        return '{}: {}'.format(self.label, self.value)
+
+    def items(self):
+        return [(self.label, self.value)]
+
+
+class Summary:
+    """
+    Mean, standard deviation, median, max and min of a measure, with optional confidence intervals
+    """
+
+    def __init__(self, name, statistics, unit='', intervals=None, confidence=None):
+        """
+        Object creation operations
+        :param name: name of the measure
+        :param statistics: dictionary statistic key (see STATISTICS) -> value
+        :param unit: unit of the measure
+        :param intervals: dictionary statistic key -> (low, high)
+        :param confidence: confidence level of the intervals
+        """
+        self.name = name
+        self.statistics = statistics
+        self.unit = unit
+        self.intervals = intervals or {}
+        self.confidence = confidence
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.name)
+
+    def text(self):
+        unit = ' ' + self.unit if self.unit else ''
+        lines = []
+        for key, label in STATISTICS:
+            line = '{}: {}{}'.format(label + self.name, self.statistics[key], unit)
+            if key in self.intervals:
+                low, high = self.intervals[key]
+                line += ' ({:.0%} CI: {} - {}{})'.format(self.confidence, low, high, unit)
+            lines.append(line)
+        return '\n'.join(lines[:3]) + '\n' + ', '.join(lines[3:])
+
+    def items(self):
+        items = []
+        for key, label in STATISTICS:
+            items.append((label + self.name, self.statistics[key]))
+            if key in self.intervals:
+                items.append(('{}{} {:.0%} CI'.format(label, self.name, self.confidence),
+                              np.array(self.intervals[key])))
+        return items
+
+
+class Position:
+    """
+    Mean position, in mm and (when the reference grid is known) in voxels
+    """
+
+    def __init__(self, label, key, position, position_ijk=None):
+        self.label = label
+        self.key = key
+        self.position = position
+        self.position_ijk = position_ijk
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.key)
+
+    def text(self):
+        if self.position_ijk is None:
+            return '{}: {} mm'.format(self.label, self.position)
+        return '{}: {} mm / {} vox'.format(self.label, self.position, self.position_ijk)
+
+    def items(self):
+        if self.position_ijk is None:
+            return [(self.key + ' (mm)', self.position)]
+        return [(self.key + ' (mm)', self.position), (self.key + ' (vox)', self.position_ijk)]
+
+
+class Report:
+    """
+    Ordered sections of report entries (Value, Summary, Position); the entries of a section are printed on
+    consecutive lines, the sections are separated by a blank line
+    """
+
+    def __init__(self):
+        self.sections = []
+
+    def __repr__(self):
+        return "{}({} sections)".format(self.__class__.__name__, len(self.sections))
+
+    def __iter__(self):
+        for section in self.sections:
+            for entry in section:
+                yield entry
+
+    def add(self, entry, new_section=True):
+        """
+        Append an entry
+        :param entry: Value, Summary or Position
+        :param new_section: start a new section, otherwise continue the last one
+        """
+        if new_section or not self.sections:
+            self.sections.append([])
+        self.sections[-1].append(entry)
+
+    def to_text(self):
+        return ''.join('\n\n' + '\n'.join(entry.text() for entry in section) for section in self.sections)
+
+    def to_dict(self):
+        body = dict()
+        for entry in self:
+            body.update(entry.items())
+        return body
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reproducible selection of a subset of the fibers, optionally stratified by fiber length.
+"""
+
+import numpy as np
+
+N_STRATA = 10
+
+
+def subsample_size(n_lines, count=None, fraction=None):
+    """
+    Number of fibers to keep
+    :param n_lines: number of fibers
+    :param count: number of fibers to keep
+    :param fraction: fraction of fibers to keep (used when count is None)
+    :return: number of fibers, between 1 and n_lines
+    """
+    if count is None and fraction is None:
+        return n_lines
+    size = count if count is not None else int(round(fraction * n_lines))
+    return int(min(max(size, 1), n_lines)) if n_lines else 0
+
+
+def allocate(stratum_sizes, size):
+    """
+    Share a sample size between strata proportionally to their size (largest remainder rounding)
+    :param stratum_sizes: number of fibers in every stratum
+    :param size: total number of fibers to keep
+    :return: number of fibers to keep in every stratum
+    """
+    stratum_sizes = np.asarray(stratum_sizes, dtype=np.int64)
+    quota = stratum_sizes * float(size) / max(stratum_sizes.sum(), 1)
+    counts = np.floor(quota).astype(np.int64)
+    remainder = size - counts.sum()
+    if remainder > 0:
+        order = np.argsort(-(quota - counts), kind='mergesort')
+        counts[order[:remainder]] += 1
+    return np.minimum(counts, stratum_sizes)
+
+
+def subsample_indices(n_lines, count=None, fraction=None, strata_values=None, n_strata=N_STRATA, rng=None):
+    """
+    Random subset of fibers, drawn without replacement
+    :param n_lines: number of fibers
+    :param count: number of fibers to keep
+    :param fraction: fraction of fibers to keep (used when count is None)
+    :param strata_values: per-fiber value (e.g. length) defining the strata; None for a simple random sample
+    :param n_strata: number of strata (quantiles of strata_values)
+    :param rng: numpy random Generator, or seed
+    :return: sorted indices of the kept fibers
+    """
+    rng = np.random.default_rng(rng)
+    size = subsample_size(n_lines, count, fraction)
+    if size >= n_lines:
+        return np.arange(n_lines, dtype=np.int64)
+    if strata_values is None:
+        return np.sort(rng.choice(n_lines, size, replace=False))
+
+    strata_values = np.asarray(strata_values)
+    edges = np.quantile(strata_values, np.linspace(0, 1, n_strata + 1)[1:-1])
+    stratum = np.searchsorted(edges, strata_values, side='right')
+    order = np.argsort(stratum, kind='mergesort')
+    stratum_sizes = np.bincount(stratum, minlength=n_strata)
+    starts = np.concatenate(([0], np.cumsum(stratum_sizes)[:-1]))
+
+    selected = []
+    for start, stratum_size, k in zip(starts, stratum_sizes, allocate(stratum_sizes, size)):
+        if k:
+            selected.append(order[start + rng.choice(stratum_size, k, replace=False)])
+    return np.sort(np.concatenate(selected))
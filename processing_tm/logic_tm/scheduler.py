@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared intermediates of the per-fiber metrics (segment vectors, segment lengths, arc lengths...): every intermediate
+is computed once, on first use, and freed as soon as the last planned consumer is done with it.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Intermediate:
+    """
+    Node of the intermediate graph
+    """
+
+    def __init__(self, name, compute, dependencies=()):
+        """
+        Object creation operations
+        :param name: name of the intermediate
+        :param compute: function called with the values of the dependencies
+        :param dependencies: names of the intermediates needed to compute this one
+        """
+        self.name = name
+        self.compute = compute
+        self.dependencies = tuple(dependencies)
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.name, self.dependencies)
+
+
+class Scheduler:
+    """
+    Reference-counted store of intermediates.
+
+    plan() declares the consumers (metrics) of a run and the intermediates each of them reads. An intermediate holds
+    one reference per consumer reading it and one per planned intermediate computed from it; a reference is dropped
+    when a consumer is released or when the dependent intermediate has been computed, and the value is freed when the
+    count reaches zero. Intermediates read outside of any plan are computed but not kept.
+    """
+
+    def __init__(self, intermediates):
+        """
+        Object creation operations
+        :param intermediates: list of Intermediate
+        """
+        self.intermediates = dict((node.name, node) for node in intermediates)
+        self.values = dict()
+        self.consumers = dict()
+        self.refcounts = Counter()
+        self.computed = Counter()
+
+    def __repr__(self):
+        return "{}({} kept, {} consumers)".format(self.__class__.__name__, sorted(self.values), len(self.consumers))
+
+    def plan(self, consumers):
+        """
+        Declare consumers, in addition to the ones already planned and not yet released
+        :param consumers: dictionary consumer name -> names of the intermediates it reads
+        """
+        for consumer, needs in consumers.items():
+            if consumer in self.consumers:
+                self.release(consumer)
+            self.consumers[consumer] = tuple(needs)
+            for name in needs:
+                self._acquire(name)
+
+    def _acquire(self, name):
+        self.refcounts[name] += 1
+        if self.refcounts[name] == 1 and name not in self.values:
+            # first reference: the dependencies are held until this intermediate is computed
+            for dependency in self.intermediates[name].dependencies:
+                self._acquire(dependency)
+
+    def _drop(self, name):
+        self.refcounts[name] -= 1
+        if self.refcounts[name] > 0:
+            return
+        del self.refcounts[name]
+        if name in self.values:
+            del self.values[name]
+        else:
+            # freed before being computed: its dependencies are not needed anymore either
+            for dependency in self.intermediates[name].dependencies:
+                self._drop(dependency)
+
+    def get(self, name):
+        """
+        Value of an intermediate, computed on first use
+        :param name: name of the intermediate
+        :return: value
+        """
+        if name in self.values:
+            return self.values[name]
+        node = self.intermediates[name]
+        value = node.compute(*[self.get(dependency) for dependency in node.dependencies])
+        self.computed[name] += 1
+        if self.refcounts[name] > 0:
+            self.values[name] = value
+            for dependency in node.dependencies:
+                self._drop(dependency)
+        return value
+
+    def release(self, consumer):
+        """
+        Drop the references of a consumer that is done
+        :param consumer: consumer name (ignored when not planned)
+        """
+        for name in self.consumers.pop(consumer, ()):
+            self._drop(name)
+
+    @contextmanager
+    def consumer(self, consumer):
+        """
+        Run a consumer: `with scheduler.consumer(name) as get: ...` releases it at the end of the block
+        """
+        try:
+            yield self.get
+        finally:
+            self.release(consumer)
+
+    def reset(self):
+        """
+        Forget every computed value (e.g. when the fibers change) and restore the references of the planned consumers
+        """
+        consumers = self.consumers
+        self.values = dict()
+        self.consumers = dict()
+        self.refcounts = Counter()
+        self.plan(consumers)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Descriptive statistics of per-fiber quantities, computed at once (exact) or accumulated chunk by chunk (streaming).
+"""
+
+import numpy as np
+
+
+class ArraySummary:
+    """
+    Exact statistics of an in-memory array
+    """
+
+    def __init__(self, values):
+        self.values = np.asarray(values)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, len(self.values))
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        return self.values.mean(axis=0)
+
+    @property
+    def std(self):
+        return self.values.std(axis=0)
+
+    @property
+    def median(self):
+        return np.median(self.values, axis=0)
+
+    @property
+    def amax(self):
+        return np.amax(self.values, axis=0)
+
+    @property
+    def amin(self):
+        return np.amin(self.values, axis=0)
+
+
+class RunningStats:
+    """
+    Count, mean, variance (Welford/Chan batch update), min and max of a stream of values
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.amin = None
+        self.amax = None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.count)
+
+    def update(self, values):
+        """
+        Add a batch of values
+        :param values: (n, ...) array
+        """
+        raw = np.asarray(values)
+        values = raw.astype(np.float64, copy=False)
+        n_batch = len(values)
+        if n_batch == 0:
+            return
+        mean_batch = values.mean(axis=0)
+        m2_batch = ((values - mean_batch) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n_batch, mean_batch, m2_batch
+            self.amin, self.amax = raw.min(axis=0), raw.max(axis=0)
+            return
+        total = self.count + n_batch
+        delta = mean_batch - self.mean
+        self.mean = self.mean + delta * n_batch / total
+        self.m2 = self.m2 + m2_batch + delta ** 2 * self.count * n_batch / total
+        self.count = total
+        self.amin = np.minimum(self.amin, raw.min(axis=0))
+        self.amax = np.maximum(self.amax, raw.max(axis=0))
+
+    def merge(self, other):
+        """
+        Combine with the statistics of another stream
+        :param other: RunningStats
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.amin, self.amax = \
+                other.count, other.mean, other.m2, other.amin, other.amax
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / total
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / total
+        self.count = total
+        self.amin = np.minimum(self.amin, other.amin)
+        self.amax = np.maximum(self.amax, other.amax)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+class QuantileSketch:
+    """
+    Bounded-memory quantile estimator.
+
+    Values are kept as weighted centroids; when more than 2 * capacity are stored, they are sorted and merged into
+    capacity groups of equal weight. Quantiles are exact until the first compression and the rank error stays in the
+    order of 1 / capacity afterwards.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.values = np.zeros(0, dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.capacity)
+
+    def update(self, values):
+        """
+        Add a batch of values
+        :param values: array of values
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.values = np.concatenate((self.values, values))
+        self.weights = np.concatenate((self.weights, np.ones(len(values))))
+        if len(self.values) > 2 * self.capacity:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Combine with the sketch of another stream
+        :param other: QuantileSketch
+        """
+        self.values = np.concatenate((self.values, other.values))
+        self.weights = np.concatenate((self.weights, other.weights))
+        if len(self.values) > 2 * self.capacity:
+            self._compress()
+
+    def _compress(self):
+        order = np.argsort(self.values, kind='mergesort')
+        values, weights = self.values[order], self.weights[order]
+        cum = np.cumsum(weights)
+        group = np.minimum(((cum - weights / 2.) / cum[-1] * self.capacity).astype(np.int64), self.capacity - 1)
+        merged_weights = np.bincount(group, weights=weights, minlength=self.capacity)
+        merged_values = np.bincount(group, weights=weights * values, minlength=self.capacity)
+        keep = merged_weights > 0
+        self.values = merged_values[keep] / merged_weights[keep]
+        self.weights = merged_weights[keep]
+
+    def quantile(self, q):
+        """
+        Estimated quantile
+        :param q: quantile, between 0 and 1
+        :return: value
+        """
+        if not len(self.values):
+            return np.nan
+        order = np.argsort(self.values, kind='mergesort')
+        values, weights = self.values[order], self.weights[order]
+        cum = np.cumsum(weights)
+        return np.interp(q * cum[-1], cum - weights / 2., values)
+
+    @property
+    def median(self):
+        return self.quantile(.5)
+
+
+class StreamingSummary:
+    """
+    Same interface as ArraySummary, accumulated chunk by chunk in bounded memory
+    """
+
+    def __init__(self, capacity=4096):
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch(capacity)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.count)
+
+    def update(self, values):
+        values = np.asarray(values)
+        self.stats.update(values)
+        if values.ndim == 1:
+            self.sketch.update(values)
+
+    @property
+    def count(self):
+        return self.stats.count
+
+    @property
+    def mean(self):
+        return self.stats.mean
+
+    @property
+    def std(self):
+        return self.stats.std
+
+    @property
+    def median(self):
+        return self.sketch.median
+
+    @property
+    def amax(self):
+        return self.stats.amax
+
+    @property
+    def amin(self):
+        return self.stats.amin
+
+
+BOOTSTRAP_STATISTICS = {'mean': lambda v: v.mean(axis=1), 'std': lambda v: v.std(axis=1),
+                        'median': lambda v: np.median(v, axis=1), 'amax': lambda v: v.max(axis=1),
+                        'amin': lambda v: v.min(axis=1)}
+BOOTSTRAP_BLOCK = 1 << 22
+
+
+def bootstrap_intervals(values, n_resamples=1000, confidence=.95, rng=None, statistics=BOOTSTRAP_STATISTICS):
+    """
+    Percentile bootstrap confidence intervals of summary statistics of per-fiber values
+    :param values: (n,) array
+    :param n_resamples: number of bootstrap samples
+    :param confidence: confidence level
+    :param rng: numpy random Generator, or seed
+    :param statistics: dictionary name -> function reducing a (n_resamples, n) array along axis 1
+    :return: dictionary name -> (low, high)
+    """
+    rng = np.random.default_rng(rng)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n == 0:
+        return {name: (np.nan, np.nan) for name in statistics}
+
+    replicates = {name: [] for name in statistics}
+    batch = max(BOOTSTRAP_BLOCK // n, 1)
+    for start in range(0, n_resamples, batch):
+        sample = values[rng.integers(0, n, size=(min(batch, n_resamples - start), n))]
+        for name, statistic in statistics.items():
+            replicates[name].append(statistic(sample))
+
+    tail = (1 - confidence) / 2. * 100
+    return {name: tuple(float(q) for q in np.percentile(np.concatenate(r), [tail, 100 - tail]))
+            for name, r in replicates.items()}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packed streamline container: all the points of a tractogram in one contiguous buffer.
+"""
+
+import numpy as np
+
+
+def lengths_to_offsets(lengths):
+    """
+    Starting index of every streamline in the packed buffer
+    :param lengths: number of points per streamline
+    :return: offsets
+    """
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths) > 1:
+        np.cumsum(lengths[:-1], out=offsets[1:])
+    return offsets
+
+
+class Streamlines:
+    """
+    Sequence of streamlines stored as a single (N_points, ...) array plus per-streamline offsets and lengths.
+
+    Streamlines are stored back to back, so the offsets are always the cumulative sum of the lengths. Integer
+    indexing returns a view of one streamline, slicing returns a container sharing the same buffer and any other
+    index (boolean mask, index array) gathers the selected streamlines in a new buffer.
+    """
+
+    def __init__(self, data=None, lengths=None):
+        """
+        Object creation operations
+        :param data: packed points, shape (N_points, 3) (or any other common per-point shape)
+        :param lengths: number of points of every streamline, must sum to N_points
+        """
+        if data is None:
+            data = np.zeros((0, 3), dtype=np.float32)
+        data = np.asarray(data)
+        if lengths is None:
+            lengths = [len(data)] if len(data) else []
+        lengths = np.asarray(lengths, dtype=np.int64).ravel()
+        if lengths.sum() != len(data):
+            raise ValueError('Streamline lengths ({}) do not match the number of points ({})'.format(
+                lengths.sum(), len(data)))
+
+        self._data = data
+        self._lengths = lengths
+        self._offsets = None
+
+    @classmethod
+    def from_list(cls, arrays, dtype=None):
+        """
+        Pack a list of per-streamline arrays
+        :param arrays: iterable of (n_i, 3) arrays
+        :param dtype: output data type (default: data type of the inputs)
+        :return: packed streamlines
+        """
+        if isinstance(arrays, cls):
+            return arrays if dtype is None else cls(arrays.data.astype(dtype, copy=False), arrays.lengths)
+        arrays = [np.asarray(a) for a in arrays]
+        if not arrays:
+            return cls(np.zeros((0, 3), dtype=dtype or np.float32), [])
+        lengths = [len(a) for a in arrays]
+        data = np.concatenate(arrays, axis=0)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return cls(data, lengths)
+
+    @classmethod
+    def from_bounds(cls, data, starts, lengths):
+        """
+        Gather streamlines stored as ranges of a larger buffer (e.g. separated by delimiters)
+        :param data: buffer containing the points
+        :param starts: index of the first point of every streamline in the buffer
+        :param lengths: number of points of every streamline
+        :return: packed streamlines
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        shift = np.repeat(starts - lengths_to_offsets(lengths), lengths)
+        return cls(data[np.arange(lengths.sum(), dtype=np.int64) + shift], lengths)
+
+    @classmethod
+    def concatenate(cls, sequences):
+        """
+        Join several packed containers
+        :param sequences: iterable of Streamlines
+        :return: packed streamlines
+        """
+        sequences = list(sequences)
+        if not sequences:
+            return cls()
+        return cls(np.concatenate([s.data for s in sequences], axis=0),
+                   np.concatenate([s.lengths for s in sequences]))
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def lengths(self):
+        return self._lengths
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = lengths_to_offsets(self._lengths)
+        return self._offsets
+
+    @property
+    def ends(self):
+        """
+        Index of the last point of every streamline in the packed buffer
+        """
+        return self.offsets + self._lengths - 1
+
+    @property
+    def common_shape(self):
+        return self._data.shape[1:]
+
+    @property
+    def total_points(self):
+        return len(self._data)
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __iter__(self):
+        data = self._data
+        for start, length in zip(self.offsets.tolist(), self._lengths.tolist()):
+            yield data[start:start + length]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            n = len(self)
+            if index < 0:
+                index += n
+            if not 0 <= index < n:
+                raise IndexError('Streamline index out of range: {}'.format(index))
+            start = self.offsets[index]
+            return self._data[start:start + self._lengths[index]]
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                first = self.offsets[start] if start < len(self) else len(self._data)
+                last = first + self._lengths[start:stop].sum()
+                return self.__class__(self._data[first:last], self._lengths[start:stop])
+            index = np.arange(start, stop, step)
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        return self.__class__.from_bounds(self._data, self.offsets[index], self._lengths[index])
+
+    def __repr__(self):
+        return "{}({} streamlines, {} points)".format(self.__class__.__name__, len(self), self.total_points)
+
+    def point_indices(self, index):
+        """
+        Indices in the packed buffer of all the points of a subset of streamlines
+        :param index: streamline indices
+        :return: point indices, streamline after streamline
+        """
+        lengths = self._lengths[index]
+        shift = np.repeat(self.offsets[index] - lengths_to_offsets(lengths), lengths)
+        return np.arange(lengths.sum(), dtype=np.int64) + shift
+
+    def fiber_ids(self):
+        """
+        Streamline index of every point in the packed buffer
+        :return: (N_points,) array
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), self._lengths)
+
+    def first_points(self):
+        return self._data[self.offsets]
+
+    def last_points(self):
+        return self._data[self.ends]
+
+    def chunks(self, max_points):
+        """
+        Split in consecutive groups of whole streamlines of about max_points points
+        :param max_points: number of points per group (a longer streamline forms a group on its own)
+        :return: generator of Streamlines sharing this buffer
+        """
+        cum = np.cumsum(self._lengths)
+        start = 0
+        while start < len(self):
+            base = cum[start - 1] if start else 0
+            stop = max(int(np.searchsorted(cum, base + max_points, side='right')), start + 1)
+            yield self[start:stop]
+            start = stop
+
+    def copy(self):
+        return self.__class__(self._data.copy(), self._lengths.copy())
+
+    def flip(self, mask):
+        """
+        Reverse in place the point order of the selected streamlines
+        :param mask: boolean array, one value per streamline
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            return
+        index = np.flatnonzero(mask)
+        points = self.point_indices(index)
+        lengths = self._lengths[index]
+        position = points - np.repeat(self.offsets[index], lengths)
+        reversed_points = np.repeat(self.ends[index], lengths) - position
+        if not self._data.flags.writeable:
+            self._data = self._data.copy()
+        self._data[points] = self._data[reversed_points]
+
+    def apply(self, func):
+        """
+        Map a point-wise function on the packed buffer
+        :param func: function taking and returning a (N_points, ...) array
+        :return: new streamlines with the same lengths
+        """
+        return self.__class__(func(self._data), self._lengths)
+
+
+def as_streamlines(value):
+    """
+    Convert any sequence of streamlines to the packed container
+    :param value: Streamlines, nibabel ArraySequence or list of arrays
+    :return: Streamlines
+    """
+    if isinstance(value, Streamlines):
+        return value
+    if hasattr(value, '_data') and hasattr(value, '_offsets') and hasattr(value, '_lengths'):
+        if hasattr(value, 'is_sliced_view') and not value.is_sliced_view and \
+                np.array_equal(value._offsets, lengths_to_offsets(value._lengths)):
+            return Streamlines(value._data[:int(np.sum(value._lengths))], value._lengths)
+    return Streamlines.from_list(value)
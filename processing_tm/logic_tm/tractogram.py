@@ -8,58 +8,95 @@ Tractogram specific operation and data encapsulation.
 from __future__ import division
 
 import sys
+from collections import OrderedDict
 
 import numpy as np
-from dipy.tracking.streamlinespeed import compress_streamlines
-from dipy.tracking.streamline import set_number_of_points, values_from_volume
-from dipy.tracking.metrics import midpoint, winding
-from nibabel.affines import apply_affine
-
-
-def get_centroid(tract, affine):
-    tract = [set_number_of_points(s, len(tract[0])) for s in tract]
-    central_line = []
-    for i in range(len(tract[0])):
-        x, y, z = (0.0, 0.0, 0.0)
-        for s in tract:
-            x, y, z = (n + s[i][j] for j, n in enumerate((x, y, z)))
-        x, y, z = (n / len(tract) for n in (x, y, z))
-        central_line.append([x, y, z])
-    central_line = np.array(central_line)
-    inverse = np.linalg.inv(affine)
-    central_line_vox = [apply_affine(inverse, np.array(s)) for s in central_line]
+
+from . import geometry
+from .interpolation import sample_volumes
+from .sampling import subsample_indices
+from .scheduler import Intermediate, Scheduler
+from .streamlines import Streamlines, as_streamlines
+from .utils import affine_key, inverse_affine, transform_points, LazyModule
+
+streamlinespeed = LazyModule('dipy.tracking.streamlinespeed', 'to resample or compress the streamlines')
+
+VOXEL_CACHE_BYTES = 1 << 30
+
+
+def get_centroid(tract, affine, flips=None):
+    """
+    Average streamline, oriented from top to bottom in voxel space
+    :param tract: packed streamlines
+    :param affine: affine matrix
+    :param flips: boolean array of streamlines to reverse before averaging
+    :return: (n, 3) central line, n being the number of points of the first streamline
+    """
+    tract = as_streamlines(tract)
+    central_line = geometry.mean_streamline(tract, max(int(tract.lengths[0]), 2), flips)
+    return orient_centroid(central_line, affine)
+
+
+def orient_centroid(central_line, affine):
+    """
+    Reverse the central line if it goes upward in voxel space
+    :param central_line: (n, 3) central line
+    :param affine: affine matrix
+    :return: oriented central line
+    """
+    central_line_vox = transform_points(central_line, inverse_affine(affine))
     if central_line_vox[0][2] < central_line_vox[-1][2]:
         return central_line[::-1]
 
     return central_line
 
 
-def get_shortest(tract):
-    return ((((tract[0] - tract[-1]) ** 2).sum()) ** .5).sum()
+def resample_streamlines(streamlines, perc):
+    """
+    Reduction of streamlines number of points
+    :param streamlines: packed streamlines
+    :param perc: resampling percentage
+    :return: resampled streamlines
+    """
+    return Streamlines.from_list([streamlinespeed.set_number_of_points(s, max(int(len(s) * perc / 100.), 2))
+                                  for s in streamlines])
 
 
-def get_length(tract):
+def get_windings(streamlines):
     """
-    Compute streamline length
-    :param tract: streamline
-    :return: length
+    Turning angle of every streamline (see geometry.windings)
+    :param streamlines: packed streamlines
+    :return: (n_lines,) angles (degrees)
     """
-    return ((((tract[1:] - tract[:-1]) ** 2).sum(1)) ** .5).sum()
+    return geometry.windings(streamlines)
 
 
 def streamlines_mapvolume(streamlines, volume, affine):
     """
     Map tractograms on volumetric image
     :param streamlines: tractogram
-    :param volume: image
+    :param volume: image, or list of images sharing the same grid
     :param affine: affine matrix
-    :return: tractogram with mapping
+    :return: values mapped on the packed points, (N_points,) for one image or (N_points, n_images)
     """
-    inverse = np.linalg.inv(affine)
-    streamlines = [apply_affine(inverse, np.array(s)) for s in streamlines]
-    mapping = values_from_volume(volume, streamlines, np.eye(4))
+    values, _ = streamlines_mapvolumes(streamlines, volume if isinstance(volume, (list, tuple)) else [volume], affine)
+    return values if isinstance(volume, (list, tuple)) else values[:, 0]
 
-    return mapping
+
+def streamlines_mapvolumes(streamlines, volumes, affine, points_vox=None, origin=None):
+    """
+    Map tractograms on several volumetric images sharing the same grid: voxel coordinates and interpolation weights
+    are computed once for all the images
+    :param streamlines: tractogram
+    :param volumes: list of images
+    :param affine: affine matrix shared by the images
+    :param points_vox: precomputed voxel coordinates of the packed points
+    :param origin: voxel of the full images stored first in the volumes, when they are cropped
+    :return: (N_points, n_images) values, (N_points,) sum of the interpolation weights inside the grid
+    """
+    if points_vox is None:
+        points_vox = transform_points(as_streamlines(streamlines).data, inverse_affine(affine))
+    return sample_volumes(points_vox, volumes, origin=origin)
 
 
 class Tracts:
@@ -67,14 +104,20 @@ class Tracts:
     Tractogram encapsulation
     """
 
-    def __init__(self, tractogram, header=None):
+    def __init__(self, tractogram, header=None, voxel_cache_bytes=VOXEL_CACHE_BYTES):
         """
         Object creation operations
-        :param tractogram: streamlines
+        :param tractogram: streamlines (packed container or list of arrays)
         :param header: header (if input not in vtk)
+        :param voxel_cache_bytes: memory allowed to the voxel coordinates cache
         """
+        self.voxel_cache_bytes = voxel_cache_bytes
+        self.intermediates = Scheduler(self.fiber_intermediates())
         self.tractogram = tractogram
         self.header = header
+        self.n_lines_total = None
+        # indices of the streamlines kept by subsample in the input tractogram (None when all are kept)
+        self.kept = None
 
     @property
     def tractogram(self):
@@ -85,7 +128,10 @@ class Tracts:
         if len(value) == 0:
             sys.exit(1)
 
-        self._tractogram = value
+        self._tractogram = as_streamlines(value)
+        self._orientation = None
+        self._voxel_cache = OrderedDict()
+        self.intermediates.reset()
 
     def __repr__(self):
         return "{}({},{})".format(self.__class__.__name__, self.tractogram, self.header)
@@ -98,31 +144,56 @@ class Tracts:
         Reduction of streamlines number of points
         :param perc: resampling percentage
         """
-        self.tractogram = [set_number_of_points(s, max(int(len(s) * perc / 100.), 2)) for s in self.tractogram]
+        self.tractogram = resample_streamlines(self.tractogram, perc)
 
     def compress(self):
-        self.tractogram = compress_streamlines(self.tractogram)
+        self.tractogram = Streamlines.from_list(streamlinespeed.compress_streamlines(list(self.tractogram)))
+
+    def subsample(self, count=None, fraction=None, stratify=False, seed=None):
+        """
+        Reduction of the number of streamlines: keep a random subset, in the original order
+        :param count: number of streamlines to keep
+        :param fraction: fraction of streamlines to keep (used when count is None)
+        :param stratify: draw in every length decile proportionally to its size
+        :param seed: random seed, for reproducible subsets
+        """
+        n_lines = len(self.tractogram)
+        strata_values = geometry.lengths(self.tractogram) if stratify else None
+        index = subsample_indices(n_lines, count, fraction, strata_values, rng=seed)
+        if len(index) < n_lines:
+            self.tractogram = self.tractogram[index]
+            self.kept = index if self.kept is None else self.kept[index]
+        self.n_lines_total = n_lines
+
+    def original_ids(self):
+        """
+        Index of every streamline in the input tractogram
+        :return: (n_lines,) array
+        """
+        if self.kept is None:
+            return np.arange(len(self.tractogram), dtype=np.int64)
+        return self.kept
 
     def sort(self, affine):
         """
-        Reorient fiber in the same direction
-        """
-
-        template = self.tractogram[0]
-        initial_flip = []
-        for i, s in enumerate(self.tractogram):
-            dist_norm = np.linalg.norm(s[0] - template[0]) + np.linalg.norm(s[-1] - template[-1])
-            dist_flipped = np.linalg.norm(s[-1] - template[0]) + np.linalg.norm(s[0] - template[-1])
-            if dist_flipped < dist_norm:
-                initial_flip.append(s[::-1])
-            else:
-                initial_flip.append(s)
-        template = get_centroid(initial_flip, affine)
-        for i, s in enumerate(self.tractogram):
-            dist_norm = np.linalg.norm(s[0] - template[0]) + np.linalg.norm(s[-1] - template[-1])
-            dist_flipped = np.linalg.norm(s[-1] - template[0]) + np.linalg.norm(s[0] - template[-1])
-            if dist_flipped < dist_norm:
-                self.tractogram[i] = s[::-1]
+        Reorient fiber in the same direction. The orientation is cached: sorting again with the same affine is free.
+        :param affine: affine matrix of the reference image
+        """
+        key = affine_key(affine)
+        if self._orientation == key:
+            return
+
+        first, last = self.tractogram.first_points(), self.tractogram.last_points()
+        initial_flip = geometry.endpoint_flips(first, last, first[0], last[0])
+        template = get_centroid(self.tractogram, affine, initial_flip)
+        to_flip = geometry.endpoint_flips(first, last, template[0], template[-1])
+        self.tractogram.flip(to_flip)
+        for points_vox in self._voxel_cache.values():
+            Streamlines(points_vox, self.tractogram.lengths).flip(to_flip)
+        if np.any(to_flip):
+            self.intermediates.reset()
+
+        self._orientation = key
 
     def n_lines(self):
         """
@@ -132,43 +203,228 @@ class Tracts:
         return len(self.tractogram)
 
     def n_points(self):
-        points = [len(s) for s in self.tractogram]
-        return points
+        return self.tractogram.lengths
 
     def extremities(self):
         """
         Get streamline endpoints
-        :return: tractogram composed only by the extremities
+        :return: (n_lines, 2, 3) array of first and last points
         """
-        extremities = [np.array([s[0], s[-1]], s[0].dtype) for s in self.tractogram]
-        return extremities
+        return geometry.extremities(self.tractogram)
 
     def lengths(self):
         """
         Get tractogram streamline lengths
         :return: tractogram composed by lengths
         """
-        tracts_lengths = [get_length(s) for s in self.tractogram]
-        return tracts_lengths
+        return geometry.lengths(self.tractogram)
 
     def shortest(self):
-        tracts_shortest = [get_shortest(s) for s in self.tractogram]
-        return tracts_shortest
+        return geometry.shortest(self.tractogram)
+
+    def fiber_intermediates(self):
+        """
+        Intermediates shared by the per-fiber metrics (see Metrics.plan)
+        :return: list of Intermediate
+        """
+        return [Intermediate('segment_vectors', lambda: geometry.padded_segment_vectors(self.tractogram)),
+                Intermediate('segment_lengths',
+                             lambda vectors: geometry.padded_segment_lengths(self.tractogram, vectors),
+                             ['segment_vectors']),
+                Intermediate('arc_lengths', geometry.arc_lengths, ['segment_lengths']),
+                Intermediate('cumulative_lengths', lambda arc: geometry.cumulative_lengths(self.tractogram, arc=arc),
+                             ['arc_lengths'])]
+
+    def geometric_features(self):
+        """
+        Batched computation of lengths, shortest paths, midpoints and endpoints
+        :return: dictionary of per-fiber arrays
+        """
+        return geometry.geometric_features(self.tractogram, self.intermediates.get('segment_lengths'),
+                                           self.intermediates.get('arc_lengths'))
 
     def mapping(self, volume, affine):
         """
         Get tractogram mapping
         :param volume: volume to be mapped on
         :param affine: affine matrix
-        :return: mapped tractogram
+        :return: values mapped on the packed points
         """
         mapped = streamlines_mapvolume(self.tractogram, volume, affine)
         return mapped
 
+    def mapping_multi(self, volumes, affine, origin=None):
+        """
+        Get tractogram mapping on several volumes sharing the same grid, in a single pass
+        :param volumes: list of volumes
+        :param affine: affine matrix
+        :param origin: voxel of the full images stored first in the volumes, when they are cropped
+        :return: (N_points, n_volumes) values, (N_points,) sum of the interpolation weights inside the grid
+        """
+        return streamlines_mapvolumes(self.tractogram, volumes, affine, self.voxel_points(affine), origin)
+
+    def voxel_bounds(self, affine):
+        """
+        Bounding box of the tractogram in the voxel space of an image
+        :param affine: affine matrix of the image
+        :return: min, max voxel coordinates
+        """
+        points_vox = self.voxel_points(affine)
+        return points_vox.min(axis=0), points_vox.max(axis=0)
+
+    def voxel_points(self, affine):
+        """
+        Packed points in the voxel space of an image. Results are cached by affine (least recently used entries are
+        evicted beyond voxel_cache_bytes) and kept consistent when fibers are reoriented.
+        :param affine: affine matrix of the image
+        :return: (N_points, 3) voxel coordinates
+        """
+        key = affine_key(affine)
+        if key in self._voxel_cache:
+            self._voxel_cache.move_to_end(key)
+            return self._voxel_cache[key]
+
+        points_vox = transform_points(self.tractogram.data, inverse_affine(affine))
+        if points_vox.nbytes <= self.voxel_cache_bytes:
+            self._voxel_cache[key] = points_vox
+            while sum(p.nbytes for p in self._voxel_cache.values()) > self.voxel_cache_bytes:
+                self._voxel_cache.popitem(last=False)
+        return points_vox
+
+    def release_voxel_points(self, affine):
+        """
+        Free the cached voxel coordinates of an image once its maps are sampled
+        :param affine: affine matrix of the image
+        """
+        self._voxel_cache.pop(affine_key(affine), None)
+
     def get_midpoints(self):
-        midpoints = [midpoint(s) for s in self.tractogram]
-        return midpoints
+        return geometry.midpoints(self.tractogram)
 
     def get_winding(self):
-        windings = [winding(s) for s in self.tractogram]
-        return windings
+        return get_windings(self.tractogram)
+
+
+class TractStream:
+    """
+    Out-of-core tractogram: the streamlines are read again, chunk by chunk, at every pass
+    """
+
+    def __init__(self, chunks, header=None):
+        """
+        Object creation operations
+        :param chunks: callable returning a new iterator of packed streamlines at every call
+        :param header: header (if input not in vtk)
+        """
+        self._chunks = chunks
+        self.header = header
+        self._perc = None
+        self._subsample = None
+        self._template = None
+        self._orientation = None
+        self.n_lines_total = None
+
+    def __repr__(self):
+        return "{}({},{})".format(self.__class__.__name__, self._chunks, self.header)
+
+    def __str__(self):
+        return "{}({},{})".format(self.__class__.__name__, 'Tractogram stream', 'Header')
+
+    def chunks(self, with_ids=False):
+        """
+        Iterate over the tractogram, resampled and oriented like Tracts would be
+        :param with_ids: also give the index of every streamline of the chunk in the input tractogram
+        :return: generator of packed streamlines, or of (indices, packed streamlines) with_ids
+        """
+        start = 0
+        for i, chunk in enumerate(self._chunks()):
+            ids = np.arange(start, start + len(chunk), dtype=np.int64)
+            start += len(chunk)
+            if not len(chunk):
+                continue
+            if self._subsample is not None:
+                fraction, stratify, seed = self._subsample
+                strata_values = geometry.lengths(chunk) if stratify else None
+                rng = np.random.default_rng(None if seed is None else [seed, i])
+                index = subsample_indices(len(chunk), fraction=fraction, strata_values=strata_values, rng=rng)
+                chunk, ids = chunk[index], ids[index]
+            if self._perc:
+                chunk = resample_streamlines(chunk, self._perc)
+            if self._template is not None:
+                to_flip = geometry.endpoint_flips(chunk.first_points(), chunk.last_points(),
+                                                  self._template[0], self._template[-1])
+                if to_flip.any():
+                    chunk = chunk.copy()
+                    chunk.flip(to_flip)
+            yield (ids, chunk) if with_ids else chunk
+
+    def voxel_bounds(self, affine):
+        """
+        Bounding box of the tractogram in the voxel space of an image (one pass over the chunks)
+        :param affine: affine matrix of the image
+        :return: min, max voxel coordinates
+        """
+        inverse = inverse_affine(affine)
+        lower, upper = np.full(3, np.inf), np.full(3, -np.inf)
+        for chunk in self.chunks():
+            points_vox = transform_points(chunk.data, inverse)
+            lower, upper = np.minimum(lower, points_vox.min(axis=0)), np.maximum(upper, points_vox.max(axis=0))
+        return lower, upper
+
+    def resample(self, perc):
+        """
+        Reduction of streamlines number of points, applied to every chunk
+        :param perc: resampling percentage
+        """
+        self._perc = perc
+        self._template = None
+        self._orientation = None
+
+    def subsample(self, count=None, fraction=None, stratify=False, seed=None):
+        """
+        Reduction of the number of streamlines, applied to every chunk with the same fraction (a count is turned into a
+        fraction with one counting pass). Chunks are seeded with (seed, chunk index), so the subset is reproducible
+        for a given chunk size.
+        :param count: number of streamlines to keep
+        :param fraction: fraction of streamlines to keep (used when count is None)
+        :param stratify: draw in every length decile of the chunk proportionally to its size
+        :param seed: random seed
+        """
+        self._subsample = None
+        self.n_lines_total = sum(len(chunk) for chunk in self._chunks())
+        if count is not None:
+            fraction = min(float(count) / max(self.n_lines_total, 1), 1.)
+        if seed is None:
+            # every pass over the chunks must draw the same subset
+            seed = np.random.SeedSequence().entropy
+        self._subsample = (fraction, stratify, seed)
+        self._template = None
+        self._orientation = None
+
+    def sort(self, affine):
+        """
+        Reorient fiber in the same direction: one pass to build the centroid, the flips are then applied to every
+        chunk read afterwards
+        :param affine: affine matrix of the reference image
+        """
+        key = affine_key(affine)
+        if self._orientation == key:
+            return
+
+        self._template = None
+        first_fiber = None
+        total = None
+        count = 0
+        for chunk in self.chunks():
+            first, last = chunk.first_points(), chunk.last_points()
+            if first_fiber is None:
+                first_fiber = (first[0].copy(), last[0].copy(), max(int(chunk.lengths[0]), 2))
+                total = np.zeros((first_fiber[2], 3), dtype=np.float64)
+            flips = geometry.endpoint_flips(first, last, first_fiber[0], first_fiber[1])
+            total += geometry.mean_streamline(chunk, first_fiber[2], flips) * len(chunk)
+            count += len(chunk)
+        if not count:
+            sys.exit(1)
+
+        self._template = orient_centroid(total / count, affine)
+        self._orientation = key
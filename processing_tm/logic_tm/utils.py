@@ -1,10 +1,93 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import importlib
+from functools import lru_cache
+
 import numpy as np
-from nibabel.affines import apply_affine
+
+HASH_BLOCK = 1 << 20
+
+
+class LazyModule:
+    """
+    Module imported on first attribute access, so that the heavy dependencies (vtk, dipy, nibabel, xlsxwriter) only
+    slow down the code paths using them
+    """
+
+    def __init__(self, name, purpose=''):
+        """
+        Object creation operations
+        :param name: module name
+        :param purpose: what the module is needed for, e.g. 'to read .vtk tractograms' (error message)
+        """
+        self._name = name
+        self._purpose = purpose
+        self._module = None
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self._name,
+                                   'imported' if self._module is not None else 'not imported')
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as e:
+                raise ImportError('{} is required {}: {}'.format(self._name.split('.')[0], self._purpose, e))
+        return getattr(self._module, attr)
+
+
+def affine_key(affine):
+    """
+    Hashable identifier of an affine matrix
+    :param affine: affine matrix
+    :return: bytes
+    """
+    return np.asarray(affine, dtype=np.float64).tobytes()
+
+
+@lru_cache(maxsize=32)
+def _inverse(key):
+    inverse = np.linalg.inv(np.frombuffer(key, dtype=np.float64).reshape(4, 4))
+    inverse.flags.writeable = False
+    return inverse
+
+
+def inverse_affine(affine):
+    """
+    Inverse of an affine matrix, computed once per matrix
+    :param affine: (4, 4) affine matrix
+    :return: read-only inverse
+    """
+    return _inverse(affine_key(affine))
+
+
+def transform_points(points, affine):
+    """
+    Batched homogeneous transform of a point buffer
+    :param points: (N, 3) array
+    :param affine: (4, 4) affine matrix
+    :return: (N, 3) float64 array
+    """
+    points = np.asarray(points, dtype=np.float64)
+    return points @ affine[:3, :3].T + affine[:3, 3]
 
 
 def ras_to_ijk(point, affine):
-    inverse = np.linalg.inv(affine)
-    return apply_affine(inverse, np.array(point))
+    return transform_points(np.atleast_2d(point), inverse_affine(affine)).reshape(np.shape(point))
+
+
+def file_digest(fname, block=HASH_BLOCK):
+    """
+    SHA-256 of the content of a file
+    :param fname: filename
+    :param block: read size
+    :return: hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as handle:
+        for data in iter(lambda: handle.read(block), b''):
+            digest.update(data)
+    return digest.hexdigest()
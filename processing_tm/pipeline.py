@@ -2,86 +2,416 @@
 # -*- coding: utf-8 -*-
 
 import processing_tm.logic_tm as lg
+from processing_tm.logic_tm.utils import LazyModule
+from processing_tm.profiling import NullProfiler
 import numpy as np
 import csv
-import xlsxwriter
 from six import iteritems
 
+xlsxwriter = LazyModule('xlsxwriter', 'to write Excel files')
 
-def proc(tractogram_filepath, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv, to_xlsx,
-         perc_resampling, from_plugin=False):
-    tractogram = load_tracts(tractogram_filepath)
+CHUNK_POINTS = 1 << 20
+SKETCH_CAPACITY = 4096
 
-    if from_plugin:
+
+def proc(tractogram_filepath, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv, to_xlsx,
+         perc_resampling, from_plugin=False, n_bins=20, streaming=False, chunk_size=CHUNK_POINTS, jobs=1,
+         backend='process', cache=None, sidecar=None, profiler=None, subsample=None, stratify=False, seed=None,
+         n_bootstrap=0, confidence=.95, fiber_table=None, metrics=None, data_cache=None, progress=None):
+    if from_plugin and isinstance(txt_filepath, bytes):
         txt_filepath = txt_filepath.decode()
+    profiler = profiler or NullProfiler()
 
-    if perc_resampling:
-        tractogram.resample(perc_resampling)
+    report, behaviors = compute(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath,
+                                perc_resampling, n_bins=n_bins, streaming=streaming, chunk_size=chunk_size,
+                                jobs=jobs, backend=backend, cache=cache, sidecar=sidecar,
+                                profiler=profiler, subsample=subsample, stratify=stratify, seed=seed,
+                                n_bootstrap=n_bootstrap, confidence=confidence, fiber_table=fiber_table,
+                                metrics=metrics, data_cache=data_cache, progress=progress)
+    csv_filepath = save_report(report, txt_filepath, header, to_csv, to_xlsx, profiler)
 
-    metrics = lg.Metrics(tractogram)
-    behaviors = dict()
-    if fa_filepath:
-        fa, affine = lg.load_nii(fa_filepath)
-        metrics.set_affine(affine)
-        tractogram.sort(affine)
-        behaviors['FA'] = metrics.diffusion(fa, 'FA')
-    if bzero_filepath:
-        bzero, affine = lg.load_nii(bzero_filepath)
-        metrics.set_affine(affine)
-        if not fa_filepath:
-            tractogram.sort(affine)
-        behaviors['b-zero'] = metrics.diffusion(bzero, 'b-zero')
-    if md_filepath:
-        md, affine = lg.load_nii(md_filepath)
-        metrics.set_affine(affine)
-        if not fa_filepath or bzero_filepath:
-            tractogram.sort(affine)
-        behaviors['MD'] = metrics.diffusion(md, 'MD')
+    if from_plugin:
+        if not to_csv:
+            csv_filepath = from_plugin['csv_fname']
+            with profiler.stage('write_csv'):
+                save_csv(csv_filepath, report.to_dict())
+        return csv_filepath, behaviors
 
-    metrics.geometric()
 
-    body = metrics.get_str()
-    body_dict = metrics.get_dict()
+def save_report(report, txt_filepath, header, to_csv, to_xlsx, profiler=None):
+    """
+    Write a report as text, and optionally as CSV and Excel files next to it
+    :param report: logic_tm.report.Report
+    :param txt_filepath: text report filename
+    :param header: first line of the text and Excel files (default: the text filename)
+    :param to_csv: also write <name>.csv
+    :param to_xlsx: also write <name>.xlsx
+    :param profiler: processing_tm.profiling.Profiler recording the stages (None to disable)
+    :return: CSV filename (None when not written)
+    """
+    profiler = profiler or NullProfiler()
+    body, body_dict = report.to_text(), report.to_dict()
 
     if not header:
         header = txt_filepath
 
-    save_txt(txt_filepath, body, header)
+    with profiler.stage('write_txt'):
+        save_txt(txt_filepath, body, header)
 
     if to_xlsx:
         xlsx_filepath = txt_filepath.split('.')[0] + '.xlsx'
-        save_xlsx(xlsx_filepath, body_dict, header)
+        with profiler.stage('write_xlsx'):
+            save_xlsx(xlsx_filepath, body_dict, header)
 
+    csv_filepath = None
     if to_csv:
         csv_filepath = txt_filepath.split('.')[0] + '.csv'
-        save_csv(csv_filepath, body_dict)
-    else:
-        if from_plugin:
-            csv_filepath = from_plugin['csv_fname']
+        with profiler.stage('write_csv'):
             save_csv(csv_filepath, body_dict)
+    return csv_filepath
 
-    if from_plugin:
-        return csv_filepath, behaviors
+
+def compute(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, perc_resampling=None, n_bins=20,
+            streaming=False, chunk_size=CHUNK_POINTS, jobs=1, backend='process', cache=None, sidecar=None,
+            profiler=None, subsample=None, stratify=False, seed=None, n_bootstrap=0, confidence=.95, fiber_table=None,
+            metrics=None, data_cache=None, progress=None):
+    """
+    Compute the metrics of one tractogram, or fetch them from the result cache
+    :param cache: ResultCache (None to always compute; not used when a per-fiber table is exported, nor for a random
+    subset or bootstrap without seed, which must be drawn again on every run)
+    :param profiler: processing_tm.profiling.Profiler recording the stages (None to disable)
+    :param data_cache: in-memory cache of the parsed inputs of a resident process (cache.DataCache, None to disable)
+    :param progress: processing_tm.progress.Progress reporting the stages and cancelling the computation (None to
+    disable)
+    :return: report (logic_tm.report.Report), along-tract profiles
+    """
+    profiler = profiler or NullProfiler()
+    sampling = dict(subsample=subsample, stratify=stratify, seed=seed, n_bootstrap=n_bootstrap, confidence=confidence)
+    if cache is None or fiber_table or ((subsample or n_bootstrap) and seed is None):
+        return compute_metrics(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, perc_resampling, n_bins,
+                               streaming, chunk_size, jobs, backend, sidecar, profiler, fiber_table=fiber_table,
+                               metrics=metrics, data_cache=data_cache, progress=progress, **sampling)
+
+    params = {'perc_resampling': perc_resampling, 'n_bins': n_bins, 'streaming': streaming,
+              'chunk_size': chunk_size if streaming else None,
+              'sketch_capacity': SKETCH_CAPACITY if streaming else None,
+              'metrics': sorted(lg.select_metrics(metrics))}
+    if subsample or n_bootstrap:
+        params.update(sampling)
+    with profiler.stage('cache_lookup'):
+        key = cache.key([tractogram_filepath, fa_filepath, bzero_filepath, md_filepath], params)
+        result = cache.get(key)
+    if result is None:
+        result = compute_metrics(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, perc_resampling,
+                                 n_bins, streaming, chunk_size, jobs, backend, sidecar, profiler, metrics=metrics,
+                                 data_cache=data_cache, progress=progress, **sampling)
+        with profiler.stage('cache_store'):
+            cache.put(key, result)
+    return result
+
+
+def compute_metrics(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, perc_resampling=None, n_bins=20,
+                    streaming=False, chunk_size=CHUNK_POINTS, jobs=1, backend='process', sidecar=None, profiler=None,
+                    subsample=None, stratify=False, seed=None, n_bootstrap=0, confidence=.95, fiber_table=None,
+                    metrics=None, data_cache=None, progress=None):
+    """
+    Compute the metrics of one tractogram without writing any report
+    :param tractogram_filepath: tractogram filename
+    :param fa_filepath: FA map filename (or None)
+    :param bzero_filepath: b-zero map filename (or None)
+    :param md_filepath: MD map filename (or None)
+    :param perc_resampling: percentage of the points of every fiber kept by the resampling (None to disable)
+    :param n_bins: number of fiber portions of the along-tract profiles
+    :param streaming: accumulate the statistics chunk by chunk
+    :param chunk_size: number of points per chunk in streaming mode
+    :param jobs: number of workers of the per-streamline kernels
+    :param backend: 'process' or 'thread' workers
+    :param sidecar: binary sidecar of the parsed tractogram (see load_tracts)
+    :param profiler: processing_tm.profiling.Profiler recording the stages (None to disable)
+    :param subsample: number (int) or fraction (float) of streamlines to keep, drawn at random (None to keep all)
+    :param stratify: draw the subset in every fiber length decile proportionally to its size
+    :param seed: random seed of the subset and of the bootstrap
+    :param n_bootstrap: number of bootstrap resamples of the confidence intervals (0 to disable)
+    :param confidence: confidence level of the intervals
+    :param fiber_table: filename of the per-fiber table (.npz, .parquet or .feather, see logic_tm.FiberTable; None to
+    skip it)
+    :param metrics: metrics to compute, e.g. 'lengths,endpoints,FA' (see logic_tm.metrics.select_metrics; None for
+    every metric); the maps given but not selected are only used as reference grid
+    :param data_cache: in-memory cache of the parsed inputs of a resident process (cache.DataCache, None to disable)
+    :param progress: processing_tm.progress.Progress reporting the stages and the chunks of the parallel kernels, and
+    cancelling the computation between them (None to disable)
+    :return: report (logic_tm.report.Report), along-tract profiles
+    """
+    profiler = profiler or NullProfiler()
+    scalar_maps = []
+    for scalar_name, filepath in (('FA', fa_filepath), ('b-zero', bzero_filepath), ('MD', md_filepath)):
+        if filepath:
+            affine, shape = lg.nii_grid(filepath)
+            scalar_maps.append((scalar_name, filepath, affine, shape))
+    if progress is not None:
+        profiler = progress.track(profiler, count_stages(scalar_maps, perc_resampling, subsample, fiber_table, metrics))
+
+    with profiler.stage('load') as record:
+        if streaming:
+            tractogram = stream_tracts(tractogram_filepath, chunk_size, sidecar, data_cache)
+        else:
+            tractogram = load_tracts(tractogram_filepath, sidecar, data_cache)
+        set_counts(profiler, record, tractogram)
+
+    def load_volume(filepath, bbox, with_range):
+        return load_nii(filepath, bbox, with_range=with_range, data_cache=data_cache)
+
+    return compute_tracts(tractogram, scalar_maps, load_volume, perc_resampling, n_bins, streaming, jobs, backend,
+                          profiler, subsample, stratify, seed, n_bootstrap, confidence, fiber_table, metrics, progress)
+
+
+def compute_in_memory(tractogram, volumes, perc_resampling=None, n_bins=20, jobs=1, backend='process', profiler=None,
+                      subsample=None, stratify=False, seed=None, n_bootstrap=0, confidence=.95, fiber_table=None,
+                      metrics=None, progress=None):
+    """
+    Compute the metrics of a tractogram and of volumes already in memory (e.g. Slicer nodes), without any file
+    :param tractogram: vtkPolyData of polylines, logic_tm.Streamlines or list of (n, 3) arrays, in RAS coordinates
+    (copied: the fibers are reoriented in place)
+    :param volumes: dictionary map name ('FA', 'b-zero', 'MD') -> (voxel array in IJK order, IJK to RAS matrix)
+    :param profiler: processing_tm.profiling.Profiler recording the stages (None to disable)
+    :param progress: processing_tm.progress.Progress (see compute_metrics; None to disable)
+    :return: report (logic_tm.report.Report), along-tract profiles
+    """
+    profiler = profiler or NullProfiler()
+    scalar_maps = []
+    for scalar_name in ('FA', 'b-zero', 'MD'):
+        if volumes.get(scalar_name) is not None:
+            data, affine = volumes[scalar_name]
+            affine = np.asarray(affine, dtype=np.float64)
+            scalar_maps.append((scalar_name, (np.asarray(data), affine), affine, np.shape(data)[:3]))
+    if progress is not None:
+        profiler = progress.track(profiler, count_stages(scalar_maps, perc_resampling, subsample, fiber_table, metrics))
+
+    with profiler.stage('load') as record:
+        if hasattr(tractogram, 'GetLines'):
+            tractogram = lg.input_output.vtkpolydata_to_tracts(tractogram)[0]
+        tractogram = lg.Tracts(lg.streamlines.as_streamlines(tractogram).copy())
+        set_counts(profiler, record, tractogram)
+
+    def load_volume(source, bbox, with_range):
+        data, affine = crop_volume(source[0], source[1], bbox)
+        data = np.asarray(data, dtype=np.float32)
+        if with_range:
+            return data, affine, (float(np.min(source[0])), float(np.max(source[0])))
+        return data, affine
+
+    return compute_tracts(tractogram, scalar_maps, load_volume, perc_resampling, n_bins, False, jobs, backend,
+                          profiler, subsample, stratify, seed, n_bootstrap, confidence, fiber_table, metrics, progress)
+
+
+def compute_tracts(tractogram, scalar_maps, load_volume, perc_resampling=None, n_bins=20, streaming=False, jobs=1,
+                   backend='process', profiler=None, subsample=None, stratify=False, seed=None, n_bootstrap=0,
+                   confidence=.95, fiber_table=None, metrics=None, progress=None):
+    """
+    Compute the metrics of a loaded tractogram (see compute_metrics for the parameters)
+    :param tractogram: Tracts or TractStream
+    :param scalar_maps: list of (name, source, affine, shape) of the scalar maps
+    :param load_volume: function (source, bbox, with_range) -> data, affine[, (min, max)], like load_nii
+    :param progress: processing_tm.progress.Progress already tracking the profiler (see count_stages)
+    :return: report (logic_tm.report.Report), along-tract profiles
+    """
+    profiler = profiler or NullProfiler()
+    if subsample:
+        with profiler.stage('subsample') as record:
+            if isinstance(subsample, float):
+                tractogram.subsample(fraction=subsample, stratify=stratify, seed=seed)
+            else:
+                tractogram.subsample(count=subsample, stratify=stratify, seed=seed)
+            set_counts(profiler, record, tractogram)
+
+    if perc_resampling:
+        with profiler.stage('resample') as record:
+            tractogram.resample(perc_resampling)
+            set_counts(profiler, record, tractogram)
+
+    selection = lg.select_metrics(metrics)
+    table = lg.FiberTable(fiber_table) if fiber_table else None
+    if streaming:
+        metrics = lg.StreamingMetrics(tractogram, n_bins=n_bins, sketch_capacity=SKETCH_CAPACITY, jobs=jobs,
+                                      backend=backend, n_bootstrap=n_bootstrap, confidence=confidence, seed=seed,
+                                      fiber_table=table, metrics=selection, progress=progress)
+    else:
+        metrics = lg.Metrics(tractogram, n_bins=n_bins, jobs=jobs, backend=backend, n_bootstrap=n_bootstrap,
+                             confidence=confidence, seed=seed, fiber_table=table, metrics=selection,
+                             progress=progress)
+    metrics.plan([scalar_name for scalar_name, _, _, _ in scalar_maps if scalar_name in selection])
+    behaviors = dict()
+    for affine, shape, group in group_by_grid(scalar_maps):
+        metrics.set_affine(affine)
+        with profiler.stage('sort'):
+            tractogram.sort(affine)
+            lower, upper = lg.crop_bounds(tractogram.voxel_bounds(affine), shape)
+        group = [(scalar_name, source) for scalar_name, source in group if scalar_name in selection]
+        if not group:
+            continue
+        bbox = (lower, upper) if np.all(upper > lower) else None
+        volumes = []
+        for scalar_name, source in group:
+            with profiler.stage('load_nii ' + scalar_name):
+                if scalar_name == 'FA':
+                    volumes.append((scalar_name, load_volume(source, bbox, False)[0]))
+                else:
+                    scalar_map, _, value_range = load_volume(source, bbox, True)
+                    volumes.append((scalar_name, scalar_map, value_range))
+        with profiler.stage('diffusion ' + '+'.join(scalar_name for scalar_name, _ in group)):
+            behaviors.update(metrics.diffusion_maps(volumes, lower if bbox is not None else None))
+        if isinstance(tractogram, lg.Tracts):
+            tractogram.release_voxel_points(affine)
+
+    with profiler.stage('geometric'):
+        metrics.geometric()
+
+    if table is not None:
+        with profiler.stage('write_fibers'):
+            table.save()
+
+    return metrics.get_report(), behaviors
+
+
+def count_stages(scalar_maps, perc_resampling=None, subsample=None, fiber_table=None, metrics=None):
+    """
+    Number of stages run by compute_tracts, load included, for the progress fraction
+    :param scalar_maps: list of (name, source, affine, shape) of the scalar maps
+    :return: number of stages
+    """
+    selection = lg.select_metrics(metrics)
+    n_stages = 2 + bool(subsample) + bool(perc_resampling) + bool(fiber_table)
+    for _, _, group in group_by_grid(scalar_maps):
+        n_selected = sum(scalar_name in selection for scalar_name, _ in group)
+        n_stages += 1 + (n_selected + 1 if n_selected else 0)
+    return n_stages
+
+
+def set_counts(profiler, record, tractogram):
+    """
+    Give the size of an in-memory tractogram to the profiler (unknown in streaming mode)
+    :param profiler: profiler
+    :param record: record of the current stage
+    :param tractogram: Tracts or TractStream
+    """
+    if isinstance(tractogram, lg.Tracts):
+        record['n_lines'], record['n_points'] = tractogram.n_lines(), tractogram.tractogram.total_points
+        profiler.set_counts(record['n_lines'], record['n_points'])
+
+
+def group_by_grid(scalar_maps):
+    """
+    Group the scalar maps sharing the same voxel grid, so that they can be sampled together
+    :param scalar_maps: list of (name, filepath, affine, shape)
+    :return: list of (affine, shape, [(name, filepath), ...]) in order of first appearance
+    """
+    groups = []
+    for scalar_name, filepath, affine, shape in scalar_maps:
+        for group_affine, group_shape, group in groups:
+            if np.allclose(group_affine, affine) and tuple(group_shape) == tuple(shape):
+                group.append((scalar_name, filepath))
+                break
+        else:
+            groups.append((affine, shape, [(scalar_name, filepath)]))
+    return groups
 
 
-def load_tracts(fname):
+def load_tracts(fname, sidecar=None, data_cache=None):
     """
     Tractogram loading manager
     :param fname: tractogram filename
+    :param sidecar: reuse (or write) a memory-mappable binary copy of the parsed tractogram: True to keep it next to
+    the file, or the name of the folder holding the sidecars (None or False to always parse the file)
+    :param data_cache: in-memory cache of the parsed inputs (cache.DataCache): the tractogram is parsed once, and every
+    call gets its own copy of the fibers (the pipeline reorients them in place)
     :return: tractogram class object
     """
+    if data_cache is not None:
+        streamlines, header = data_cache.get('tracts', fname, lambda: tracts_entry(load_tracts(fname, sidecar)))
+        return lg.Tracts(streamlines.copy(), header=header)
+
+    folder = sidecar if isinstance(sidecar, str) else None
+    if sidecar:
+        cached = lg.read_sidecar(fname, folder)
+        if cached is not None:
+            return lg.Tracts(cached[0], header=cached[1])
+
+    point_data = None
     if fname.endswith('.tck'):
         tractogram, header = lg.read_tck(fname)
-        obj = lg.Tracts(tractogram, header=header)
     elif fname.endswith('.trk'):
         tractogram, header = lg.read_trk(fname)
-        obj = lg.Tracts(tractogram, header=header)
     else:
-        tractogram = lg.read_vtk(fname)[0]
-        obj = lg.Tracts(tractogram)
+        tractogram, point_data = lg.read_vtk(fname)
+        header = None
+    obj = lg.Tracts(tractogram, header=header)
+
+    if sidecar:
+        try:
+            lg.write_sidecar(fname, obj.tractogram, header, point_data, folder)
+        except (IOError, OSError) as e:
+            print('Tractogram sidecar not written: {}'.format(e))
     return obj
 
 
+def tracts_entry(tractogram):
+    streamlines = tractogram.tractogram
+    return (streamlines, tractogram.header), streamlines.data.nbytes + streamlines.lengths.nbytes
+
+
+def load_nii(fname, bbox=None, with_range=False, data_cache=None):
+    """
+    NIfTI images loading (see logic_tm.load_nii), through the in-memory cache of the parsed inputs when given: the
+    whole image is read once and the bounding box is a view of it
+    :param data_cache: cache.DataCache (None to read the file)
+    """
+    if data_cache is None:
+        return lg.load_nii(fname, bbox, with_range=with_range)
+    data, affine, value_range = data_cache.get('nii', fname, lambda: nii_entry(fname))
+    data, affine = crop_volume(data, affine, bbox)
+    if with_range:
+        return data, affine, value_range
+    return data, affine
+
+
+def crop_volume(data, affine, bbox=None):
+    """
+    Region of an in-memory volume
+    :param data: voxel array (IJK order)
+    :param affine: IJK to RAS matrix
+    :param bbox: (lower, upper) voxel bounds (upper excluded), None for the whole volume
+    :return: view of the region, affine matrix of the cropped grid
+    """
+    if bbox is None:
+        return data, affine
+    lower, upper = [[int(v) for v in bound] for bound in bbox]
+    affine = np.array(affine, dtype=np.float64)
+    affine[:3, 3] = affine[:3, :3].dot(np.asarray(lower, dtype=np.float64)) + affine[:3, 3]
+    return data[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]], affine
+
+
+def nii_entry(fname):
+    data, affine, value_range = lg.load_nii(fname, with_range=True)
+    return (data, affine, value_range), data.nbytes
+
+
+def stream_tracts(fname, chunk_size=CHUNK_POINTS, sidecar=None, data_cache=None):
+    """
+    Tractogram streaming manager: .tck files are read from disk chunk by chunk at every pass, other formats are
+    loaded once and then visited chunk by chunk
+    :param fname: tractogram filename
+    :param chunk_size: number of points per chunk
+    :param sidecar: see load_tracts (not used for .tck files)
+    :param data_cache: see load_tracts (not used for .tck files)
+    :return: streaming tractogram class object
+    """
+    if fname.endswith('.tck'):
+        header = lg.input_output.read_mrtrix_header(fname)
+        return lg.TractStream(lambda: lg.iter_tck(fname, chunk_size), header=header)
+    tractogram = load_tracts(fname, sidecar, data_cache)
+    return lg.TractStream(lambda: tractogram.tractogram.chunks(chunk_size), header=tractogram.header)
+
+
 def save_txt(txt_filepath, body, header):
     with open(txt_filepath, "w") as handler:
         handler.write(header + '\n' + body)
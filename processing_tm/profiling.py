@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-stage instrumentation of the pipeline: wall and CPU time, memory peaks and throughput, saved as JSON or as a
+trace-event file (chrome://tracing, Perfetto).
+"""
+
+import os
+import json
+import platform
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process
+    :return: bytes (None where not available)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def children_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class NullProfiler:
+    """
+    Profiler doing nothing, used when the pipeline is not instrumented
+    """
+
+    def __repr__(self):
+        return "{}()".format(self.__class__.__name__)
+
+    @contextmanager
+    def stage(self, name, n_lines=None, n_points=None):
+        yield {}
+
+    def set_counts(self, n_lines, n_points):
+        pass
+
+
+class Profiler(NullProfiler):
+    """
+    Records every stage run inside a `with profiler.stage(name):` block
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        Object creation operations
+        :param trace_memory: record the tracemalloc peak of every stage (Python and numpy allocations); tracing slows
+        down the pure Python parts of the pipeline
+        """
+        self.trace_memory = trace_memory
+        self.records = []
+        self.n_lines = None
+        self.n_points = None
+        self._origin = perf_counter()
+
+    def __repr__(self):
+        return "{}({} stages)".format(self.__class__.__name__, len(self.records))
+
+    def set_counts(self, n_lines, n_points):
+        """
+        Size of the tractogram, used for the throughput of the following stages
+        """
+        self.n_lines = None if n_lines is None else int(n_lines)
+        self.n_points = None if n_points is None else int(n_points)
+
+    @contextmanager
+    def stage(self, name, n_lines=None, n_points=None):
+        """
+        Instrument a stage
+        :param name: stage name
+        :param n_lines: number of streamlines processed (default: the current counts)
+        :param n_points: number of points processed (default: the current counts)
+        :return: the stage record, which can be completed inside the block
+        """
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        record = {'name': name}
+        start, cpu, children = perf_counter(), process_time(), children_cpu_time()
+        try:
+            yield record
+        finally:
+            wall = perf_counter() - start
+            record['start'] = start - self._origin
+            record['wall'] = wall
+            record['cpu'] = process_time() - cpu
+            record['cpu_children'] = children_cpu_time() - children
+            record['peak_rss'] = peak_rss()
+            if self.trace_memory:
+                record['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1] - traced_before
+            record.setdefault('n_lines', self.n_lines if n_lines is None else n_lines)
+            record.setdefault('n_points', self.n_points if n_points is None else n_points)
+            for count, rate in (('n_lines', 'lines_per_second'), ('n_points', 'points_per_second')):
+                record[rate] = record[count] / wall if record[count] is not None and wall > 0 else None
+            self.records.append(record)
+
+    def total(self):
+        return sum(record['wall'] for record in self.records)
+
+    def to_json(self):
+        return {'stages': self.records, 'total_wall': self.total(), 'peak_rss': peak_rss()}
+
+    def to_trace_events(self):
+        """
+        Trace Event Format: one complete event per stage, times in microseconds
+        """
+        pid = os.getpid()
+        events = []
+        for record in self.records:
+            events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': 0, 'ts': record['start'] * 1e6,
+                           'dur': record['wall'] * 1e6,
+                           'args': {k: v for k, v in record.items() if k not in ('name', 'start', 'wall')}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, fname, fmt='json'):
+        """
+        Write the records
+        :param fname: output filename
+        :param fmt: 'json' (stage list) or 'trace' (Trace Event Format)
+        """
+        with open(fname, 'w') as handle:
+            json.dump(self.to_trace_events() if fmt == 'trace' else self.to_json(), handle, indent=1)
+
+    def summary(self):
+        lines = ['{:<24} {:>10} {:>10} {:>14}'.format('stage', 'wall (s)', 'cpu (s)', 'points/s')]
+        for record in self.records:
+            rate = record['points_per_second']
+            lines.append('{:<24} {:10.4f} {:10.4f} {:>14}'.format(record['name'], record['wall'],
+                                                                  record['cpu'] + record['cpu_children'],
+                                                                  '{:.0f}'.format(rate) if rate else '-'))
+        return '\n'.join(lines)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Progress reporting and cancellation of a running computation, e.g. from a GUI thread. The pipeline stages and the
+streamline chunks of the parallel kernels are the cancellation points.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from .profiling import NullProfiler
+
+
+class Cancelled(Exception):
+    """
+    Raised at the first cancellation point reached after CancelToken.cancel
+    """
+
+
+class CancelToken:
+    """
+    Cancellation request shared between the thread running the computation and the one cancelling it
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return "{}(cancelled={})".format(self.__class__.__name__, self.cancelled)
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled('Computation cancelled')
+
+
+class Progress(NullProfiler):
+    """
+    Progress of one computation. It is given to the pipeline in place of the profiler (which it wraps, see track): every
+    stage and every chunk of streamlines reports the completed fraction to the callback, and raises Cancelled once the
+    token is cancelled.
+    """
+
+    def __init__(self, callback=None, token=None):
+        """
+        Object creation operations
+        :param callback: function (fraction, stage name) called at every stage and chunk, from the computing thread
+        :param token: CancelToken (default: a new token, see cancel)
+        """
+        self.callback = callback
+        self.token = token if token is not None else CancelToken()
+        self.profiler = NullProfiler()
+        self.n_stages = 1
+        self.n_done = 0
+        self.name = None
+
+    def __repr__(self):
+        return "{}({}/{} stages)".format(self.__class__.__name__, self.n_done, self.n_stages)
+
+    def track(self, profiler, n_stages):
+        """
+        Start a computation
+        :param profiler: profiler receiving the stages too
+        :param n_stages: expected number of stages
+        :return: self, to be used as profiler
+        """
+        self.profiler = profiler
+        self.n_stages = max(int(n_stages), 1)
+        self.n_done = 0
+        return self
+
+    def cancel(self):
+        self.token.cancel()
+
+    def check(self):
+        self.token.check()
+
+    def set_counts(self, n_lines, n_points):
+        self.profiler.set_counts(n_lines, n_points)
+
+    @contextmanager
+    def stage(self, name, n_lines=None, n_points=None):
+        self.check()
+        self.name = name
+        self.report(0.)
+        with self.profiler.stage(name, n_lines, n_points) as record:
+            yield record
+        self.n_done += 1
+        self.report(0.)
+
+    def chunk(self, done, total=None):
+        """
+        Chunk of streamlines processed in the current stage
+        :param done: number of processed chunks
+        :param total: number of chunks (None when unknown, e.g. when streaming)
+        """
+        self.check()
+        if total:
+            self.report(done / float(total))
+
+    def report(self, fraction):
+        """
+        :param fraction: completed fraction of the current stage
+        """
+        if self.callback is not None:
+            self.callback(min((self.n_done + fraction) / self.n_stages, 1.), self.name)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Resident local service: a long-running process keeps the libraries imported and the parsed inputs in memory
+(cache.DataCache), and runs the pipeline for the command line, batch and Slicer clients over HTTP on the loopback
+interface. Follow-up requests on the same files skip the imports and the parsing.
+
+Every request must carry the token the service writes at start-up in a file readable by its owner only (see
+token_path), so that the other users of a shared machine cannot drive it.
+"""
+
+import os
+import hmac
+import json
+import secrets
+import threading
+from time import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+from .cache import DataCache, default_cache_dir
+from .pipeline import proc, compute
+from .logic_tm.input_output import sidecar_path
+
+HOST = '127.0.0.1'
+PORT = 8765
+JSON_TYPE = 'application/json'
+TOKEN_HEADER = 'X-Service-Token'
+LOCAL_HOSTS = ('127.0.0.1', 'localhost')
+# keyword arguments of pipeline.compute accepted from the clients (the caches stay on the service side)
+COMPUTE_OPTIONS = ('perc_resampling', 'n_bins', 'streaming', 'chunk_size', 'jobs', 'backend', 'sidecar', 'subsample',
+                   'stratify', 'seed', 'n_bootstrap', 'confidence', 'fiber_table', 'metrics')
+PROC_OPTIONS = ('header', 'to_csv', 'to_xlsx', 'from_plugin') + COMPUTE_OPTIONS
+INPUTS = ('tractogram_filepath', 'fa_filepath', 'bzero_filepath', 'md_filepath')
+
+
+def token_path(port=PORT):
+    """
+    File holding the access token of the service listening on a port, in the per-user cache folder
+    """
+    return os.path.join(default_cache_dir(), 'service-{}.token'.format(port))
+
+
+def write_token(port):
+    """
+    Create a new random token file, readable and writable by the owner only
+    :return: token
+    """
+    path = token_path(port)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.lexists(path):
+        os.unlink(path)
+    token = secrets.token_urlsafe(32)
+    # O_EXCL: never write through a file or a link planted in the meantime
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as handle:
+        handle.write(token)
+    return token
+
+
+def read_token(port):
+    """
+    Token of the service listening on a port
+    :return: token
+    :raise OSError: no token file, or a file that another user could have written
+    """
+    path = token_path(port)
+    stat = os.lstat(path)
+    if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o077):
+        raise PermissionError('Token file not private: {}'.format(path))
+    with open(path) as handle:
+        return handle.read().strip()
+
+
+def check_writable(path, folder=False):
+    """
+    Refuse an output that the caller (the owner of the service) could not write, or that is reached through a link
+    :param path: absolute file or folder name
+    :param folder: the output is a folder
+    """
+    if not os.path.isabs(path):
+        raise PermissionError('Output paths must be absolute: {}'.format(path))
+    if os.path.lexists(path):
+        exists = os.path.isdir(path) if folder else os.path.isfile(path)
+        if os.path.islink(path) or not exists or not os.access(path, os.W_OK):
+            raise PermissionError('Cannot write {}'.format(path))
+    else:
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent) or not os.access(parent, os.W_OK | os.X_OK):
+            raise PermissionError('Cannot write in {}'.format(parent))
+
+
+def output_paths(endpoint, arguments):
+    """
+    Outputs of a request
+    :return: list of (absolute name, is a folder)
+    """
+    paths = []
+    txt_filepath = arguments.get('txt_filepath')
+    if endpoint == 'proc' and txt_filepath:
+        paths.append((txt_filepath, False))
+        if arguments.get('to_csv'):
+            paths.append((txt_filepath.split('.')[0] + '.csv', False))
+        if arguments.get('to_xlsx'):
+            paths.append((txt_filepath.split('.')[0] + '.xlsx', False))
+        if arguments.get('from_plugin'):
+            paths.append((arguments['from_plugin']['csv_fname'], False))
+    if arguments.get('fiber_table'):
+        paths.append((arguments['fiber_table'], False))
+    sidecar = arguments.get('sidecar')
+    if sidecar and arguments.get('tractogram_filepath'):
+        paths.append((sidecar_path(arguments['tractogram_filepath'], None if sidecar is True else sidecar), True))
+    return paths
+
+
+def to_json(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError('Not serializable: {!r}'.format(value))
+
+
+def from_json(body):
+    """
+    Dictionary of values, lists turned back into arrays
+    """
+    return dict((key, np.array(value) if isinstance(value, list) else value) for key, value in body.items())
+
+
+class Service(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server bound to the loopback interface. Endpoints (JSON bodies):
+    POST /proc: pipeline.proc, the service writes the output files; returns the CSV filename and the profiles
+    POST /compute: pipeline.compute; returns the report dictionary and the profiles
+    GET /status: cache usage and number of served requests
+    POST /clear: empty the caches
+    POST /shutdown: stop the service
+    The computations are run one at a time; the status is answered meanwhile. Requests without the token of
+    token_path are refused, and so are output paths the caller could not write.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=PORT, data_cache=None, cache=None, verbose=True):
+        """
+        Object creation operations
+        :param port: TCP port (0 for any free port)
+        :param data_cache: in-memory cache of the parsed inputs (default: a new cache.DataCache)
+        :param cache: ResultCache of the computed metrics (None to always compute)
+        :param verbose: log the requests
+        """
+        HTTPServer.__init__(self, (HOST, port), ServiceHandler)
+        self.token = write_token(self.server_address[1])
+        self.data_cache = data_cache if data_cache is not None else DataCache()
+        self.cache = cache
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.n_requests = 0
+
+    def __repr__(self):
+        return "{}({}:{})".format(self.__class__.__name__, *self.server_address)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        try:
+            if read_token(self.server_address[1]) == self.token:
+                os.unlink(token_path(self.server_address[1]))
+        except OSError:
+            pass
+
+    def status(self):
+        return {'pid': os.getpid(), 'requests': self.n_requests, 'data_cache': self.data_cache.status()}
+
+    def clear(self):
+        with self.lock:
+            self.data_cache.clear()
+            if self.cache is not None:
+                self.cache.clear()
+
+    def run(self, endpoint, arguments):
+        """
+        Compute one request
+        :param endpoint: 'proc' or 'compute'
+        :param arguments: dictionary with the input filenames (INPUTS), txt_filepath for 'proc', and options
+        :return: JSON-serializable result
+        """
+        options = PROC_OPTIONS if endpoint == 'proc' else COMPUTE_OPTIONS
+        unknown = set(arguments) - set(options) - set(INPUTS) - {'txt_filepath'}
+        if unknown:
+            raise ValueError('Unknown arguments: {}'.format(', '.join(sorted(unknown))))
+        for path, folder in output_paths(endpoint, arguments):
+            check_writable(path, folder)
+        kwargs = dict((key, arguments[key]) for key in options if key in arguments)
+        inputs = [arguments.get(key) for key in INPUTS]
+
+        with self.lock:
+            t0 = time()
+            if endpoint == 'proc':
+                kwargs.setdefault('header', None)
+                kwargs.setdefault('to_csv', False)
+                kwargs.setdefault('to_xlsx', False)
+                kwargs.setdefault('perc_resampling', None)
+                result = proc(inputs[0], arguments['txt_filepath'], *inputs[1:], cache=self.cache,
+                              data_cache=self.data_cache, **kwargs)
+                csv_filepath, behaviors = result if result else (None, {})
+                body = {'csv_filepath': csv_filepath}
+            else:
+                report, behaviors = compute(*inputs, cache=self.cache, data_cache=self.data_cache, **kwargs)
+                body = {'report': report.to_dict()}
+            self.n_requests += 1
+        body.update(behaviors=behaviors, seconds=time() - t0)
+        return body
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.check_origin() and self.check_token():
+            if self.path == '/status':
+                self.reply(200, self.server.status())
+            else:
+                self.reply(404, {'error': 'Unknown endpoint: {}'.format(self.path)})
+
+    def do_POST(self):
+        if not (self.check_origin() and self.check_token()):
+            return
+        # browsers cannot send a JSON body to another origin without a preflight request, which is not answered
+        if self.headers.get('Content-Type', '').split(';')[0].strip() != JSON_TYPE:
+            self.reply(415, {'error': 'Expected a {} body'.format(JSON_TYPE)})
+            return
+        try:
+            arguments = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as e:
+            self.reply(400, {'error': 'Invalid JSON body: {}'.format(e)})
+            return
+
+        if self.path == '/status':
+            self.reply(200, self.server.status())
+        elif self.path == '/clear':
+            self.server.clear()
+            self.reply(200, self.server.status())
+        elif self.path == '/shutdown':
+            self.reply(200, {})
+            threading.Thread(target=self.server.shutdown).start()
+        elif self.path in ('/proc', '/compute'):
+            try:
+                self.reply(200, self.server.run(self.path[1:], arguments))
+            except SystemExit:
+                self.reply(500, {'error': 'Empty or unreadable tractogram'})
+            except PermissionError as e:
+                self.reply(403, {'error': str(e)})
+            except Exception as e:
+                self.reply(500, {'error': '{}: {}'.format(e.__class__.__name__, e)})
+        else:
+            self.reply(404, {'error': 'Unknown endpoint: {}'.format(self.path)})
+
+    def check_origin(self):
+        """
+        Reject the requests addressed to another host name (DNS rebinding)
+        """
+        if self.headers.get('Host', HOST).rsplit(':', 1)[0] not in LOCAL_HOSTS:
+            self.reply(403, {'error': 'Forbidden host'})
+            return False
+        return True
+
+    def check_token(self):
+        """
+        Reject the requests of the users who cannot read the token file
+        """
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode(), self.server.token.encode()):
+            self.reply(401, {'error': 'Missing or invalid {} header'.format(TOKEN_HEADER)})
+            return False
+        return True
+
+    def reply(self, code, body):
+        data = json.dumps(body, default=to_json).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', JSON_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class ServiceClient:
+    """
+    Client of a running Service, with the same calls as the pipeline. Relative filenames are made absolute, since
+    the service may run from another folder. The token is read from the file written by the service (see token_path).
+    """
+
+    def __init__(self, port=PORT, timeout=None):
+        """
+        Object creation operations
+        :param port: TCP port of the service
+        :param timeout: seconds to wait for a computation (None to wait for ever)
+        """
+        self.port = port
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "{}({}:{})".format(self.__class__.__name__, HOST, self.port)
+
+    def request(self, endpoint, arguments=None, timeout=None):
+        """
+        Send a request
+        :param endpoint: endpoint name (see Service)
+        :param arguments: dictionary sent as JSON body (None for a GET request)
+        :return: decoded JSON reply
+        """
+        url = 'http://{}:{}/{}'.format(HOST, self.port, endpoint)
+        headers = {TOKEN_HEADER: read_token(self.port)}
+        if arguments is None:
+            request = Request(url, headers=headers)
+        else:
+            headers['Content-Type'] = JSON_TYPE
+            request = Request(url, json.dumps(arguments, default=to_json).encode(), headers)
+        try:
+            with urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except URLError as e:
+            body = getattr(e, 'read', None)
+            if body is None:
+                raise
+            raise RuntimeError('Service error: {}'.format(json.loads(body()).get('error', e)))
+
+    def available(self):
+        try:
+            self.request('status', timeout=1)
+        except (URLError, OSError, ValueError):
+            return False
+        return True
+
+    def status(self):
+        return self.request('status')
+
+    def clear(self):
+        return self.request('clear', {})
+
+    def shutdown(self):
+        return self.request('shutdown', {})
+
+    @staticmethod
+    def arguments(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, options):
+        arguments = dict((key, os.path.abspath(value) if value else None) for key, value in
+                         zip(INPUTS, (tractogram_filepath, fa_filepath, bzero_filepath, md_filepath)))
+        for key, value in options.items():
+            if key in ('sidecar', 'fiber_table') and isinstance(value, str):
+                value = os.path.abspath(value)
+            arguments[key] = value.decode() if isinstance(value, bytes) else value
+        return arguments
+
+    def proc(self, tractogram_filepath, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv,
+             to_xlsx, perc_resampling, from_plugin=False, **options):
+        """
+        pipeline.proc run by the service (same arguments, except the caches and the profiler)
+        :return: like pipeline.proc
+        """
+        if from_plugin:
+            from_plugin = dict((key, os.path.abspath(value)) for key, value in from_plugin.items())
+        options.update(header=header, to_csv=to_csv, to_xlsx=to_xlsx, perc_resampling=perc_resampling,
+                       from_plugin=from_plugin)
+        arguments = self.arguments(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, options)
+        txt_filepath = txt_filepath.decode() if isinstance(txt_filepath, bytes) else txt_filepath
+        arguments['txt_filepath'] = os.path.abspath(txt_filepath)
+        result = self.request('proc', arguments)
+        if from_plugin:
+            return result['csv_filepath'], from_json(result['behaviors'])
+
+    def compute(self, tractogram_filepath, fa_filepath, bzero_filepath, md_filepath, perc_resampling=None, **options):
+        """
+        pipeline.compute run by the service (same arguments, except the caches and the profiler)
+        :return: report dictionary (see logic_tm.report.Report.to_dict), along-tract profiles
+        """
+        options['perc_resampling'] = perc_resampling
+        result = self.request('compute', self.arguments(tractogram_filepath, fa_filepath, bzero_filepath, md_filepath,
+                                                        options))
+        return from_json(result['report']), from_json(result['behaviors'])
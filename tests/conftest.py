@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os.path
+import json
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET = os.path.join(ROOT, 'test_dataset')
+# report values and along-tract profiles of test_dataset/l5.vtk with FA, b0 and MD, computed by the original code
+# except for the last profile portion, which now always includes the last point of every fiber, and for the termination
+# position of the report dictionary, which repeated the seed position
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'l5_baseline.json')
+
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def dataset():
+    return {'tractogram': os.path.join(DATASET, 'l5.vtk'), 'fa': os.path.join(DATASET, 'FA.nii.gz'),
+            'bzero': os.path.join(DATASET, 'b0.nii.gz'), 'md': os.path.join(DATASET, 'MD.nii.gz')}
+
+
+@pytest.fixture(scope='session')
+def baseline():
+    with open(BASELINE) as handle:
+        return json.load(handle)
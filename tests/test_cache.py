@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cache keys and least recently used eviction
+"""
+
+import os
+
+import pytest
+
+from processing_tm.cache import ResultCache, DataCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / 'cache'))
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    names = []
+    for i in range(2):
+        fname = str(tmp_path / 'input_{}.bin'.format(i))
+        with open(fname, 'wb') as handle:
+            handle.write(b'input %d' % i)
+        names.append(fname)
+    return names
+
+
+def test_key_stable(cache, inputs, tmp_path):
+    key = cache.key(inputs + [None], {'n_bins': 20, 'metrics': ['length']})
+    assert key == cache.key(inputs + [None], {'metrics': ['length'], 'n_bins': 20})
+    assert key == ResultCache(cache.directory).key(inputs + [None], {'n_bins': 20, 'metrics': ['length']})
+    # addressed by content, not by path
+    copy = str(tmp_path / 'copy.bin')
+    with open(inputs[1], 'rb') as src, open(copy, 'wb') as dst:
+        dst.write(src.read())
+    assert key == cache.key([inputs[0], copy, None], {'n_bins': 20, 'metrics': ['length']})
+
+
+def test_key_changes(cache, inputs):
+    params = {'n_bins': 20}
+    key = cache.key(inputs, params)
+    assert key != cache.key(inputs, {'n_bins': 10})
+    assert key != cache.key(inputs[::-1], params)
+    assert key != cache.key(inputs + [None], params)
+
+    with open(inputs[0], 'wb') as handle:
+        handle.write(b'input 9')
+    stat = os.stat(inputs[0])
+    os.utime(inputs[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert key != cache.key(inputs, params)
+
+
+def test_get_put_evict(cache):
+    assert cache.get('a') is None
+    cache.put('a', {'value': 1})
+    assert cache.get('a') == {'value': 1}
+
+    cache.max_bytes = os.path.getsize(cache.entry_path('a')) * 2
+    cache.put('b', {'value': 2})
+    os.utime(cache.entry_path('a'), ns=(0, 0))
+    cache.put('c', {'value': 3})
+    assert cache.get('a') is None
+    assert cache.get('c') == {'value': 3}
+
+    cache.clear()
+    assert cache.get('c') is None
+
+
+def test_data_cache(inputs):
+    cache = DataCache(max_bytes=10)
+    loads = []
+
+    def load(fname):
+        loads.append(fname)
+        return fname, 6
+
+    for fname in inputs + inputs[1:]:
+        assert cache.get('raw', fname, lambda: load(fname)) == fname
+    assert loads == inputs
+    assert cache.status()['hits'] == 1
+    # the first entry was evicted beyond max_bytes
+    cache.get('raw', inputs[0], lambda: load(inputs[0]))
+    assert loads == inputs + inputs[:1]
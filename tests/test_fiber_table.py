@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-fiber table export
+"""
+
+import numpy as np
+import pytest
+
+from processing_tm.logic_tm import read_vtk, read_fiber_table, geometry
+from processing_tm.pipeline import compute
+
+
+@pytest.fixture(scope='module')
+def fibers(dataset):
+    streamlines = read_vtk(dataset['tractogram'])[0]
+    return streamlines.lengths, geometry.lengths(streamlines)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_fiber_table(dataset, fibers, tmp_path, streaming):
+    fname = str(tmp_path / 'fibers.npz')
+    compute(dataset['tractogram'], dataset['fa'], None, None, fiber_table=fname, streaming=streaming, chunk_size=5000)
+    table = read_fiber_table(fname)
+    n_points, lengths = fibers
+    np.testing.assert_array_equal(table['fiber'], np.arange(len(n_points)))
+    np.testing.assert_array_equal(table['n_points'], n_points)
+    np.testing.assert_allclose(table['length'], lengths, rtol=1e-10)
+    assert np.all(table['FA_min'] <= table['FA_mean']) and np.all(table['FA_mean'] <= table['FA_max'])
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_subsampled_fiber_ids(dataset, fibers, tmp_path, streaming):
+    fname = str(tmp_path / 'fibers.npz')
+    compute(dataset['tractogram'], dataset['fa'], None, None, fiber_table=fname, streaming=streaming, chunk_size=5000,
+            subsample=.25, seed=0)
+    table = read_fiber_table(fname)
+    n_points, lengths = fibers
+    ids = table['fiber']
+    assert 0 < len(ids) < len(n_points)
+    assert np.all(np.diff(ids) > 0) and ids[-1] < len(n_points)
+    # the rows join back to the input streamlines
+    np.testing.assert_array_equal(table['n_points'], n_points[ids])
+    np.testing.assert_allclose(table['length'], lengths[ids], rtol=1e-10)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized geometric kernels against the per-fiber computations
+"""
+
+import numpy as np
+import pytest
+from dipy.tracking import metrics as dipy_metrics
+
+from processing_tm.logic_tm import geometry, Streamlines
+
+
+@pytest.fixture
+def fibers():
+    rng = np.random.default_rng(0)
+    return [np.cumsum(rng.normal(size=(rng.integers(2, 40), 3)), axis=0) for _ in range(50)]
+
+
+def test_lengths(fibers):
+    streamlines = Streamlines.from_list(fibers)
+    expected = [np.linalg.norm(np.diff(f, axis=0), axis=1).sum() for f in fibers]
+    np.testing.assert_allclose(geometry.lengths(streamlines), expected, rtol=1e-12)
+
+
+def test_cumulative_lengths(fibers):
+    streamlines = Streamlines.from_list(fibers)
+    expected = np.concatenate([np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(f, axis=0), axis=1))))
+                               for f in fibers])
+    np.testing.assert_allclose(geometry.cumulative_lengths(streamlines), expected, rtol=1e-10, atol=1e-10)
+
+
+def test_shortest_and_extremities(fibers):
+    streamlines = Streamlines.from_list(fibers)
+    np.testing.assert_allclose(geometry.shortest(streamlines), [np.linalg.norm(f[0] - f[-1]) for f in fibers],
+                               rtol=1e-12)
+    np.testing.assert_array_equal(geometry.extremities(streamlines), [(f[0], f[-1]) for f in fibers])
+
+
+def test_midpoints(fibers):
+    streamlines = Streamlines.from_list(fibers)
+    np.testing.assert_allclose(geometry.midpoints(streamlines), [dipy_metrics.midpoint(f) for f in fibers],
+                               rtol=1e-10, atol=1e-10)
+
+
+def test_windings(fibers):
+    streamlines = Streamlines.from_list(fibers)
+    np.testing.assert_allclose(geometry.windings(streamlines), [dipy_metrics.winding(f) for f in fibers],
+                               atol=1e-5)
+
+
+def test_single_point_fibers():
+    streamlines = Streamlines.from_list([np.zeros((1, 3)), np.ones((3, 3)), np.full((1, 3), 2.)])
+    np.testing.assert_array_equal(geometry.lengths(streamlines), [0., 0., 0.])
+    np.testing.assert_array_equal(geometry.midpoints(streamlines), [[0.] * 3, [1.] * 3, [2.] * 3])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tractogram readers
+"""
+
+import numpy as np
+import nibabel as nib
+import pytest
+import vtk
+
+from processing_tm.logic_tm import read_tck, iter_tck, read_vtk, read_sidecar, write_sidecar, Streamlines
+from processing_tm.logic_tm.input_output import legacy_cells_to_connectivity, walk_legacy_cells
+
+
+@pytest.fixture
+def fibers():
+    rng = np.random.default_rng(0)
+    return [np.cumsum(rng.normal(size=(rng.integers(1, 60), 3)), axis=0).astype(np.float32) for _ in range(200)]
+
+
+@pytest.fixture
+def tck_file(fibers, tmp_path):
+    fname = str(tmp_path / 'fibers.tck')
+    tractogram = nib.streamlines.Tractogram(fibers, affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(tractogram, fname)
+    return fname
+
+
+@pytest.mark.parametrize('chunk_points', [7, 100, 1 << 20])
+def test_read_tck(fibers, tck_file, chunk_points):
+    streamlines, header = read_tck(tck_file, chunk_points)
+    assert int(header['count']) == len(fibers)
+    np.testing.assert_array_equal(streamlines.lengths, [len(f) for f in fibers])
+    np.testing.assert_array_equal(streamlines.data, np.concatenate(fibers))
+
+
+@pytest.mark.parametrize('chunk_points', [7, 100])
+def test_iter_tck(fibers, tck_file, chunk_points):
+    chunks = list(iter_tck(tck_file, chunk_points))
+    assert len(chunks) > 1
+    streamlines = Streamlines.concatenate(chunks)
+    np.testing.assert_array_equal(streamlines.lengths, [len(f) for f in fibers])
+    np.testing.assert_array_equal(streamlines.data, np.concatenate(fibers))
+
+
+def legacy_cells(lengths, ids):
+    cells, start = [], 0
+    for n in lengths:
+        cells += [n] + list(ids[start:start + n])
+        start += n
+    return np.array(cells, dtype=np.int64)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_legacy_cells(fibers, shuffle):
+    lengths = [len(f) for f in fibers]
+    ids = np.arange(sum(lengths))
+    if shuffle:
+        np.random.default_rng(1).shuffle(ids)
+    lines = legacy_cells(lengths, ids)
+
+    offsets, connectivity = legacy_cells_to_connectivity(lines, len(lengths))
+    np.testing.assert_array_equal(np.diff(offsets), lengths)
+    np.testing.assert_array_equal(connectivity, ids)
+    np.testing.assert_array_equal(lines[walk_legacy_cells(lines, len(lengths))], lengths)
+
+
+def test_read_vtk(dataset):
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(dataset['tractogram'])
+    reader.Update()
+    polydata = reader.GetOutput()
+    points = np.array([polydata.GetPoint(i) for i in range(polydata.GetNumberOfPoints())])
+    ids = vtk.vtkIdList()
+    expected = []
+    for i in range(polydata.GetNumberOfCells()):
+        polydata.GetCellPoints(i, ids)
+        expected.append(points[[ids.GetId(k) for k in range(ids.GetNumberOfIds())]])
+
+    streamlines = read_vtk(dataset['tractogram'])[0]
+    assert len(streamlines) == len(expected) == 479
+    np.testing.assert_array_equal(streamlines.lengths, [len(f) for f in expected])
+    np.testing.assert_allclose(streamlines.data, np.concatenate(expected), rtol=1e-6)
+
+
+def test_sidecar(dataset, tmp_path):
+    streamlines, point_data = read_vtk(dataset['tractogram'])
+    write_sidecar(dataset['tractogram'], streamlines, point_data=point_data, folder=str(tmp_path))
+    cached = read_sidecar(dataset['tractogram'], folder=str(tmp_path))
+    assert cached is not None
+    np.testing.assert_array_equal(cached[0].lengths, streamlines.lengths)
+    np.testing.assert_array_equal(cached[0].data, streamlines.data)
+    assert read_sidecar(dataset['tractogram'], folder=str(tmp_path / 'missing')) is None
+
+
+def test_stale_sidecar(fibers, tck_file, tmp_path):
+    streamlines, header = read_tck(tck_file)
+    write_sidecar(tck_file, streamlines, header, folder=str(tmp_path))
+    assert read_sidecar(tck_file, folder=str(tmp_path)) is not None
+    nib.streamlines.save(nib.streamlines.Tractogram(fibers[1:], affine_to_rasmm=np.eye(4)), tck_file)
+    assert read_sidecar(tck_file, folder=str(tmp_path)) is None
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Metric selection
+"""
+
+import pytest
+
+from processing_tm.logic_tm import select_metrics
+from processing_tm.logic_tm.metrics import METRICS
+from processing_tm.pipeline import compute
+
+
+def test_select_metrics():
+    assert select_metrics() == frozenset(METRICS)
+    assert select_metrics('all') == frozenset(METRICS)
+    assert select_metrics('length, b0,Turning_Angle') == {'lengths', 'b-zero', 'winding'}
+    assert select_metrics(['FA', 'profile']) == {'FA', 'profiles'}
+    with pytest.raises(ValueError, match='Unknown metric'):
+        select_metrics('lengths,curvature')
+
+
+def test_profiles_need_a_scalar_metric():
+    with pytest.raises(ValueError, match='profiles'):
+        select_metrics('lengths,profiles')
+
+
+def test_selection(dataset):
+    report, profiles = compute(dataset['tractogram'], dataset['fa'], dataset['bzero'], None, metrics='lengths,FA')
+    keys = set(report.to_dict())
+    assert 'Mean Length' in keys and 'Mean FA Value' in keys and 'Number of fibers' in keys
+    assert not any('b-zero' in key or 'Turning Angle' in key or 'Shortest' in key for key in keys)
+    assert profiles == {}
+    profiles = compute(dataset['tractogram'], dataset['fa'], dataset['bzero'], None, metrics='FA,profiles')[1]
+    assert list(profiles) == ['FA']
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end checks of the pipeline against the baseline outputs of test_dataset/l5.vtk
+"""
+
+import numpy as np
+import pytest
+
+import processing_tm.logic_tm as lg
+from processing_tm.pipeline import compute, compute_in_memory, proc
+from processing_tm.cache import ResultCache
+from processing_tm.progress import Progress, Cancelled
+
+# statistics estimated by the streaming mode (quantile sketch)
+SKETCHED = ('Median',)
+
+
+def assert_report(report, expected, rtol=1e-7, skip=()):
+    """
+    Compare a report dictionary with the baseline values
+    :param report: Report.to_dict()
+    :param expected: baseline dictionary
+    :param rtol: relative tolerance
+    :param skip: prefixes of the keys not compared
+    """
+    assert sorted(report) == sorted(expected)
+    for key, value in expected.items():
+        if not key.startswith(skip):
+            np.testing.assert_allclose(np.asarray(report[key], dtype=np.float64), value, rtol=rtol, err_msg=key)
+
+
+def assert_profiles(profiles, expected, rtol=1e-7):
+    assert sorted(profiles) == sorted(expected)
+    for key, value in expected.items():
+        np.testing.assert_allclose(profiles[key], value, rtol=rtol, err_msg=key)
+
+
+def run(dataset, **kwargs):
+    return compute(dataset['tractogram'], dataset['fa'], dataset['bzero'], dataset['md'], **kwargs)
+
+
+@pytest.mark.parametrize('name, perc_resampling', [('default', None), ('resampled', 50)])
+def test_baseline(dataset, baseline, name, perc_resampling):
+    report, profiles = run(dataset, perc_resampling=perc_resampling)
+    assert_report(report.to_dict(), baseline[name]['report'])
+    assert_profiles(profiles, baseline[name]['profiles'])
+
+
+def test_proc_writes_report(dataset, baseline, tmp_path):
+    txt = str(tmp_path / 'l5.txt')
+    csv_filepath, profiles = proc(dataset['tractogram'], txt.encode(), dataset['fa'], dataset['bzero'],
+                                  dataset['md'], 'l5', True, False, None, from_plugin={'csv_fname': None})
+    assert csv_filepath == str(tmp_path / 'l5.csv')
+    with open(txt) as handle:
+        text = handle.read()
+    assert text.startswith('l5\n')
+    assert 'Number of fibers: 479' in text
+    assert_profiles(profiles, baseline['default']['profiles'])
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel(dataset, baseline, backend):
+    report, profiles = run(dataset, jobs=2, backend=backend)
+    assert_report(report.to_dict(), baseline['default']['report'])
+    assert_profiles(profiles, baseline['default']['profiles'])
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 1 << 20])
+def test_streaming(dataset, baseline, chunk_size):
+    report, profiles = run(dataset, streaming=True, chunk_size=chunk_size)
+    report = report.to_dict()
+    assert_report(report, baseline['default']['report'], skip=SKETCHED)
+    for key, value in baseline['default']['report'].items():
+        if key.startswith(SKETCHED):
+            np.testing.assert_allclose(report[key], value, rtol=2e-2, err_msg=key)
+    assert_profiles(profiles, baseline['default']['profiles'])
+
+
+def test_cache(dataset, baseline, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    for _ in range(2):
+        report, profiles = run(dataset, cache=cache)
+        assert_report(report.to_dict(), baseline['default']['report'])
+        assert_profiles(profiles, baseline['default']['profiles'])
+    assert len(list(tmp_path.glob('*.pkl'))) == 1
+
+
+def test_cache_skips_unseeded_subsets(dataset, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    run(dataset, cache=cache, subsample=100)
+    assert not list(tmp_path.glob('*.pkl'))
+    first = run(dataset, cache=cache, subsample=100, seed=0)[0].to_dict()
+    second = run(dataset, cache=cache, subsample=100, seed=0)[0].to_dict()
+    assert len(list(tmp_path.glob('*.pkl'))) == 1
+    assert first['Number of fibers'] == 100
+    assert_report(second, {key: np.asarray(value).tolist() for key, value in first.items()}, rtol=0)
+
+
+def test_in_memory(dataset, baseline):
+    tractogram = lg.read_vtk(dataset['tractogram'])[0]
+    volumes = {name: lg.load_nii(dataset[key]) for name, key in (('FA', 'fa'), ('b-zero', 'bzero'), ('MD', 'md'))}
+    report, profiles = compute_in_memory(tractogram, volumes)
+    assert_report(report.to_dict(), baseline['default']['report'])
+    assert_profiles(profiles, baseline['default']['profiles'])
+
+
+def test_progress(dataset):
+    fractions = []
+    run(dataset, jobs=2, backend='thread', progress=Progress(lambda fraction, name: fractions.append(fraction)))
+    assert fractions == sorted(fractions)
+    assert fractions[-1] == 1.
+
+
+def test_cancel(dataset):
+    stages = []
+    progress = Progress(lambda fraction, name: stages.append(name))
+    progress.cancel()
+    with pytest.raises(Cancelled):
+        run(dataset, progress=progress)
+    assert not stages
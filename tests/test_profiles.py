@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Along-tract profiles against the per-fiber loop of the original code
+"""
+
+import numpy as np
+import pytest
+
+from processing_tm.logic_tm import Streamlines
+from processing_tm.logic_tm.profiles import along_tract_profile, mean_profile
+
+
+def fiber_profile(fiber, values, n_bins):
+    """
+    Per-fiber profile, as computed by the original loop: mean over the points whose cumulative length lies in
+    [j * L / n_bins, (j + 1) * L / n_bins]. The last point always belongs to the last portion, which the original loop
+    missed when (n_bins * L / n_bins) rounded below L.
+    """
+    cum = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(fiber, axis=0), axis=1))))
+    step = cum[-1] / n_bins
+    profile = np.full(n_bins, np.nan)
+    for j in range(n_bins):
+        inside = (step * j <= cum) & (cum <= step * (j + 1))
+        if j == n_bins - 1:
+            inside[-1] = True
+        if inside.any():
+            profile[j] = values[inside].mean()
+    return profile
+
+
+@pytest.fixture
+def fibers():
+    rng = np.random.default_rng(0)
+    return [np.cumsum(rng.normal(size=(rng.integers(2, 60), 3)), axis=0) for _ in range(50)]
+
+
+@pytest.mark.parametrize('n_bins', [1, 5, 20])
+def test_along_tract_profile(fibers, n_bins):
+    values = [np.random.default_rng(i).random(len(f)) for i, f in enumerate(fibers)]
+    profile = along_tract_profile(Streamlines.from_list(fibers), np.concatenate(values), n_bins)
+    expected = np.array([fiber_profile(f, v, n_bins) for f, v in zip(fibers, values)])
+    np.testing.assert_allclose(profile, expected, rtol=1e-12)
+
+
+def test_last_portion_includes_last_point():
+    fiber = np.cumsum(np.full((30, 3), .1, dtype=np.float32), axis=0)
+    values = np.zeros(len(fiber))
+    values[-1] = 1.
+    profile = along_tract_profile(Streamlines.from_list([fiber]), values, 20)
+    assert profile[0, -1] > 0
+
+
+def test_mean_profile_ignores_empty_portions():
+    # the two-point fiber has no point inside its middle portions
+    fibers = [np.array([[0., 0., 0.], [10., 0., 0.]]), np.linspace([0., 0., 0.], [10., 0., 0.], 21)]
+    values = np.concatenate((np.ones(2), np.full(21, 3.)))
+    profile = mean_profile(Streamlines.from_list(fibers), values, 4)
+    np.testing.assert_allclose(profile, [2., 3., 3., 2.])
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Report formatting, in the layout of the original text report
+"""
+
+import numpy as np
+
+from processing_tm.logic_tm.report import Report, Value, Summary, Position
+
+STATISTICS = {'mean': 2., 'std': .5, 'median': 1.5, 'amax': 4., 'amin': 1.}
+
+
+def test_to_text():
+    report = Report()
+    report.add(Value('Number of fibers', 3))
+    report.add(Summary('Length', STATISTICS, 'mm'))
+    report.add(Position('Mean Midpoint Position', 'Mean Midpoint Position', np.array([1., 2., 3.]),
+                        np.array([4., 5., 6.])))
+    report.add(Position('Seed Points Mean Position', 'Seed Points Mean Position', np.array([0., 0., 0.])),
+               new_section=False)
+    assert report.to_text() == ('\n\nNumber of fibers: 3'
+                                '\n\nMean Length: 2.0 mm\nStd Length: 0.5 mm\nMedian Length: 1.5 mm\n'
+                                'Max Length: 4.0 mm, Min Length: 1.0 mm'
+                                '\n\nMean Midpoint Position: [1. 2. 3.] mm / [4. 5. 6.] vox\n'
+                                'Seed Points Mean Position: [0. 0. 0.] mm')
+
+
+def test_to_dict():
+    report = Report()
+    report.add(Summary('FA Value', STATISTICS, intervals={'mean': (1.8, 2.2)}, confidence=.95))
+    report.add(Position('Mean Midpoint Position', 'Mean Midpoint Position', [1., 2., 3.], [4., 5., 6.]))
+    body = report.to_dict()
+    assert list(body) == ['Mean FA Value', 'Mean FA Value 95% CI', 'Std FA Value', 'Median FA Value', 'Max FA Value',
+                          'Min FA Value', 'Mean Midpoint Position (mm)', 'Mean Midpoint Position (vox)']
+    np.testing.assert_array_equal(body['Mean FA Value 95% CI'], [1.8, 2.2])
+    assert body['Min FA Value'] == 1.
+    assert 'Mean FA Value: 2.0 (95% CI: 1.8 - 2.2)' in report.to_text()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Importing the package and the --version/--help paths of the entry points must not load the heavy dependencies
+"""
+
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from check_startup import ROOT, COMMANDS, PROBE, HEAVY_MODULES, heavy_imports  # noqa: E402
+
+
+@pytest.mark.parametrize('name, script, args', COMMANDS, ids=[command[0] for command in COMMANDS])
+def test_lazy_imports(name, script, args):
+    path = os.path.join(ROOT, script) if script else None
+    assert heavy_imports(PROBE.format(root=ROOT, script=path, args=args, heavy=HEAVY_MODULES)) == []
+
+
+def test_lazy_module_loads_on_use():
+    probe = PROBE.format(root=ROOT, script=None, args=[], heavy=HEAVY_MODULES).replace(
+        'import processing_tm\n', 'import processing_tm.logic_tm.input_output as io\n    io.nib.Nifti1Image\n', 1)
+    assert 'nibabel' in heavy_imports(probe)
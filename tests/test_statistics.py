@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming statistics and quantile sketch against numpy on the whole array
+"""
+
+import numpy as np
+import pytest
+
+from processing_tm.logic_tm.statistics import ArraySummary, RunningStats, QuantileSketch, StreamingSummary, \
+    bootstrap_intervals
+
+
+@pytest.fixture
+def values():
+    return np.random.default_rng(0).lognormal(size=100000)
+
+
+def batches(values, size=7919):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def test_running_stats(values):
+    stats = RunningStats()
+    for batch in batches(values):
+        stats.update(batch)
+    assert stats.count == len(values)
+    np.testing.assert_allclose([stats.mean, stats.std], [values.mean(), values.std()], rtol=1e-12)
+    assert (stats.amin, stats.amax) == (values.min(), values.max())
+
+
+def test_running_stats_merge(values):
+    left, right = RunningStats(), RunningStats()
+    left.update(values[:30000])
+    right.update(values[30000:])
+    left.merge(right)
+    assert left.count == len(values)
+    np.testing.assert_allclose([left.mean, left.std], [values.mean(), values.std()], rtol=1e-12)
+
+
+def test_running_stats_points():
+    points = np.random.default_rng(0).normal(size=(1000, 3))
+    stats = RunningStats()
+    for batch in batches(points, 64):
+        stats.update(batch)
+    np.testing.assert_allclose(stats.mean, points.mean(axis=0), rtol=1e-12)
+
+
+def test_sketch_exact_before_compression():
+    values = np.random.default_rng(0).normal(size=1001)
+    sketch = QuantileSketch(capacity=1024)
+    sketch.update(values)
+    assert sketch.median == np.median(values)
+
+
+@pytest.mark.parametrize('q', [.1, .5, .9])
+def test_sketch_rank_error(values, q):
+    capacity = 1024
+    sketch = QuantileSketch(capacity)
+    for batch in batches(values):
+        sketch.update(batch)
+    rank = np.searchsorted(np.sort(values), sketch.quantile(q)) / float(len(values))
+    assert abs(rank - q) < 2. / capacity
+
+
+def test_sketch_merge(values):
+    left, right = QuantileSketch(1024), QuantileSketch(1024)
+    left.update(values[:50000])
+    right.update(values[50000:])
+    left.merge(right)
+    rank = np.searchsorted(np.sort(values), left.median) / float(len(values))
+    assert abs(rank - .5) < 2. / 1024
+
+
+def test_streaming_summary(values):
+    summary, exact = StreamingSummary(), ArraySummary(values)
+    for batch in batches(values):
+        summary.update(batch)
+    assert summary.count == exact.count
+    np.testing.assert_allclose([summary.mean, summary.std, summary.amax, summary.amin],
+                               [exact.mean, exact.std, exact.amax, exact.amin], rtol=1e-12)
+    np.testing.assert_allclose(summary.median, exact.median, rtol=1e-2)
+
+
+def test_bootstrap_intervals(values):
+    first = bootstrap_intervals(values[:1000], n_resamples=200, rng=0)
+    assert first == bootstrap_intervals(values[:1000], n_resamples=200, rng=0)
+    low, high = first['mean']
+    assert low < values[:1000].mean() < high
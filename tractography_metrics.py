@@ -12,17 +12,38 @@ __email__ = 'delmonte.ale92@gmail.com'
 
 
 def main():
-    tractogram, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv, to_xlsx, perc_resampling = setup()
+    args = setup()
 
-    if not fa_filepath and not bzero_filepath and not md_filepath:
+    if not args.Fractional_Anisotropy and not args.b_zero and not args.Mean_Diffusivity and needs_maps(args.metrics):
         sys.exit(1)
 
-    tm.proc(tractogram, txt_filepath, fa_filepath, bzero_filepath, md_filepath, header, to_csv, to_xlsx,
-            perc_resampling)
+    options = dict(n_bins=args.bins, streaming=args.stats == 'streaming', chunk_size=args.chunk_size, jobs=args.jobs,
+                   backend=args.backend, sidecar=args.sidecar, subsample=args.subsample, stratify=args.stratify,
+                   seed=args.seed, n_bootstrap=args.bootstrap, confidence=args.confidence, fiber_table=args.fibers,
+                   metrics=args.metrics)
+    inputs = (args.Input_Tractogram, args.Output_Stats, args.Fractional_Anisotropy, args.b_zero, args.Mean_Diffusivity,
+              args.header, args.save_csv, args.save_xlsx, args.resample)
+
+    if args.service:
+        client = tm.ServiceClient(args.service)
+        if client.available():
+            client.proc(*inputs, **options)
+            return
+        print('No service running on port {}, computing locally'.format(args.service))
+
+    cache = tm.ResultCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+    profiler = tm.Profiler(trace_memory=args.profile_memory) if args.profile else None
+
+    tm.proc(*inputs, cache=cache, profiler=profiler, **options)
+
+    if profiler:
+        profiler.save(args.profile, args.profile_format)
+        print(profiler.summary())
 
 
 def setup():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version='%(prog)s ' + tm.__version__)
     parser.add_argument('Input_Tractogram', help='Name of the input tractography file', type=check_tracto)
     parser.add_argument('Output_Stats', help='Name of the output statistic file', type=check_txt)
     parser.add_argument('-fa', '--Fractional_Anisotropy', help='Name of the input fractional anisotropy image file',
@@ -35,11 +56,65 @@ def setup():
     parser.add_argument('-xlsx', '--save_xlsx', help='Save additional file in Excel format.', action='store_true')
     parser.add_argument('-r', '--resample', help='Downsampling streamlines (might improve computational time)',
                         type=check_threshold)
+    parser.add_argument('-b', '--bins', help='Number of fiber portions of the along-tract profiles (default: 20)',
+                        type=check_positive, default=20)
+    parser.add_argument('--stats', help='Statistics mode: exact (all values in memory) or streaming (chunk by chunk, '
+                                        'bounded memory, approximate medians)', choices=['exact', 'streaming'],
+                        default='exact')
+    parser.add_argument('--chunk-size', help='Number of points per chunk in streaming mode', type=check_positive,
+                        default=tm.pipeline.CHUNK_POINTS)
+    parser.add_argument('-j', '--jobs', help='Number of parallel workers for the per-fiber computations (default: 1)',
+                        type=check_positive, default=1)
+    parser.add_argument('--backend', help='Parallel workers: processes (shared memory) or threads',
+                        choices=['process', 'thread'], default='process')
+    parser.add_argument('--cache-dir', help='Folder of the result cache (default: %(default)s)', type=check_str,
+                        default=tm.cache.default_cache_dir())
+    parser.add_argument('--cache-size', help='Size of the result cache in MB (default: %(default)s)',
+                        type=check_positive,
+                        default=tm.cache.CACHE_BYTES >> 20)
+    parser.add_argument('--cache', help='Read and write the result cache: the results are stored as pickle files in '
+                                        '--cache-dir, keyed by the content of the inputs and by the parameters, and '
+                                        'read back by identical runs (default: always recompute)',
+                        action='store_true')
+    parser.add_argument('--sidecar', help='Keep a memory-mappable binary copy of the parsed tractogram, next to the '
+                                          'file or in the given folder, and reuse it while the file is unchanged',
+                        nargs='?', const=True, default=None, metavar='FOLDER')
+    parser.add_argument('--profile', help='Record wall time, CPU time, memory peaks and throughput of every stage in '
+                                          'the given file', type=check_str, metavar='FILE')
+    parser.add_argument('--profile-format', help='Profile file format: stage list or Trace Event Format '
+                                                 '(chrome://tracing, Perfetto)', choices=['json', 'trace'],
+                        default='json')
+    parser.add_argument('--profile-memory', help='Also record the tracemalloc peak of every stage (slower).',
+                        action='store_true')
+    parser.add_argument('-s', '--subsample', help='Keep a random subset of the streamlines: a number of fibers, or a '
+                                                  'percentage ending with %% (e.g. 5000 or 10%%)', type=check_subsample)
+    parser.add_argument('--stratify', help='Draw the subset in every fiber length decile proportionally to its size.',
+                        action='store_true')
+    parser.add_argument('--seed', help='Random seed of the subset and of the bootstrap, for reproducible results',
+                        type=check_non_negative)
+    parser.add_argument('--bootstrap', help='Report bootstrap confidence intervals of the per-fiber statistics, with '
+                                            'the given number of resamples (e.g. 1000)', type=check_non_negative,
+                        default=0)
+    parser.add_argument('--confidence', help='Confidence level of the intervals (default: %(default)s)',
+                        type=check_confidence, default=.95)
+    parser.add_argument('--fibers', help='Save the per-fiber table (geometry, winding, mean/min/max of every map) in '
+                                         'the given .npz, .parquet or .feather file (Parquet and Feather need pyarrow)',
+                        type=check_fiber_table, metavar='FILE')
+    parser.add_argument('--metrics', help='Comma-separated list of the metrics to compute (default: all): points, '
+                                          'lengths, shortest, midpoint, winding, endpoints, FA, b-zero, MD, '
+                                          'profiles. Maps given but not selected only set the reference grid.',
+                        type=check_metrics)
+    parser.add_argument('--service', help='Send the computation to the resident service (tractography_metrics_service'
+                                          '.py) listening on the given port (default: %(const)s), which keeps the '
+                                          'libraries and the parsed inputs in memory (and its own result cache when '
+                                          'started with --cache)',
+                        nargs='?', type=check_port, const=tm.service.PORT, metavar='PORT')
 
     args = parser.parse_args()
+    if args.service and args.profile:
+        parser.error('--profile is not available with --service')
 
-    return (args.Input_Tractogram, args.Output_Stats, args.Fractional_Anisotropy, args.b_zero, args.Mean_Diffusivity,
-            args.header, args.save_csv, args.save_xlsx, args.resample)
+    return args
 
 
 def check_tracto(value):
@@ -85,6 +160,85 @@ def check_threshold(value):
         sys.exit(1)
 
 
+def check_positive(value):
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError("Invalid value (must be a positive integer): %s" % value)
+    return n
+
+
+def check_non_negative(value):
+    try:
+        n = int(value)
+    except ValueError:
+        n = -1
+    if n < 0:
+        raise argparse.ArgumentTypeError("Invalid value (must be a non-negative integer): %s" % value)
+    return n
+
+
+def check_subsample(value):
+    try:
+        if value.endswith('%'):
+            n = float(value[:-1]) / 100.
+            valid = 0 < n <= 1
+        else:
+            n = int(value)
+            valid = n > 0
+    except ValueError:
+        valid = False
+    if not valid:
+        raise argparse.ArgumentTypeError("Invalid subsample (a positive number of fibers or a percentage between 0 and "
+                                         "100%%): %s" % value)
+    return n
+
+
+def check_confidence(value):
+    try:
+        c = float(value)
+    except ValueError:
+        c = None
+    if c is None or not 0 < c < 1:
+        raise argparse.ArgumentTypeError("Invalid confidence level (must be between 0 and 1): %s" % value)
+    return c
+
+
+def check_fiber_table(value):
+    try:
+        tm.logic_tm.fiber_table.table_format(value)
+    except (ValueError, ImportError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def check_metrics(value):
+    try:
+        tm.logic_tm.select_metrics(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def check_port(value):
+    try:
+        port = int(value)
+    except ValueError:
+        port = None
+    if port is None or not 0 < port < 65536:
+        raise argparse.ArgumentTypeError("Invalid port (must be between 1 and 65535): %s" % value)
+    return port
+
+
+def needs_maps(metrics):
+    """
+    Whether a metric selection needs a scalar map (a selection without any map is computed in world coordinates only)
+    """
+    return metrics is None or bool(tm.logic_tm.select_metrics(metrics) & set(tm.logic_tm.metrics.SCALAR_METRICS))
+
+
 if __name__ == '__main__':
     t0 = time()
     main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import os.path
+from time import time
+import processing_tm as tm
+from tractography_metrics import check_threshold, check_str, check_subsample, check_confidence, \
+    check_metrics, check_port, check_positive, check_non_negative
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+
+def main():
+    args = setup()
+
+    service = args.service
+    if service and not tm.ServiceClient(service).available():
+        print('No service running on port {}, computing locally'.format(service))
+        service = None
+
+    rows = tm.batch(args.Manifest, args.Output_Table, workers=args.workers, perc_resampling=args.resample,
+                    n_bins=args.bins, streaming=args.stats == 'streaming', chunk_size=args.chunk_size,
+                    cache_dir=args.cache_dir if args.cache else None, cache_bytes=args.cache_size << 20,
+                    sidecar=args.sidecar, subsample=args.subsample, stratify=args.stratify, seed=args.seed,
+                    n_bootstrap=args.bootstrap, confidence=args.confidence, metrics=args.metrics, service=service)
+
+    failed = sum(row['Status'] != 'ok' for row in rows)
+    print('{} items processed, {} failed'.format(len(rows), failed))
+
+
+def setup():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version='%(prog)s ' + tm.__version__)
+    parser.add_argument('Manifest', help='CSV or JSON manifest: one item per line/object with the columns subject, '
+                                         'bundle, tractogram, fa, bzero, md', type=check_manifest)
+    parser.add_argument('Output_Table', help='Name of the merged output table (one row per subject and bundle)',
+                        type=check_csv)
+    parser.add_argument('-w', '--workers', help='Number of worker processes (default: number of CPUs)',
+                        type=check_positive)
+    parser.add_argument('-r', '--resample', help='Downsampling streamlines (might improve computational time)',
+                        type=check_threshold)
+    parser.add_argument('-b', '--bins', help='Number of fiber portions of the along-tract profiles (default: 20)',
+                        type=check_positive, default=20)
+    parser.add_argument('--stats', help='Statistics mode: exact (all values in memory) or streaming (chunk by chunk, '
+                                        'bounded memory, approximate medians)', choices=['exact', 'streaming'],
+                        default='exact')
+    parser.add_argument('--chunk-size', help='Number of points per chunk in streaming mode', type=check_positive,
+                        default=tm.pipeline.CHUNK_POINTS)
+    parser.add_argument('--cache-dir', help='Folder of the result cache (default: %(default)s)', type=check_str,
+                        default=tm.cache.default_cache_dir())
+    parser.add_argument('--cache-size', help='Size of the result cache in MB (default: %(default)s)',
+                        type=check_positive,
+                        default=tm.cache.CACHE_BYTES >> 20)
+    parser.add_argument('--cache', help='Read and write the result cache: the results are stored as pickle files in '
+                                        '--cache-dir, keyed by the content of the inputs and by the parameters, and '
+                                        'read back by identical runs (default: always recompute)',
+                        action='store_true')
+    parser.add_argument('--sidecar', help='Keep a memory-mappable binary copy of the parsed tractogram, next to the '
+                                          'file or in the given folder, and reuse it while the file is unchanged',
+                        nargs='?', const=True, default=None, metavar='FOLDER')
+    parser.add_argument('-s', '--subsample', help='Keep a random subset of the streamlines: a number of fibers, or a '
+                                                  'percentage ending with %% (e.g. 5000 or 10%%)', type=check_subsample)
+    parser.add_argument('--stratify', help='Draw the subset in every fiber length decile proportionally to its size.',
+                        action='store_true')
+    parser.add_argument('--seed', help='Random seed of the subsets and of the bootstrap, for reproducible results',
+                        type=check_non_negative)
+    parser.add_argument('--bootstrap', help='Report bootstrap confidence intervals of the per-fiber statistics, with '
+                                            'the given number of resamples (e.g. 1000)', type=check_non_negative,
+                        default=0)
+    parser.add_argument('--confidence', help='Confidence level of the intervals (default: %(default)s)',
+                        type=check_confidence, default=.95)
+    parser.add_argument('--metrics', help='Comma-separated list of the metrics to compute (default: all): points, '
+                                          'lengths, shortest, midpoint, winding, endpoints, FA, b-zero, MD, '
+                                          'profiles', type=check_metrics)
+    parser.add_argument('--service', help='Send the items, one at a time, to the resident service '
+                                          '(tractography_metrics_service.py) listening on the given port (default: '
+                                          '%(const)s) instead of the worker processes',
+                        nargs='?', type=check_port, const=tm.service.PORT, metavar='PORT')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def check_manifest(value):
+    if (value.endswith('.csv') or value.endswith('.json')) and os.path.isfile(os.path.abspath(value)):
+        return value
+    else:
+        raise argparse.ArgumentTypeError("Invalid manifest (file format supported: csv, json): %s" % value)
+
+
+def check_csv(value):
+    if value.endswith('.csv'):
+        return value
+    else:
+        raise argparse.ArgumentTypeError("Invalid output extension (file format supported: csv): %s" % value)
+
+
+if __name__ == '__main__':
+    t0 = time()
+    main()
+    print('Execution time: {} s'.format(round((time() - t0), 2)))
+
+    sys.exit(0)
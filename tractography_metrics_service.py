@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import argparse
+import processing_tm as tm
+from tractography_metrics import check_positive, check_str, check_port
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+
+def main():
+    args = setup()
+
+    if args.status or args.stop:
+        client = tm.ServiceClient(args.port)
+        if not client.available():
+            print('No service running on port {}'.format(args.port))
+            sys.exit(1)
+        print(json.dumps(client.shutdown() if args.stop else client.status(), indent=2))
+        return
+
+    cache = tm.ResultCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+    service = tm.Service(args.port, tm.DataCache(args.memory << 20), cache, verbose=not args.quiet)
+    print('Tractography metrics service listening on {}:{}'.format(*service.server_address))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Resident service keeping the libraries and the parsed inputs in '
+                                                 'memory, for tractography_metrics.py --service, '
+                                                 'tractography_metrics_batch.py --service and the Slicer module')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + tm.__version__)
+    parser.add_argument('-p', '--port', help='Port on the loopback interface (default: %(default)s)', type=check_port,
+                        default=tm.service.PORT)
+    parser.add_argument('--memory', help='Memory of the parsed tractograms and volumes in MB (default: %(default)s)',
+                        type=check_positive, default=tm.cache.DATA_CACHE_BYTES >> 20)
+    parser.add_argument('--cache-dir', help='Folder of the result cache (default: %(default)s)', type=check_str,
+                        default=tm.cache.default_cache_dir())
+    parser.add_argument('--cache-size', help='Size of the result cache in MB (default: %(default)s)',
+                        type=check_positive, default=tm.cache.CACHE_BYTES >> 20)
+    parser.add_argument('--cache', help='Read and write the result cache: the results are stored as pickle files in '
+                                        '--cache-dir, keyed by the content of the inputs and by the parameters, and '
+                                        'read back by identical runs (default: always recompute)',
+                        action='store_true')
+    parser.add_argument('-q', '--quiet', help='Do not log the requests.', action='store_true')
+    parser.add_argument('--status', help='Print the status of the running service and exit.', action='store_true')
+    parser.add_argument('--stop', help='Stop the running service and exit.', action='store_true')
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)